@@ -0,0 +1,251 @@
+"""
+Analisi di frequenza e pagamenti per individuare gli allievi a rischio di abbandono.
+
+Data is loaded in bulk into pandas frames and every indicator is computed
+column-wise, without per-student loops:
+- absence and justified-without-recovery rates from the monthly rollups
+  (presenze_mensili) of the analysed months;
+- absence streaks (current and longest) from the raw presenze of the last
+  STREAK_WINDOW_DAYS, the only indicator that needs the order of the events;
+- late-payment frequency from the fees (mensile/annuale) due in the period.
+
+The result for the whole school is cached in process for ANALYTICS_CACHE_TTL
+seconds: the indicators move slowly and the analysis reads every student.
+Bulk rewrites of its inputs done by this process (archive job, seeding) drop
+the cache at once.
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from archive import stream_across
+from reports import PRESENT, ABSENT, JUSTIFIED, FEE_TYPES, PAID, months_between, next_month
+from rollups import sum_counts
+
+ANALYTICS_CACHE_TTL = int(os.environ.get("ANALYTICS_CACHE_TTL", "600"))
+STREAK_WINDOW_DAYS = 90
+LOAD_BATCH_SIZE = 10_000
+
+# Weight of each indicator in the risk score (sum = 1)
+RISK_WEIGHTS = {
+    "tasso_assenze": 0.35,
+    "serie_assenze": 0.25,
+    "tasso_giustificati_senza_recupero": 0.15,
+    "tasso_ritardi_pagamento": 0.25,
+}
+# A current streak of this many missed lessons weighs as a 100% rate
+STREAK_SATURATION = 4
+RISK_LEVELS = ((0.5, "alto"), (0.25, "medio"), (0.0, "basso"))
+
+_cache: Dict[Tuple, Tuple[float, dict]] = {}
+
+
+# ===================== LOADING =====================
+
+async def load_students(db) -> pd.DataFrame:
+    rows = await db.utenti.find(
+        {"ruolo": "allievo", "attivo": True}, {"_id": 0, "id": 1, "nome": 1, "cognome": 1}
+    ).to_list(None)
+    frame = pd.DataFrame(rows, columns=["id", "nome", "cognome"])
+    return frame.rename(columns={"id": "allievo_id"}).set_index("allievo_id")
+
+
+async def load_attendance_totals(db, months: List[str]) -> pd.DataFrame:
+    """Per-student counters over `months`, summed by MongoDB from the rollups"""
+    rows = await db.presenze_mensili.aggregate([
+        {"$match": {"mese": {"$in": months}}},
+        sum_counts("$allievo_id")
+    ]).to_list(None)
+    frame = pd.DataFrame(rows, columns=["_id", "presenti", "assenti", "giustificati", "recuperi", "totale"])
+    return frame.rename(columns={"_id": "allievo_id"}).set_index("allievo_id")
+
+
+async def _load_columns(rows, columns: List[str]) -> pd.DataFrame:
+    """Cursor (or async stream) -> DataFrame, one list per column instead of one dict per row"""
+    data = {column: [] for column in columns}
+    async for doc in rows:
+        for column in columns:
+            data[column].append(doc.get(column))
+    return pd.DataFrame(data, columns=columns)
+
+
+async def load_recent_attendance(db, since: datetime) -> pd.DataFrame:
+    columns = ["allievo_id", "data", "stato", "recupero_data"]
+    query = {"data": {"$gte": since}}
+    rows = stream_across(db, "presenze", query, {"_id": 0, **{c: 1 for c in columns}}, LOAD_BATCH_SIZE)
+    return await _load_columns(rows, columns)
+
+
+async def load_fees(db, start: datetime, end: datetime) -> pd.DataFrame:
+    columns = ["utente_id", "stato", "data_scadenza", "data_pagamento", "tolleranza_giorni"]
+    query = {
+        "tipo": {"$in": FEE_TYPES},
+        "data_scadenza": {"$gte": start, "$lt": end},
+        "visibile_utente": {"$ne": False}
+    }
+    rows = stream_across(db, "pagamenti", query, {"_id": 0, **{c: 1 for c in columns}}, LOAD_BATCH_SIZE)
+    return await _load_columns(rows, columns)
+
+
+# ===================== INDICATORS =====================
+
+def _naive(value: datetime) -> datetime:
+    """MongoDB returns naive UTC datetimes: compare against naive UTC"""
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def attendance_rates(totals: pd.DataFrame) -> pd.DataFrame:
+    lessons = totals["totale"].where(totals["totale"] > 0)
+    return pd.DataFrame({
+        "lezioni": totals["totale"],
+        "tasso_assenze": (totals["assenti"] + totals["giustificati"] - totals["recuperi"]) / lessons,
+        "giustificati_senza_recupero": totals["giustificati"] - totals["recuperi"],
+        "tasso_giustificati_senza_recupero": (totals["giustificati"] - totals["recuperi"]) / lessons,
+    }, index=totals.index)
+
+
+def attendance_streaks(events: pd.DataFrame) -> pd.DataFrame:
+    """
+    Current and longest run of consecutive missed lessons per student. A lesson
+    is missed when the student was absent, or justified and never recovered.
+    """
+    if events.empty:
+        return pd.DataFrame(columns=["serie_assenze", "serie_assenze_max", "ultima_presenza"])
+    codes, students = pd.factorize(events["allievo_id"])
+    dates = pd.to_datetime(events["data"]).to_numpy()
+    order = np.lexsort((dates, codes))
+    codes, dates = codes[order], dates[order]
+    stato = events["stato"]
+    attended = stato.eq(PRESENT).to_numpy()[order]
+    missed = (stato.eq(ABSENT) | (stato.eq(JUSTIFIED) & events["recupero_data"].isna())).to_numpy()[order]
+
+    # A run starts at every change of student or of missed/attended
+    starts = np.ones(len(codes), dtype=bool)
+    starts[1:] = (codes[1:] != codes[:-1]) | (missed[1:] != missed[:-1])
+    run_start = np.flatnonzero(starts)
+    run_length = np.diff(np.append(run_start, len(codes)))
+    run_student = codes[run_start]
+    missed_length = np.where(missed[run_start], run_length, 0)
+
+    # Runs are grouped by student: the last run of each student is its current one
+    last_run = np.flatnonzero(np.append(run_student[1:] != run_student[:-1], True))
+    longest = np.maximum.reduceat(missed_length, np.append(0, last_run[:-1] + 1))
+    last_attended = pd.Series(dates[attended], index=codes[attended]).groupby(level=0).max()
+
+    frame = pd.DataFrame({
+        "serie_assenze": missed_length[last_run],
+        "serie_assenze_max": longest,
+        "ultima_presenza": last_attended.reindex(run_student[last_run]).to_numpy(),
+    }, index=pd.Index(students[run_student[last_run]], name="allievo_id"))
+    return frame
+
+
+def payment_lateness(fees: pd.DataFrame, now: datetime) -> pd.DataFrame:
+    """
+    Share of the fees already due that were paid late or are still unpaid,
+    honouring the tolerance days of each payment
+    """
+    if fees.empty:
+        return pd.DataFrame(columns=["scadenze", "ritardi", "tasso_ritardi_pagamento"])
+    due = pd.to_datetime(fees["data_scadenza"]) + pd.to_timedelta(
+        fees["tolleranza_giorni"].fillna(0).astype(int), unit="D"
+    )
+    paid_at = pd.to_datetime(fees["data_pagamento"])
+    paid = (fees["stato"] == PAID).to_numpy()
+    now = pd.Timestamp(now)
+
+    counted = paid | (due < now).to_numpy()
+    late = (paid & (paid_at > due).to_numpy()) | (~paid & (due < now).to_numpy())
+    frame = pd.DataFrame({"utente_id": fees["utente_id"], "scadenze": counted, "ritardi": late & counted})
+    per_user = frame.groupby("utente_id").sum()
+    per_user["tasso_ritardi_pagamento"] = per_user["ritardi"] / per_user["scadenze"].where(per_user["scadenze"] > 0)
+    return per_user
+
+
+def risk_scores(frame: pd.DataFrame) -> pd.Series:
+    streak = (frame["serie_assenze"] / STREAK_SATURATION).clip(upper=1)
+    return (
+        RISK_WEIGHTS["tasso_assenze"] * frame["tasso_assenze"]
+        + RISK_WEIGHTS["serie_assenze"] * streak
+        + RISK_WEIGHTS["tasso_giustificati_senza_recupero"] * frame["tasso_giustificati_senza_recupero"]
+        + RISK_WEIGHTS["tasso_ritardi_pagamento"] * frame["tasso_ritardi_pagamento"]
+    ).round(3)
+
+
+def risk_levels(scores: pd.Series) -> np.ndarray:
+    conditions = [scores >= threshold for threshold, _ in RISK_LEVELS]
+    return np.select(conditions, [level for _, level in RISK_LEVELS], default="basso")
+
+
+# ===================== ANALYSIS =====================
+
+def _records(frame: pd.DataFrame) -> List[dict]:
+    """DataFrame rows -> JSON-friendly dicts (NaN/NaT -> None, numpy -> Python)"""
+    frame = frame.reset_index()
+    for column in frame.select_dtypes(include="datetime").columns:
+        frame[column] = frame[column].astype(object)
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+
+async def student_analytics(db, mesi: int = 12, now: Optional[datetime] = None) -> dict:
+    """Risk indicators of every active student over the last `mesi` months"""
+    started = time.perf_counter()
+    now = _naive(now or datetime.now(timezone.utc))
+    end = next_month(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+    start = end
+    for _ in range(mesi):
+        start = (start - timedelta(days=1)).replace(day=1)
+    months = months_between(start, end)
+
+    students = await load_students(db)
+    totals = await load_attendance_totals(db, months)
+    events = await load_recent_attendance(db, now - timedelta(days=STREAK_WINDOW_DAYS))
+    fees = await load_fees(db, start, end)
+
+    frame = (
+        students
+        .join(attendance_rates(totals))
+        .join(attendance_streaks(events))
+        .join(payment_lateness(fees, now)[["scadenze", "ritardi", "tasso_ritardi_pagamento"]])
+    )
+    counters = ["lezioni", "giustificati_senza_recupero", "serie_assenze", "serie_assenze_max", "scadenze", "ritardi"]
+    rates = ["tasso_assenze", "tasso_giustificati_senza_recupero", "tasso_ritardi_pagamento"]
+    frame[counters] = frame[counters].fillna(0).astype(int)
+    frame[rates] = frame[rates].astype(float).fillna(0.0).round(3)
+    frame["punteggio_rischio"] = risk_scores(frame)
+    frame["livello_rischio"] = risk_levels(frame["punteggio_rischio"])
+    frame = frame.sort_values("punteggio_rischio", ascending=False, kind="stable")
+
+    levels = frame["livello_rischio"].value_counts()
+    return {
+        "periodo": {"da": months[0], "a": months[-1], "finestra_serie_giorni": STREAK_WINDOW_DAYS},
+        "riepilogo": {
+            "allievi": len(frame),
+            **{level: int(levels.get(level, 0)) for _, level in RISK_LEVELS},
+        },
+        "allievi": _records(frame),
+        "generato_il": datetime.now(timezone.utc),
+        "durata_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+# ===================== CACHE =====================
+
+async def cached_student_analytics(db, mesi: int = 12, refresh: bool = False) -> Tuple[dict, bool]:
+    """(analysis, served from cache) - recomputed at most once per ANALYTICS_CACHE_TTL"""
+    key = ("allievi", mesi)
+    entry = _cache.get(key)
+    if entry and not refresh and entry[0] > time.monotonic():
+        return entry[1], True
+    result = await student_analytics(db, mesi)
+    _cache[key] = (time.monotonic() + ANALYTICS_CACHE_TTL, result)
+    return result, False
+
+
+def clear_analytics_cache():
+    """Drop the cached analyses, after a bulk change of presenze, rollups or fees"""
+    _cache.clear()
@@ -0,0 +1,258 @@
+"""
+Archiviazione degli anni accademici chiusi (presenze, pagamenti, notifiche).
+
+Documents dated before the start of the current academic year are moved, in
+batches, from the hot collection to `<collection>_archivio`. Only closed
+documents move: paid payments and inactive notifications; open payments stay
+hot whatever their due date, because automations, balances and bank
+reconciliation work on them.
+
+`archivio_stato` records, per collection, the horizon `fino_a`: every archived
+document is dated before it. Reads whose date range starts before the horizon
+(or has no lower bound) also query the archive and merge the results; the
+others never touch it. The horizon is written before the first batch moves, so
+a concurrent reader never misses a document; a document copied but not yet
+deleted from the hot collection is returned once (merge by `id`). A document
+written while its batch moves (reopened, or edited: its `versione` changed)
+stays hot and its archived copy is dropped; if it is still closed, the next
+batch moves it again.
+
+Esempi:
+    python archive.py                 # archivia gli anni accademici chiusi
+    python archive.py --dry-run       # conta soltanto i documenti da archiviare
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, List, Optional
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne
+
+# Load env
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+DEFAULT_BATCH_SIZE = 1000
+# The academic year runs from September to August
+ACADEMIC_YEAR_START_MONTH = 9
+
+# collection -> (archive collection, date field, closed-document filter)
+ARCHIVED = {
+    "presenze": ("presenze_archivio", "data", {}),
+    "pagamenti": ("pagamenti_archivio", "data_scadenza", {"stato": "pagato"}),
+    "notifiche": ("notifiche_archivio", "data_creazione", {"attivo": {"$ne": True}}),
+}
+
+
+class ArchivedRecord(Exception):
+    """The document belongs to a closed academic year and is read-only"""
+
+
+def archive_of(collection: str) -> str:
+    return ARCHIVED[collection][0]
+
+
+def academic_year_start(when: datetime) -> datetime:
+    """First instant of the academic year `when` falls in"""
+    year = when.year if when.month >= ACADEMIC_YEAR_START_MONTH else when.year - 1
+    return datetime(year, ACADEMIC_YEAR_START_MONTH, 1)
+
+
+async def ensure_archive_indexes(db):
+    await db.presenze_archivio.create_index("id", unique=True)
+    await db.presenze_archivio.create_index("data")
+    await db.presenze_archivio.create_index([("allievo_id", 1), ("data", 1)])
+    await db.pagamenti_archivio.create_index("id", unique=True)
+    await db.pagamenti_archivio.create_index([("utente_id", 1), ("data_scadenza", 1)])
+    await db.pagamenti_archivio.create_index("data_scadenza")
+    await db.pagamenti_archivio.create_index("data_pagamento")
+    await db.notifiche_archivio.create_index("data_creazione")
+
+
+# ===================== READS =====================
+
+async def archive_horizon(db, collection: str) -> Optional[datetime]:
+    state = await db.archivio_stato.find_one({"_id": collection})
+    return state["fino_a"] if state else None
+
+
+def range_start(query: dict, field: str) -> Optional[datetime]:
+    """Lower bound of `field` in a find filter, None when unbounded"""
+    condition = query.get(field)
+    if isinstance(condition, dict):
+        return condition.get("$gte", condition.get("$gt"))
+    if isinstance(condition, datetime):
+        return condition
+    return None
+
+
+def _reaches(horizon: Optional[datetime], start: Optional[datetime]) -> bool:
+    return horizon is not None and (start is None or start < horizon)
+
+
+async def reaches_archive(db, collection: str, start: Optional[datetime]) -> bool:
+    """Whether a date range starting at `start` (None = unbounded) includes archived documents"""
+    return _reaches(await archive_horizon(db, collection), start)
+
+
+def _sort_key(field: str):
+    # Missing dates sort first, as in MongoDB
+    return lambda doc: (doc.get(field) is not None, doc.get(field) or datetime.min)
+
+
+async def find_across(
+    db,
+    collection: str,
+    query: dict,
+    projection: dict,
+    sort: int = 1,
+    limit: int = 0
+) -> List[dict]:
+    """
+    find(query).sort(date field, sort).limit(limit) over the hot collection
+    and, when the date range of `query` reaches it, over its archive
+    """
+    archive, field, _ = ARCHIVED[collection]
+    cursor = db[collection].find(query, projection).sort(field, sort)
+    hot = await cursor.to_list(limit or None)
+    horizon = await archive_horizon(db, collection)
+    if not _reaches(horizon, range_start(query, field)):
+        return hot
+
+    # Newest first and already full with documents after the horizon: the archive cannot contribute
+    if sort < 0 and limit and len(hot) >= limit and hot[-1].get(field) and hot[-1][field] >= horizon:
+        return hot
+    cold = await db[archive].find(query, projection).sort(field, sort).to_list(limit or None)
+
+    seen = {doc.get("id") for doc in hot}
+    merged = hot + [doc for doc in cold if doc.get("id") is None or doc.get("id") not in seen]
+    merged.sort(key=_sort_key(field), reverse=sort < 0)
+    return merged[:limit] if limit else merged
+
+
+async def merge_sorted(cursors: list, field: str) -> AsyncIterator[dict]:
+    """Merge cursors each sorted ascending on `field` into one ascending stream"""
+    iterators = [cursor.__aiter__() for cursor in cursors]
+    heads = []
+    for position, iterator in enumerate(iterators):
+        try:
+            heads.append([await iterator.__anext__(), position])
+        except StopAsyncIteration:
+            pass
+    key = _sort_key(field)
+    # A document present in both cursors has the same date in both: dedupe among equal dates only
+    current, seen = None, set()
+    while heads:
+        head = min(heads, key=lambda entry: key(entry[0]))
+        doc = head[0]
+        if doc.get(field) != current:
+            current, seen = doc.get(field), set()
+        if doc.get("id") is None or doc["id"] not in seen:
+            seen.add(doc.get("id"))
+            yield doc
+        try:
+            head[0] = await iterators[head[1]].__anext__()
+        except StopAsyncIteration:
+            heads.remove(head)
+
+
+async def stream_across(db, collection: str, query: dict, projection: dict, batch_size: int) -> AsyncIterator[dict]:
+    """Ascending stream by date of the hot collection, merged with the archive when the range reaches it"""
+    archive, field, _ = ARCHIVED[collection]
+    cursors = [db[collection].find(query, projection).sort(field, 1).batch_size(batch_size)]
+    if await reaches_archive(db, collection, range_start(query, field)):
+        cursors.insert(0, db[archive].find(query, projection).sort(field, 1).batch_size(batch_size))
+    async for doc in merge_sorted(cursors, field):
+        yield doc
+
+
+async def ensure_not_archived(db, collection: str, doc_id: str):
+    """Raise ArchivedRecord if the document was moved to the archive"""
+    if await db[archive_of(collection)].find_one({"id": doc_id}, {"_id": 1}):
+        raise ArchivedRecord(f"Il documento appartiene a un anno accademico archiviato ({collection})")
+
+
+# ===================== JOB =====================
+
+async def archive_collection(
+    db,
+    collection: str,
+    cutoff: datetime,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dry_run: bool = False
+) -> int:
+    """Move the closed documents of `collection` dated before `cutoff` to its archive"""
+    archive, field, closed = ARCHIVED[collection]
+    query = {**closed, field: {"$lt": cutoff}}
+    if dry_run:
+        return await db[collection].count_documents(query)
+
+    # Horizon first: from now on readers of old ranges also look at the archive
+    horizon = await archive_horizon(db, collection)
+    if horizon is None or horizon < cutoff:
+        await db.archivio_stato.update_one(
+            {"_id": collection},
+            {"$set": {"fino_a": cutoff, "data_modifica": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    moved = 0
+    while True:
+        batch = await db[collection].find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        # Upsert by _id, so a batch interrupted between copy and delete can be replayed
+        await db[archive].bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False)
+        # Delete only what is still closed, old and at the copied version: a document
+        # written since it was read keeps its hot copy and loses the stale archived one
+        result = await db[collection].bulk_write([
+            DeleteOne({**query, "_id": doc["_id"], "versione": doc.get("versione")}) for doc in batch
+        ], ordered=False)
+        moved += result.deleted_count
+        if result.deleted_count < len(batch):
+            kept = await db[collection].distinct("_id", {"_id": {"$in": [doc["_id"] for doc in batch]}})
+            await db[archive].delete_many({"_id": {"$in": kept}})
+    return moved
+
+
+async def archive_closed_years(
+    db,
+    now: Optional[datetime] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    dry_run: bool = False
+) -> dict:
+    """Archive every collection up to the start of the current academic year"""
+    cutoff = academic_year_start(now or datetime.now(timezone.utc))
+    counts = {}
+    for collection in ARCHIVED:
+        counts[collection] = await archive_collection(db, collection, cutoff, batch_size, dry_run)
+    return {"fino_a": cutoff, "documenti": counts}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Archivia presenze, pagamenti e notifiche degli anni accademici chiusi")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Conta i documenti da archiviare senza spostarli")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'test_database')]
+
+    started = time.perf_counter()
+    result = await archive_closed_years(db, batch_size=args.batch_size, dry_run=args.dry_run)
+    verb = "da archiviare" if args.dry_run else "archiviati"
+    for collection, count in result["documenti"].items():
+        print(f"{'🔎' if args.dry_run else '✅'} {collection}: {count} documenti {verb} (prima del {result['fino_a']:%d/%m/%Y})")
+    print(f"Completato in {time.perf_counter() - started:.1f}s")
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,112 @@
+"""
+Esecuzione di più richieste API in un'unica chiamata (`POST /api/batch`).
+
+A mobile home screen needs 5-8 independent reads; over a high-latency
+connection paying one round trip for each of them dominates the load time.
+The batch endpoint authenticates the caller once and runs every sub-request
+concurrently inside the process, through the whole ASGI app: routing,
+validation, permission checks and error handling are exactly those of the
+single call. The authenticated user travels in the sub-request scope
+(AUTH_SCOPE_KEY), so handlers do not look the session up again.
+
+Only GET sub-requests are accepted: they run concurrently, with no order
+between them, which is only safe for reads.
+"""
+import asyncio
+import json
+import logging
+from typing import List, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 20
+AUTH_SCOPE_KEY = "utente_autenticato"
+API_PREFIX = "/api/"
+BATCH_PATH = "/api/batch"
+# Parent headers that describe the batch body, not the sub-requests
+DROPPED_HEADERS = {b"content-length", b"content-type", b"transfer-encoding"}
+
+
+class BatchError(Exception):
+    """The batch itself is malformed (too many or unsupported sub-requests)"""
+
+
+def validate(requests: List[dict]):
+    if not requests:
+        raise BatchError("Nessuna richiesta nel batch")
+    if len(requests) > MAX_BATCH_SIZE:
+        raise BatchError(f"Massimo {MAX_BATCH_SIZE} richieste per batch")
+    for position, sub in enumerate(requests):
+        if sub.get("metodo", "GET").upper() != "GET":
+            raise BatchError(f"Richiesta {position}: nel batch sono ammesse solo richieste GET")
+        path = urlsplit(sub["percorso"]).path
+        if not path.startswith(API_PREFIX) or path.rstrip("/") == BATCH_PATH:
+            raise BatchError(f"Richiesta {position}: percorso non ammesso ({path})")
+
+
+def sub_scope(parent: dict, sub: dict, user: Optional[dict]) -> dict:
+    url = urlsplit(sub["percorso"])
+    headers = [(k, v) for k, v in parent["headers"] if k not in DROPPED_HEADERS]
+    for name, value in (sub.get("intestazioni") or {}).items():
+        key = name.lower().encode("latin-1")
+        headers = [(k, v) for k, v in headers if k != key] + [(key, str(value).encode("latin-1"))]
+    return {
+        "type": "http",
+        "asgi": parent.get("asgi", {"version": "3.0"}),
+        "http_version": parent.get("http_version", "1.1"),
+        "scheme": parent.get("scheme", "http"),
+        "server": parent.get("server"),
+        "client": parent.get("client"),
+        "root_path": parent.get("root_path", ""),
+        "method": "GET",
+        "path": url.path,
+        "raw_path": url.path.encode(),
+        "query_string": url.query.encode(),
+        "headers": headers,
+        "state": {},
+        AUTH_SCOPE_KEY: user,
+    }
+
+
+async def call_app(app, scope: dict) -> Tuple[int, dict, bytes]:
+    """Run one request through the ASGI app, returning (status, headers, body)"""
+    response = {"status": 500, "headers": {}, "body": []}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode("latin-1"): v.decode("latin-1") for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        # The error middleware already sent the 500: keep it, do not fail the whole batch
+        logger.exception(f"Batch: richiesta {scope['path']} fallita")
+    return response["status"], response["headers"], b"".join(response["body"])
+
+
+def _entry(position: int, sub: dict, status: int, headers: dict, body: bytes) -> bytes:
+    """One item of the response list; JSON bodies are embedded as they are, without re-encoding"""
+    sub_id = sub["id"] if sub.get("id") is not None else position
+    meta = json.dumps({"id": sub_id, "stato": status}, ensure_ascii=False)
+    if headers.get("content-type", "").startswith("application/json") and body:
+        content = body
+    else:
+        content = json.dumps(body.decode("utf-8", errors="replace") if body else None, ensure_ascii=False).encode()
+    return meta[:-1].encode() + b',"corpo":' + content + b"}"
+
+
+async def run_batch(app, parent_scope: dict, requests: List[dict], user: Optional[dict]) -> bytes:
+    """Run the sub-requests concurrently and return the JSON body {"risposte": [...]}, in request order"""
+    validate(requests)
+    results = await asyncio.gather(*(
+        call_app(app, sub_scope(parent_scope, sub, user)) for sub in requests
+    ))
+    items = [_entry(position, sub, *result) for position, (sub, result) in enumerate(zip(requests, results))]
+    return b'{"risposte":[' + b",".join(items) + b"]}"
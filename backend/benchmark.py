@@ -0,0 +1,423 @@
+"""
+Benchmark riproducibile dell'API Accademia de 'I Musici' contro un MongoDB locale.
+
+Seeds a dedicated database with synthetic data at a configurable scale, then
+drives realistic traffic mixes through the ASGI app in-process and reports
+throughput and p50/p95/p99 latency per route. Results can be saved as a
+baseline and later runs are compared against it.
+
+Esempi:
+    python benchmark.py --students 10000 --teachers 200 --presenze 1000000
+    python benchmark.py --scenario login_storm --scenario dashboard_polling
+    python benchmark.py --save-baseline main
+    python benchmark.py --baseline main --tolerance 0.25
+    python benchmark.py --scenario admin_google_login --google-latency-ms 80
+    python benchmark.py --no-warmup          # misura il primo avvio senza il riscaldamento del lifespan
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import time
+import uuid
+from collections import defaultdict
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from seed_data import generate_dataset, STUDENT_PASSWORD  # noqa: E402
+
+BASELINE_DIR = ROOT_DIR / "bench_baselines"
+# Copies of the seeded collections, restored before each run
+SNAPSHOT_PREFIX = "bench_snapshot_"
+
+SCENARIOS = ["login_storm", "month_start_payments", "teacher_roll_call", "dashboard_polling", "admin_google_login"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark API Accademia de 'I Musici'")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default="bench_musici", help="Database dedicato al benchmark (viene sovrascritto)")
+    parser.add_argument("--students", type=int, default=10000)
+    parser.add_argument("--teachers", type=int, default=200)
+    parser.add_argument("--presenze", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=42, help="Seed per dati e traffico riproducibili")
+    parser.add_argument("--reseed", action="store_true", help="Ricrea i dati anche se già presenti")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Scenari da eseguire (default: tutti)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=500, help="Richieste per scenario")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--baseline", metavar="NAME", help="Confronta con una baseline salvata")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Regressione ammessa (0.2 = +20%% p95)")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="Mantiene i limiti di frequenza (di default disattivati: il traffico arriva da un solo indirizzo)")
+    parser.add_argument("--google-auth-url", help="Provider OAuth Google da usare (default: stub locale avviato dal benchmark)")
+    parser.add_argument("--google-latency-ms", type=float, default=50.0, help="Latenza simulata dallo stub OAuth")
+    parser.add_argument("--no-warmup", action="store_true",
+                        help="Non esegue il lifespan dell'app (indici, connessioni, cache, bcrypt): misura l'avvio a freddo")
+    return parser.parse_args(argv)
+
+
+# ===================== DATASET =====================
+
+async def data_collections(db) -> list:
+    return [
+        name for name in await db.list_collection_names()
+        if name != "bench_meta" and not name.startswith((SNAPSHOT_PREFIX, "system."))
+    ]
+
+
+async def snapshot(db):
+    """Server-side copy of every collection as seeded, restored before each run"""
+    for name in await data_collections(db):
+        await db[name].aggregate([{"$match": {}}, {"$out": SNAPSHOT_PREFIX + name}]).to_list(None)
+
+
+async def restore(db):
+    """
+    Bring the dataset back to the seeded state: the scenarios write (monthly fees,
+    roll calls, sessions, balances), so without this every run would measure a
+    different workload than the previous one. $out keeps the indexes of the target.
+    """
+    started = time.perf_counter()
+    existing = set(await data_collections(db))
+    seeded = {
+        name[len(SNAPSHOT_PREFIX):] for name in await db.list_collection_names() if name.startswith(SNAPSHOT_PREFIX)
+    }
+    for name in seeded:
+        await db[SNAPSHOT_PREFIX + name].aggregate([{"$match": {}}, {"$out": name}]).to_list(None)
+    for name in existing - seeded:
+        # Created by a previous run (idempotency keys, report generations, ...)
+        await db[name].delete_many({})
+    print(f"Dataset ripristinato allo stato del seeding in {time.perf_counter() - started:.1f}s")
+
+
+async def seed(db, args) -> str:
+    """
+    Populate the benchmark database, or restore the snapshot taken when the same
+    scale was seeded. Returns how the run's dataset was obtained ("seed" or "snapshot").
+    """
+    scale = {"students": args.students, "teachers": args.teachers, "presenze": args.presenze, "seed": args.seed}
+    meta = await db.bench_meta.find_one({"_id": "scale"})
+    if meta and meta.get("scale") == scale and meta.get("snapshot") and not args.reseed:
+        print(f"Dataset già presente ({scale}), seeding saltato")
+        await restore(db)
+        return "snapshot"
+
+    started = time.perf_counter()
+    for name in await db.list_collection_names():
+        await db.drop_collection(name)
+
+    counts = await generate_dataset(db, {
+        "allievi": args.students,
+        "insegnanti": args.teachers,
+        "presenze": args.presenze,
+        "corsi_per_insegnante": 1,
+        "mesi": 3,
+        "notifiche": 20,
+        "compiti_per_allievo": 1,
+    }, seed=args.seed)
+    await snapshot(db)
+
+    await db.bench_meta.replace_one({"_id": "scale"}, {"_id": "scale", "scale": scale, "snapshot": True}, upsert=True)
+    print(f"Dataset creato in {time.perf_counter() - started:.1f}s: {counts}")
+    return "seed"
+
+
+# ===================== TRAFFIC =====================
+
+class Recorder:
+    """Collects latencies per route label"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def call(self, http, label, method, url, **kwargs):
+        started = time.perf_counter()
+        response = await http.request(method, url, **kwargs)
+        self.latencies[label].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[label] += 1
+        return response
+
+
+async def run_concurrently(jobs, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(job):
+        async with semaphore:
+            await job()
+
+    await asyncio.gather(*(guarded(job) for job in jobs))
+
+
+async def open_sessions(db, create_access_token, users):
+    """Create sessions directly so non-login scenarios do not pay for bcrypt"""
+    tokens = {}
+    now = datetime.now(timezone.utc)
+    sessions = []
+    for user in users:
+        token = create_access_token({"sub": user["id"], "ruolo": user["ruolo"], "jti": str(uuid.uuid4())})
+        tokens[user["id"]] = token
+        sessions.append({
+            "id": str(uuid.uuid4()), "utente_id": user["id"], "token_sessione": token, "dispositivo": "benchmark",
+            "ip": None, "data_creazione": now, "data_scadenza": now + timedelta(days=1)
+        })
+    if sessions:
+        await db.sessioni.insert_many(sessions)
+    return tokens
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def scenario_login_storm(http, db, ctx, rec, args, rng):
+    students = ctx["students"]
+
+    def job(user):
+        return lambda: rec.call(http, "POST /api/auth/login", "POST", "/api/auth/login",
+                                json={"email": user["email"], "password": STUDENT_PASSWORD})
+
+    await run_concurrently([job(rng.choice(students)) for _ in range(args.requests)], args.concurrency)
+
+
+async def scenario_month_start_payments(http, db, ctx, rec, args, rng):
+    admin = auth(ctx["tokens"][ctx["admin"]["id"]])
+    mese = (datetime.now(timezone.utc) + timedelta(days=31 * (1 + rng.randrange(24)))).strftime("%Y-%m")
+    await rec.call(http, "POST /api/automazioni/crea-pagamenti-mensili", "POST",
+                   "/api/automazioni/crea-pagamenti-mensili", headers=admin, json={"mese": mese})
+    await rec.call(http, "POST /api/automazioni/aggiorna-pagamenti-scaduti", "POST",
+                   "/api/automazioni/aggiorna-pagamenti-scaduti", headers=admin)
+
+    def job(user):
+        return lambda: rec.call(http, "GET /api/pagamenti", "GET", "/api/pagamenti",
+                                headers=auth(ctx["tokens"][user["id"]]))
+
+    jobs = [job(rng.choice(ctx["session_students"])) for _ in range(args.requests)]
+    jobs += [lambda: rec.call(http, "GET /api/pagamenti (admin)", "GET", "/api/pagamenti", headers=admin,
+                              params={"stato": "in_attesa"}) for _ in range(max(1, args.requests // 20))]
+    rng.shuffle(jobs)
+    await run_concurrently(jobs, args.concurrency)
+
+
+async def scenario_teacher_roll_call(http, db, ctx, rec, args, rng):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    async def roll_call(teacher):
+        headers = auth(ctx["tokens"][teacher["id"]])
+        response = await rec.call(http, "GET /api/insegnante/allievi", "GET", "/api/insegnante/allievi", headers=headers)
+        roster = response.json() if response.status_code == 200 else []
+        for student in roster[:10]:
+            await rec.call(http, "POST /api/presenze", "POST", "/api/presenze", headers=headers, json={
+                "allievo_id": student["id"], "data": today, "stato": rng.choice(["presente", "presente", "assente"])
+            })
+        await rec.call(http, "GET /api/presenze", "GET", "/api/presenze", headers=headers,
+                       params={"from_date": today})
+
+    teachers = ctx["session_teachers"]
+    rounds = max(1, args.requests // 12)
+    await run_concurrently([lambda t=teachers[i % len(teachers)]: roll_call(t) for i in range(rounds)],
+                           args.concurrency)
+
+
+async def scenario_dashboard_polling(http, db, ctx, rec, args, rng):
+    paths = ["/api/auth/me", "/api/notifiche", "/api/pagamenti", "/api/compiti", "/api/lezioni", "/api/presenze"]
+
+    def job(user):
+        async def poll():
+            headers = auth(ctx["tokens"][user["id"]])
+            for path in paths:
+                await rec.call(http, f"GET {path}", "GET", path, headers=headers)
+        return poll
+
+    rounds = max(1, args.requests // len(paths))
+    await run_concurrently([job(rng.choice(ctx["session_students"])) for _ in range(rounds)], args.concurrency)
+
+
+async def scenario_admin_google_login(http, db, ctx, rec, args, rng):
+    email = ctx["admin"]["email"]
+
+    def job():
+        return rec.call(http, "POST /api/auth/admin/google", "POST", "/api/auth/admin/google",
+                        json={"email": email, "session_id": f"email:{email}"})
+
+    await run_concurrently([job for _ in range(args.requests)], args.concurrency)
+
+
+SCENARIO_FUNCS = {
+    "login_storm": scenario_login_storm,
+    "month_start_payments": scenario_month_start_payments,
+    "teacher_roll_call": scenario_teacher_roll_call,
+    "dashboard_polling": scenario_dashboard_polling,
+    "admin_google_login": scenario_admin_google_login,
+}
+
+
+# ===================== REPORT =====================
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(rec: Recorder, elapsed: float) -> dict:
+    routes = {}
+    for label, values in rec.latencies.items():
+        values = sorted(values)
+        routes[label] = {
+            "count": len(values),
+            "errors": rec.errors.get(label, 0),
+            "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p95_ms": round(percentile(values, 95) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            # The first call of a route shows what a cold worker pays
+            "first_ms": round(rec.latencies[label][0] * 1000, 2),
+        }
+    total = sum(len(v) for v in rec.latencies.values())
+    return {"elapsed_s": round(elapsed, 3), "throughput_rps": round(total / elapsed, 2) if elapsed else 0.0,
+            "routes": routes}
+
+
+def print_report(results: dict):
+    for scenario, summary in results.items():
+        print(f"\n== {scenario}: {summary['throughput_rps']} req/s in {summary['elapsed_s']}s")
+        print(f"   {'route':<52}{'n':>7}{'err':>6}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'prima':>10}")
+        for label, r in sorted(summary["routes"].items()):
+            print(f"   {label:<52}{r['count']:>7}{r['errors']:>6}{r['throughput_rps']:>10}"
+                  f"{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r.get('first_ms', '-'):>10}")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Routes whose p95 grew, or throughput dropped, beyond the tolerance"""
+    regressions = []
+    for scenario, summary in results.items():
+        base_routes = baseline.get("results", {}).get(scenario, {}).get("routes", {})
+        for label, r in summary["routes"].items():
+            base = base_routes.get(label)
+            if not base:
+                continue
+            if base["p95_ms"] and r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{scenario} {label}: p95 {base['p95_ms']} -> {r['p95_ms']} ms")
+            if base["throughput_rps"] and r["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{scenario} {label}: {base['throughput_rps']} -> {r['throughput_rps']} req/s")
+    return regressions
+
+
+# ===================== MAIN =====================
+
+async def start_google_stub(latency_ms: float):
+    """Run the OAuth stub on a free local port over real HTTP, so connection reuse is measured too"""
+    import uvicorn
+    from google_auth_stub import SESSION_PATH, create_app
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    stub = uvicorn.Server(uvicorn.Config(create_app(latency_ms), host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(stub.serve())
+    while not stub.started:
+        await asyncio.sleep(0.01)
+    return stub, task, f"http://127.0.0.1:{port}{SESSION_PATH}"
+
+
+async def main(args) -> int:
+    stub = None
+    if "admin_google_login" in (args.scenario or SCENARIOS) and not args.google_auth_url:
+        stub, stub_task, args.google_auth_url = await start_google_stub(args.google_latency_ms)
+
+    # The app reads its configuration at import time
+    os.environ["MONGO_URL"] = args.mongo_url
+    os.environ["DB_NAME"] = args.db
+    if args.google_auth_url:
+        os.environ["GOOGLE_AUTH_URL"] = args.google_auth_url
+    import httpx
+    import server
+
+    if not args.rate_limits:
+        server.rate_limiter.rules = {}
+
+    db = server.db
+    dataset = await seed(db, args)
+
+    rng = random.Random(args.seed)
+    admin = await db.utenti.find_one({"ruolo": "amministratore"}, {"_id": 0, "id": 1, "ruolo": 1, "email": 1})
+    students = await db.utenti.find({"ruolo": "allievo", "attivo": True}, {"_id": 0, "id": 1, "ruolo": 1, "email": 1}).to_list(None)
+    teachers = await db.utenti.find({"ruolo": "insegnante"}, {"_id": 0, "id": 1, "ruolo": 1}).to_list(None)
+    session_students = rng.sample(students, min(len(students), 500))
+    session_teachers = rng.sample(teachers, min(len(teachers), 50))
+    await db.sessioni.delete_many({"dispositivo": "benchmark"})
+    tokens = await open_sessions(db, server.create_access_token, [admin] + session_students + session_teachers)
+    ctx = {"admin": admin, "students": students, "session_students": session_students,
+           "session_teachers": session_teachers, "tokens": tokens}
+
+    results = {}
+    transport = httpx.ASGITransport(app=server.app)
+    async with AsyncExitStack() as stack:
+        # ASGITransport does not run the lifespan: enter it the way the ASGI server does
+        if not args.no_warmup:
+            await stack.enter_async_context(server.app.router.lifespan_context(server.app))
+            print(f"Riscaldamento (ms): {server.lifecycle.steps}")
+        http = await stack.enter_async_context(
+            httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None)
+        )
+        for name in args.scenario or SCENARIOS:
+            rec = Recorder()
+            started = time.perf_counter()
+            await SCENARIO_FUNCS[name](http, db, ctx, rec, args, random.Random(f"{args.seed}-{name}"))
+            results[name] = summarize(rec, time.perf_counter() - started)
+
+    if args.no_warmup:
+        await server.google_auth.close()
+    if stub is not None:
+        stub.should_exit = True
+        await stub_task
+
+    print_report(results)
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "scale": {"students": args.students, "teachers": args.teachers, "presenze": args.presenze},
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        # Every run starts from the freshly seeded state: generated now or restored from its snapshot
+        "dataset": {"fresh": True, "from": dataset},
+        "warmup_ms": None if args.no_warmup else server.lifecycle.steps,
+        "results": results,
+    }
+
+    if args.save_baseline:
+        BASELINE_DIR.mkdir(exist_ok=True)
+        path = BASELINE_DIR / f"{args.save_baseline}.json"
+        path.write_text(json.dumps(report, indent=2))
+        print(f"\nBaseline salvata in {path}")
+
+    if args.baseline:
+        baseline = json.loads((BASELINE_DIR / f"{args.baseline}.json").read_text())
+        if baseline.get("scale") != report["scale"]:
+            print(f"\nAttenzione: scala diversa dalla baseline ({baseline.get('scale')})")
+        if not baseline.get("dataset", {}).get("fresh"):
+            print("\nAttenzione: la baseline non parte da un dataset appena creato, il carico può essere diverso")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\nREGRESSIONI:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print(f"\nNessuna regressione rispetto a '{args.baseline}' (tolleranza {args.tolerance:.0%})")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,169 @@
+"""
+Dashboard di allievo e insegnante in una sola richiesta.
+
+Each dashboard runs its reads concurrently with asyncio.gather and fetches
+only the fields its screen shows (fixed projections, small limits) instead
+of the full documents returned by the list endpoints. Names of teachers,
+courses and students come from the reference-data cache.
+
+The result is cached per user for DASHBOARD_CACHE_TTL seconds: pull to
+refresh and tab switches reuse it, and concurrent requests of the same user
+share a single computation.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from reports import OPEN_STATES
+from singleflight import reads, shared_find
+
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", "5"))
+UPCOMING_DAYS = 14
+LIST_LIMIT = 10
+
+LESSON_FIELDS = {"_id": 0, "id": 1, "corso_id": 1, "insegnante_id": 1, "data": 1, "ora": 1, "durata": 1}
+ASSIGNMENT_FIELDS = {"_id": 0, "id": 1, "titolo": 1, "data_scadenza": 1, "allievo_id": 1, "insegnante_id": 1}
+PAYMENT_FIELDS = {"_id": 0, "id": 1, "tipo": 1, "importo": 1, "descrizione": 1, "data_scadenza": 1, "stato": 1}
+NOTIFICATION_FIELDS = {"_id": 0, "id": 1, "titolo": 1, "messaggio": 1, "tipo": 1, "data_creazione": 1}
+
+_cache: Dict[Tuple[str, str], Tuple[float, dict]] = {}
+
+
+def _today() -> datetime:
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _person(user: Optional[dict]) -> Optional[dict]:
+    return {"id": user["id"], "nome": user["nome"], "cognome": user["cognome"]} if user else None
+
+
+# ===================== SECTIONS =====================
+
+async def open_assignments(db, owner_field: str, user_id: str) -> List[dict]:
+    return await db.compiti.find(
+        {owner_field: user_id, "completato": False}, ASSIGNMENT_FIELDS
+    ).sort("data_scadenza", 1).to_list(LIST_LIMIT)
+
+
+async def open_payments(db, user_id: str) -> List[dict]:
+    return await db.pagamenti.find(
+        {"utente_id": user_id, "visibile_utente": True, "stato": {"$in": OPEN_STATES}}, PAYMENT_FIELDS
+    ).sort("data_scadenza", 1).to_list(LIST_LIMIT)
+
+
+async def active_notifications(db, user_id: str) -> List[dict]:
+    """Newest active notifications for everybody (one read shared by all users) or for `user_id`"""
+    newest = [("data_creazione", -1)]
+    broadcast, targeted = await asyncio.gather(
+        shared_find(db.notifiche, {"attivo": True, "destinatari_ids": {"$size": 0}}, NOTIFICATION_FIELDS, newest, LIST_LIMIT),
+        db.notifiche.find({"attivo": True, "destinatari_ids": user_id}, NOTIFICATION_FIELDS).sort(newest).to_list(LIST_LIMIT)
+    )
+    return sorted(broadcast + targeted, key=lambda n: n["data_creazione"], reverse=True)[:LIST_LIMIT]
+
+
+async def upcoming_lessons(db, refs, query: dict, until: datetime) -> List[dict]:
+    lessons = await db.lezioni.find(
+        {**query, "data": {"$gte": _today(), "$lt": until}}, LESSON_FIELDS
+    ).sort([("data", 1), ("ora", 1)]).to_list(LIST_LIMIT)
+    courses, teachers = await asyncio.gather(
+        refs.courses_by_id(lesson.get("corso_id") for lesson in lessons),
+        refs.users_by_id(lesson.get("insegnante_id") for lesson in lessons)
+    )
+    for lesson in lessons:
+        course = courses.get(lesson.get("corso_id"))
+        lesson["corso"] = {"nome": course["nome"], "strumento": course["strumento"]} if course else None
+        lesson["insegnante"] = _person(teachers.get(lesson.get("insegnante_id")))
+    return lessons
+
+
+async def course_rosters(db, refs, course_ids: List[str], enrollment_filter: dict) -> Dict[str, List[dict]]:
+    """Active students enrolled in each course, sorted by name"""
+    enrollments = await db.iscrizioni.find(
+        {"corso_id": {"$in": course_ids}, **enrollment_filter}, {"_id": 0, "corso_id": 1, "allievo_id": 1}
+    ).to_list(None)
+    students = await refs.users_by_id(e["allievo_id"] for e in enrollments)
+    rosters = {course_id: {} for course_id in course_ids}
+    for enrollment in enrollments:
+        student = students.get(enrollment["allievo_id"])
+        if student and student.get("attivo"):
+            rosters[enrollment["corso_id"]][student["id"]] = _person(student)
+    return {
+        course_id: sorted(roster.values(), key=lambda s: (s["cognome"], s["nome"]))
+        for course_id, roster in rosters.items()
+    }
+
+
+# ===================== DASHBOARDS =====================
+
+async def student_dashboard(db, refs, user: dict, enrollment_filter: dict) -> dict:
+    enrollments = await db.iscrizioni.find(
+        {"allievo_id": user["id"], **enrollment_filter}, {"_id": 0, "corso_id": 1, "insegnante_id": 1}
+    ).to_list(None)
+    course_ids = sorted({e["corso_id"] for e in enrollments if e.get("corso_id")})
+    teacher_ids = {user.get("insegnante_id")} | {e.get("insegnante_id") for e in enrollments}
+
+    lessons, assignments, payments, notifications, teachers = await asyncio.gather(
+        upcoming_lessons(db, refs, {"corso_id": {"$in": course_ids}}, _today() + timedelta(days=UPCOMING_DAYS)),
+        open_assignments(db, "allievo_id", user["id"]),
+        open_payments(db, user["id"]),
+        active_notifications(db, user["id"]),
+        refs.users_by_id(teacher_ids)
+    )
+    return {
+        "lezioni": lessons,
+        "compiti": assignments,
+        "pagamenti": payments,
+        "totale_da_pagare": round(sum(p.get("importo") or 0 for p in payments), 2),
+        "notifiche": notifications,
+        "insegnanti": sorted(
+            (_person(t) for t in teachers.values()), key=lambda t: (t["cognome"], t["nome"])
+        ),
+    }
+
+
+async def teacher_dashboard(db, refs, user: dict, enrollment_filter: dict) -> dict:
+    today = _today()
+    todays, lessons, assignments, payments, notifications, students = await asyncio.gather(
+        upcoming_lessons(db, refs, {"insegnante_id": user["id"]}, today + timedelta(days=1)),
+        upcoming_lessons(db, refs, {"insegnante_id": user["id"]}, today + timedelta(days=UPCOMING_DAYS)),
+        open_assignments(db, "insegnante_id", user["id"]),
+        open_payments(db, user["id"]),
+        active_notifications(db, user["id"]),
+        db.iscrizioni.distinct("allievo_id", {"insegnante_id": user["id"], **enrollment_filter})
+    )
+
+    course_ids = sorted({lesson["corso_id"] for lesson in todays if lesson.get("corso_id")})
+    rosters = await course_rosters(db, refs, course_ids, enrollment_filter)
+    for lesson in todays:
+        lesson["allievi"] = rosters.get(lesson.get("corso_id"), [])
+    names = await refs.users_by_id(a.get("allievo_id") for a in assignments)
+    for assignment in assignments:
+        assignment["allievo"] = _person(names.get(assignment.get("allievo_id")))
+    return {
+        "oggi": todays,
+        "lezioni": lessons,
+        "compiti_aperti": assignments,
+        "pagamenti": payments,
+        "notifiche": notifications,
+        "allievi_attivi": len(students),
+    }
+
+
+# ===================== CACHE =====================
+
+async def cached_dashboard(kind: str, user_id: str, build: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+    """(dashboard, served from cache) - rebuilt at most once per DASHBOARD_CACHE_TTL per user"""
+    key = (kind, user_id)
+    entry = _cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1], True
+    result = await reads.do(f"dashboard|{kind}|{user_id}", f"dashboard_{kind}", build)
+    now = time.monotonic()
+    _cache[key] = (now + DASHBOARD_CACHE_TTL, result)
+    # Drop the expired entries of users who did not come back
+    if len(_cache) > 1000:
+        for stale in [k for k, (expires, _) in _cache.items() if expires <= now]:
+            del _cache[stale]
+    return result, False
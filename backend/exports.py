@@ -0,0 +1,226 @@
+"""
+Export in streaming di presenze, pagamenti e compensi (NDJSON, CSV, Parquet).
+
+Rows are read from a Motor cursor and encoded as they arrive, so memory stays
+bounded by one cursor batch (one row group for Parquet) whatever the size of
+the export. Each export declares its columns and their types: CSV uses them for
+the header, Parquet for a schema that stays the same across row groups.
+"""
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+# Flush the response roughly every 64 KiB instead of once per row
+FLUSH_BYTES = 64 * 1024
+PARQUET_ROW_GROUP = 10_000
+
+# (nome colonna, tipo): tipo is one of str, float, int, bool, datetime
+PRESENZE_COLUMNS = [
+    ("id", "str"),
+    ("data", "datetime"),
+    ("allievo_id", "str"),
+    ("insegnante_id", "str"),
+    ("corso_id", "str"),
+    ("lezione_id", "str"),
+    ("stato", "str"),
+    ("recupero_data", "datetime"),
+    ("note", "str"),
+    ("data_creazione", "datetime"),
+]
+
+PAGAMENTI_COLUMNS = [
+    ("id", "str"),
+    ("utente_id", "str"),
+    ("tipo", "str"),
+    ("importo", "float"),
+    ("descrizione", "str"),
+    ("data_scadenza", "datetime"),
+    ("stato", "str"),
+    ("data_pagamento", "datetime"),
+    ("data_inizio_validita", "datetime"),
+    ("data_fine_validita", "datetime"),
+    ("tolleranza_giorni", "int"),
+    ("visibile_utente", "bool"),
+    ("data_creazione", "datetime"),
+]
+
+COMPENSI_COLUMNS = [
+    ("insegnante_id", "str"),
+    ("nome", "str"),
+    ("cognome", "str"),
+    ("presenti", "int"),
+    ("assenti", "int"),
+    ("giustificati", "int"),
+    ("recuperi", "int"),
+    ("lezioni_pagate", "int"),
+    ("quota_per_presenza", "float"),
+    ("totale_compenso", "float"),
+]
+
+
+class ExportUnavailable(Exception):
+    """The requested format needs an optional dependency that is not installed"""
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def stream_ndjson(rows: AsyncIterator[dict], columns: List[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """One JSON object per line, all columns of the export in declared order"""
+    names = [name for name, _ in columns]
+    buffer = []
+    size = 0
+    async for row in rows:
+        line = json.dumps({name: row.get(name) for name in names}, default=_json_default, ensure_ascii=False) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= FLUSH_BYTES:
+            yield "".join(buffer).encode("utf-8")
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+async def stream_csv(rows: AsyncIterator[dict], columns: List[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """CSV with a header row; the UTF-8 BOM lets Excel pick the right encoding"""
+    names = [name for name, _ in columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("﻿")
+    writer.writerow(names)
+    async for row in rows:
+        writer.writerow([_csv_value(row.get(name)) for name in names])
+        if buffer.tell() >= FLUSH_BYTES:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file object that hands back what was written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema(pa, columns: List[Tuple[str, str]]):
+    types = {
+        "str": pa.string(),
+        "float": pa.float64(),
+        "int": pa.int64(),
+        "bool": pa.bool_(),
+        "datetime": pa.timestamp("ms", tz="UTC"),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+async def stream_parquet(
+    rows: AsyncIterator[dict],
+    columns: List[Tuple[str, str]],
+    row_group: int = PARQUET_ROW_GROUP
+) -> AsyncIterator[bytes]:
+    """Parquet file written one row group at a time, each flushed as soon as it is encoded"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportUnavailable("Export Parquet non disponibile: installare pyarrow")
+
+    schema = _parquet_schema(pa, columns)
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    batch = []
+
+    def write_batch():
+        arrays = [
+            pa.array([row.get(field.name) for row in batch], type=field.type)
+            for field in schema
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        batch.clear()
+
+    try:
+        async for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group:
+                write_batch()
+                yield sink.drain()
+        if batch:
+            write_batch()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+STREAMERS: Dict[str, Callable] = {
+    "ndjson": stream_ndjson,
+    "csv": stream_csv,
+    "parquet": stream_parquet,
+}
+
+
+async def export_stream(rows: AsyncIterator[dict], formato: str, columns: List[Tuple[str, str]]) -> AsyncIterator[bytes]:
+    """
+    Encode `rows` in `formato`. The first chunk is produced before returning, so
+    a missing optional dependency surfaces as ExportUnavailable while the
+    response can still become an error instead of a truncated download.
+    """
+    stream = STREAMERS[formato](rows, columns)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = b""
+
+    async def chained():
+        if first:
+            yield first
+        async for chunk in stream:
+            yield chunk
+
+    return chained()
@@ -0,0 +1,108 @@
+"""
+Campi selezionabili (`fields=`) sulle liste dell'API.
+
+`?fields=id,nome,cognome` turns into a MongoDB inclusion projection, so the
+unneeded fields (long descriptions, notes, embedded details) are neither
+read from MongoDB nor serialized. Every role has a whitelist of the fields
+it may ask for; a field outside it is an error, not silently dropped.
+Without `fields` the lists return the same documents as before.
+
+`id` and the field the list is sorted on are always included: the archive
+merge and the clients rely on them. Some lists add computed fields (the
+course and teacher of a lesson): they are requested by name like the others
+and pull in the field they are computed from.
+"""
+from typing import Dict, Optional, Set
+
+ADMIN = "amministratore"
+ANY_ROLE = "*"
+
+# collection -> role -> fields that role may request (ANY_ROLE: every role)
+FIELDSETS: Dict[str, Dict[str, Set[str]]] = {
+    "utenti": {
+        ADMIN: {
+            "id", "ruolo", "nome", "cognome", "email", "data_nascita", "attivo", "first_login",
+            "data_creazione", "ultimo_accesso", "note_admin", "insegnante_id", "strumento", "dettaglio", "versione",
+        },
+    },
+    "pagamenti": {
+        ANY_ROLE: {
+            "id", "utente_id", "tipo", "importo", "descrizione", "data_scadenza", "stato", "data_pagamento",
+            "data_inizio_validita", "data_fine_validita", "tolleranza_giorni", "data_creazione", "data_modifica", "versione",
+        },
+        ADMIN: {"visibile_utente", "riconciliazione_id"},
+    },
+    "presenze": {
+        ANY_ROLE: {
+            "id", "corso_id", "lezione_id", "allievo_id", "insegnante_id", "data", "stato", "recupero_data",
+            "note", "data_creazione", "data_modifica", "versione",
+        },
+    },
+    "lezioni": {
+        ANY_ROLE: {
+            "id", "corso_id", "insegnante_id", "data", "ora", "durata", "note", "data_creazione", "data_modifica",
+            "versione", "corso", "insegnante",
+        },
+    },
+    "compiti": {
+        ANY_ROLE: {
+            "id", "insegnante_id", "allievo_id", "titolo", "descrizione", "data_scadenza", "completato",
+            "data_creazione", "data_modifica", "versione",
+        },
+    },
+    "notifiche": {
+        ANY_ROLE: {"id", "titolo", "messaggio", "tipo", "attivo", "data_creazione", "data_modifica", "versione"},
+        ADMIN: {"destinatari_tipo", "destinatari_ids", "filtro_pagamento"},
+    },
+}
+
+# Always returned: the id and the sort field of each list
+ALWAYS = {
+    "utenti": ("id",),
+    "pagamenti": ("id", "data_scadenza"),
+    "presenze": ("id", "data"),
+    "lezioni": ("id", "data"),
+    "compiti": ("id", "data_scadenza"),
+    "notifiche": ("id", "data_creazione"),
+}
+
+# Computed fields -> the stored field they are computed from
+COMPUTED = {
+    "lezioni": {"corso": "corso_id", "insegnante": "insegnante_id"},
+}
+
+
+class InvalidFields(Exception):
+    """A requested field does not exist or is not available to the role"""
+
+
+def allowed_fields(collection: str, role: str) -> Set[str]:
+    roles = FIELDSETS[collection]
+    return roles.get(ANY_ROLE, set()) | roles.get(role, set())
+
+
+def requested_fields(fields: Optional[str]) -> Optional[Set[str]]:
+    """The names in `?fields=a,b,c`, None when the parameter is absent"""
+    if not fields:
+        return None
+    return {field.strip() for field in fields.split(",") if field.strip()} or None
+
+
+def projection(collection: str, role: str, fields: Optional[str], default: dict) -> dict:
+    """MongoDB projection for `?fields=` (`default` when the parameter is absent)"""
+    requested = requested_fields(fields)
+    if requested is None:
+        return default
+    refused = requested - allowed_fields(collection, role)
+    if refused:
+        raise InvalidFields(f"Campi non disponibili: {', '.join(sorted(refused))}")
+
+    computed = COMPUTED.get(collection, {})
+    stored = {computed.get(field, field) for field in requested} | set(ALWAYS[collection])
+    return {"_id": 0, **{field: 1 for field in sorted(stored)}}
+
+
+def wants(fields: Optional[str], field: str) -> bool:
+    """Whether a computed field must be added to the documents"""
+    requested = requested_fields(fields)
+    return requested is None or field in requested
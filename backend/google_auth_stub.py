@@ -0,0 +1,72 @@
+"""
+Finto provider OAuth Google per prove locali e benchmark.
+
+Answers like the session-data endpoint used by `POST /api/auth/admin/google`:
+the session id `email:<address>` is a valid session of that address, any
+other id is rejected with 401. Latency and failures can be injected to see
+the timeouts and the circuit breaker at work.
+
+Esempi:
+    python google_auth_stub.py --port 8765
+    python google_auth_stub.py --latency-ms 200 --failure-rate 0.3
+    GOOGLE_AUTH_URL=http://127.0.0.1:8765/auth/v1/env/oauth/session-data uvicorn server:app
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+SESSION_PATH = "/auth/v1/env/oauth/session-data"
+SESSION_PREFIX = "email:"
+
+
+def create_app(latency_ms: float = 0.0, failure_rate: float = 0.0, seed: int = 0) -> Starlette:
+    rng = random.Random(seed)
+    stats = {"richieste": 0, "errori_simulati": 0}
+
+    async def session_data(request: Request):
+        stats["richieste"] += 1
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        if failure_rate and rng.random() < failure_rate:
+            stats["errori_simulati"] += 1
+            return JSONResponse({"error": "errore simulato"}, status_code=503)
+
+        session_id = request.headers.get("x-session-id", "")
+        if not session_id.startswith(SESSION_PREFIX):
+            return JSONResponse({"error": "sessione non valida"}, status_code=401)
+        email = session_id[len(SESSION_PREFIX):].lower()
+        return JSONResponse({
+            "email": email,
+            "sub": hashlib.sha256(email.encode()).hexdigest()[:21],
+            "name": email.split("@")[0],
+        })
+
+    async def stats_view(request: Request):
+        return JSONResponse(stats)
+
+    return Starlette(routes=[Route(SESSION_PATH, session_data), Route("/stats", stats_view)])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Finto provider OAuth Google")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Ritardo aggiunto a ogni risposta")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Frazione di risposte 503 (0-1)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    print(f"GOOGLE_AUTH_URL=http://{args.host}:{args.port}{SESSION_PATH}")
+    uvicorn.run(create_app(args.latency_ms, args.failure_rate, args.seed), host=args.host, port=args.port,
+                log_level="warning")
@@ -0,0 +1,292 @@
+"""
+Chiavi di idempotenza (`Idempotency-Key`) per le richieste POST.
+
+A mobile client that loses the response of a POST on a flaky network sends
+it again, and every retry used to create another attendance, payment,
+assignment or notification. A POST carrying an `Idempotency-Key` header now
+runs once: the response is stored under the key, and a retry gets it back
+(with `Idempotent-Replayed: true`) without running the handler again.
+
+Keys belong to the session that sent them and are kept in
+`chiavi_idempotenza`, which a TTL index empties after IDEMPOTENCY_TTL_HOURS.
+Recently completed keys are also kept in memory, so most retries do not
+touch MongoDB. Concurrent retries of the same key wait for the first one in
+the same worker; in another worker they get 409 until it completes. A key
+reused for a different request is refused (422). Responses with a 5xx
+status are not stored: the key is released and the request can be retried.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get("IDEMPOTENCY_TTL_HOURS", "24"))
+# A key left "in progress" longer than this by a crashed worker can be taken over
+IDEMPOTENCY_LOCK_SECONDS = 60
+HOT_CACHE_SIZE = 1000
+MAX_KEY_LENGTH = 255
+MAX_STORED_BODY = 1024 * 1024
+COLLECTION = "chiavi_idempotenza"
+
+KEY_HEADER = b"idempotency-key"
+REPLAYED_HEADER = (b"idempotent-replayed", b"true")
+# Never stored: sessions must not be handed out again, profiles belong to one run
+UNSTORED_HEADERS = {"set-cookie", "x-profile-id"}
+
+IN_PROGRESS, COMPLETED = "in_corso", "completata"
+
+
+class KeyConflict(Exception):
+    """The key cannot be used for this request now (in progress elsewhere, or reused)"""
+
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+async def ensure_idempotency_indexes(db):
+    await db[COLLECTION].create_index("data_creazione", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 3600)
+
+
+def fingerprint(scope: dict, body: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b""), body):
+        digest.update(len(part).to_bytes(8, "big") + part)
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Stored responses by (session, key), in MongoDB and in a small in-memory LRU"""
+
+    def __init__(self, db):
+        self.collection = db[COLLECTION]
+        self._hot: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.replayed = 0
+        self.conflicts = 0
+
+    def _remember(self, record_id: str, record: dict):
+        self._hot[record_id] = (time.monotonic() + IDEMPOTENCY_TTL_HOURS * 3600, record)
+        self._hot.move_to_end(record_id)
+        while len(self._hot) > HOT_CACHE_SIZE:
+            self._hot.popitem(last=False)
+
+    def _cached(self, record_id: str) -> Optional[dict]:
+        entry = self._hot.get(record_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._hot[record_id]
+            return None
+        return entry[1]
+
+    def _replay(self, record: dict, request_fingerprint: str) -> dict:
+        if record["impronta"] != request_fingerprint:
+            self.conflicts += 1
+            raise KeyConflict(422, "Idempotency-Key già usata per una richiesta diversa")
+        self.replayed += 1
+        return record
+
+    async def begin(self, record_id: str, request_fingerprint: str) -> Optional[dict]:
+        """
+        The stored response to replay, or None when the caller now owns the
+        key and must run the request, then call `complete` or `release`.
+        """
+        while True:
+            record = self._cached(record_id)
+            if record is not None:
+                return self._replay(record, request_fingerprint)
+
+            pending = self._inflight.get(record_id)
+            if pending is not None:
+                record = await asyncio.shield(pending)
+                if record is not None:
+                    return self._replay(record, request_fingerprint)
+                continue  # The first attempt failed: this one may run
+
+            # Registered before the first await, so concurrent retries in this worker wait on it
+            self._inflight[record_id] = asyncio.get_running_loop().create_future()
+            try:
+                if await self._claim(record_id, request_fingerprint):
+                    return None
+                stored = await self.collection.find_one({"_id": record_id})
+            except BaseException:
+                self._settle(record_id, None)
+                raise
+            if stored is None:
+                # Expired or released between the insert and the read
+                self._settle(record_id, None)
+                continue
+            if stored["stato"] == COMPLETED:
+                record = self._record(stored)
+                self._remember(record_id, record)
+                self._settle(record_id, record)
+                return self._replay(record, request_fingerprint)
+            self._settle(record_id, None)
+            self.conflicts += 1
+            raise KeyConflict(409, "Una richiesta con questa Idempotency-Key è ancora in corso")
+
+    async def _claim(self, record_id: str, request_fingerprint: str) -> bool:
+        now = datetime.now(timezone.utc)
+        document = {"_id": record_id, "stato": IN_PROGRESS, "impronta": request_fingerprint, "data_creazione": now}
+        try:
+            await self.collection.insert_one(document)
+            return True
+        except DuplicateKeyError:
+            pass
+        # Take over a key abandoned by a worker that stopped while running it
+        stale = await self.collection.delete_one({
+            "_id": record_id, "stato": IN_PROGRESS,
+            "data_creazione": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)},
+        })
+        if stale.deleted_count:
+            try:
+                await self.collection.insert_one(document)
+                return True
+            except DuplicateKeyError:
+                pass
+        return False
+
+    @staticmethod
+    def _record(stored: dict) -> dict:
+        return {
+            "impronta": stored["impronta"],
+            "stato_http": stored["stato_http"],
+            "intestazioni": stored["intestazioni"],
+            "corpo": bytes(stored["corpo"]),
+        }
+
+    def _settle(self, record_id: str, record: Optional[dict]):
+        pending = self._inflight.pop(record_id, None)
+        if pending is not None and not pending.done():
+            pending.set_result(record)
+
+    async def complete(self, record_id: str, record: dict):
+        try:
+            await self.collection.update_one(
+                {"_id": record_id},
+                {"$set": {"stato": COMPLETED, **{k: v for k, v in record.items() if k != "impronta"}}}
+            )
+        finally:
+            self._remember(record_id, record)
+            self._settle(record_id, record)
+
+    async def release(self, record_id: str):
+        try:
+            await self.collection.delete_one({"_id": record_id, "stato": IN_PROGRESS})
+        finally:
+            self._settle(record_id, None)
+
+    def metrics(self) -> dict:
+        return {"riproduzioni": self.replayed, "conflitti": self.conflicts, "voci": len(self._hot)}
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware applying the store to every POST with an Idempotency-Key.
+    `owner` returns what identifies the caller (the session token): keys of
+    different sessions never collide. Requests without the header only pay
+    for a header lookup.
+    """
+
+    def __init__(self, app, store: IdempotencyStore, owner: Callable[[dict], Awaitable[Optional[str]]]):
+        self.app = app
+        self.store = store
+        self.owner = owner
+
+    async def __call__(self, scope, receive, send):
+        key = None
+        if scope["type"] == "http" and scope["method"] == "POST":
+            key = next((value for name, value in scope["headers"] if name == KEY_HEADER), None)
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > MAX_KEY_LENGTH:
+            await _send_error(send, 400, f"Idempotency-Key troppo lunga (massimo {MAX_KEY_LENGTH} caratteri)")
+            return
+
+        body = await _read_body(receive)
+        request_fingerprint = fingerprint(scope, body)
+        owner = await self.owner(scope) or ""
+        record_id = hashlib.sha256(owner.encode() + b"|" + key).hexdigest()
+        try:
+            record = await self.store.begin(record_id, request_fingerprint)
+        except KeyConflict as e:
+            await _send_error(send, e.status, e.detail)
+            return
+        if record is not None:
+            await _send_record(send, record)
+            return
+
+        response = {"status": 500, "headers": [], "body": []}
+
+        async def receive_body():
+            nonlocal body
+            if body is None:
+                return await receive()
+            message = {"type": "http.request", "body": body, "more_body": False}
+            body = None
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_wrapper)
+        except BaseException:
+            await self.store.release(record_id)
+            raise
+
+        content = b"".join(response["body"])
+        if response["status"] >= 500 or len(content) > MAX_STORED_BODY:
+            await self.store.release(record_id)
+            return
+        await self.store.complete(record_id, {
+            "impronta": request_fingerprint,
+            "stato_http": response["status"],
+            "intestazioni": [
+                [name.decode("latin-1"), value.decode("latin-1")]
+                for name, value in response["headers"] if name.decode("latin-1").lower() not in UNSTORED_HEADERS
+            ],
+            "corpo": content,
+        })
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def _send_record(send, record: dict):
+    headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in record["intestazioni"]]
+    await send({"type": "http.response.start", "status": record["stato_http"], "headers": headers + [REPLAYED_HEADER]})
+    await send({"type": "http.response.body", "body": record["corpo"]})
+
+
+async def _send_error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,200 @@
+"""
+Bus di invalidazione delle cache in-process tra worker e pod.
+
+Every worker watches MongoDB for writes to the collections its caches
+subscribed to and calls the subscribers with (collezione, doc_id), doc_id
+being the application `id` of the document, or None when the whole
+collection must be considered stale.
+
+- Replica set / Atlas: a change stream on the database, filtered on the
+  subscribed collections, delivers every write (from any process, including
+  shell scripts and the CLI jobs) as soon as it is committed. On error the
+  stream resumes from the last token; if it cannot, every cache is flushed.
+- Standalone mongod (no change streams): writers publish their invalidations
+  with `notify()` into the capped collection `invalidazioni`, which every
+  worker polls every INVALIDATION_POLL_MS milliseconds.
+
+`notify()` also dispatches locally right away, so the writing worker never
+serves its own stale data, whatever the mode.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_POLL_MS = int(os.environ.get("INVALIDATION_POLL_MS", "50"))
+CAPPED_COLLECTION = "invalidazioni"
+CAPPED_SIZE_BYTES = 4 * 1024 * 1024
+# Events written by other processes may carry a slightly older timestamp (clock skew)
+POLL_LOOKBACK_SECONDS = 2.0
+WATCHED_OPERATIONS = ["insert", "update", "replace", "delete"]
+
+Subscriber = Callable[[str, Optional[str]], None]
+
+
+class InvalidationBus:
+    def __init__(self, db, poll_interval: float = INVALIDATION_POLL_MS / 1000):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.origin = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.mode: Optional[str] = None
+        self._subscribers: Dict[str, List[Subscriber]] = defaultdict(list)
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"ricevute": 0, "pubblicate": 0, "svuotamenti": 0}
+
+    # ===================== SUBSCRIBERS =====================
+
+    def subscribe(self, collection: str, callback: Subscriber):
+        """Call `callback(collection, doc_id)` on every write to `collection`"""
+        self._subscribers[collection].append(callback)
+        if self._task is not None and self.mode == "change_stream":
+            # The stream filters on the subscribed collections: reopen it with the new one
+            self._restart()
+
+    def dispatch(self, collection: str, doc_id: Optional[str] = None):
+        for callback in self._subscribers.get(collection, ()):
+            try:
+                callback(collection, doc_id)
+            except Exception:
+                logger.exception(f"Invalidazione {collection}/{doc_id} fallita")
+
+    def flush_all(self):
+        """Position in the event stream lost: every subscribed cache is stale"""
+        self._stats["svuotamenti"] += 1
+        for collection in list(self._subscribers):
+            self.dispatch(collection)
+
+    # ===================== PUBLISHING =====================
+
+    async def notify(self, collection: str, doc_id: Optional[str] = None):
+        """
+        Report a write: invalidates this worker now and, without change
+        streams, the others through the capped collection
+        """
+        self.dispatch(collection, doc_id)
+        if self.mode == "polling":
+            await self.db[CAPPED_COLLECTION].insert_one({
+                "ts": time.time(),
+                "collezione": collection,
+                "doc_id": doc_id,
+                "origine": self.origin,
+            })
+            self._stats["pubblicate"] += 1
+
+    # ===================== LIFECYCLE =====================
+
+    async def start(self):
+        if self._task is not None:
+            return
+        if await self._change_streams_supported():
+            self.mode = "change_stream"
+        else:
+            self.mode = "polling"
+            await self._ensure_capped_collection()
+        logger.info(f"Bus invalidazioni avviato ({self.mode})")
+        self._restart()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _restart(self):
+        if self._task is not None:
+            self._task.cancel()
+        runner = self._watch if self.mode == "change_stream" else self._poll
+        self._task = asyncio.create_task(runner())
+
+    def metrics(self) -> dict:
+        return {
+            "modalita": self.mode,
+            "collezioni": sorted(self._subscribers),
+            **self._stats,
+        }
+
+    async def _change_streams_supported(self) -> bool:
+        try:
+            async with self.db.watch([{"$match": {"operationType": "invalidate"}}], max_await_time_ms=1) as stream:
+                await stream.try_next()
+            return True
+        except Exception as e:
+            logger.info(f"Change stream non disponibili ({e.__class__.__name__}): uso {CAPPED_COLLECTION}")
+            return False
+
+    async def _ensure_capped_collection(self):
+        if CAPPED_COLLECTION not in await self.db.list_collection_names():
+            try:
+                await self.db.create_collection(CAPPED_COLLECTION, capped=True, size=CAPPED_SIZE_BYTES)
+            except Exception:
+                # Created meanwhile by another worker
+                pass
+        await self.db[CAPPED_COLLECTION].create_index("ts")
+
+    # ===================== CHANGE STREAM =====================
+
+    async def _watch(self):
+        resume_token = None
+        while True:
+            pipeline = [
+                {"$match": {
+                    "operationType": {"$in": WATCHED_OPERATIONS},
+                    "ns.coll": {"$in": sorted(self._subscribers)}
+                }},
+                {"$project": {"ns": 1, "fullDocument.id": 1}}
+            ]
+            try:
+                async with self.db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self._stats["ricevute"] += 1
+                        # Deleted documents are only known by _id: the whole collection is stale
+                        self.dispatch(change["ns"]["coll"], (change.get("fullDocument") or {}).get("id"))
+            except OperationFailure as e:
+                # Resume token no longer in the oplog (or stream invalidated): start over
+                logger.warning(f"Change stream non riprendibile ({e}), svuotamento cache")
+                self.flush_all()
+                resume_token = None
+                await asyncio.sleep(1)
+            except PyMongoError as e:
+                logger.warning(f"Change stream interrotto ({e}), riconnessione")
+                if resume_token is None:
+                    self.flush_all()
+                await asyncio.sleep(1)
+
+    # ===================== POLLING =====================
+
+    async def _poll(self):
+        collection = self.db[CAPPED_COLLECTION]
+        last_ts = time.time()
+        seen: Dict[object, float] = {}
+        while True:
+            try:
+                since = last_ts - POLL_LOOKBACK_SECONDS
+                async for event in collection.find({"ts": {"$gt": since}}).sort("ts", 1):
+                    if event["_id"] in seen:
+                        continue
+                    seen[event["_id"]] = event["ts"]
+                    last_ts = max(last_ts, event["ts"])
+                    if event.get("origine") == self.origin:
+                        continue
+                    self._stats["ricevute"] += 1
+                    self.dispatch(event["collezione"], event.get("doc_id"))
+                for event_id in [k for k, ts in seen.items() if ts <= since]:
+                    del seen[event_id]
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lettura {CAPPED_COLLECTION} fallita ({e})")
+                self.flush_all()
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,282 @@
+"""
+Saldo per utente (collection `saldi`) mantenuto a ogni scrittura sui pagamenti.
+
+Each payment contributes to its user's balance according to its state:
+in_attesa and scaduto count as outstanding (da_pagare), scaduto also as
+overdue (scaduto) and pagato as paid in the year of data_pagamento. A payment
+write is turned into the difference between the old and the new contribution
+and applied with $inc, so each balance update is a single atomic operation on
+one document; prossima_scadenza (earliest pending due date) is kept with $min
+and recomputed only when a pending payment leaves that state.
+
+Payments hidden from the user (visibile_utente = False) are not counted.
+
+Esempi:
+    python ledger.py --check      # confronta i saldi con i pagamenti
+    python ledger.py --rebuild    # ricalcola tutti i saldi
+"""
+import argparse
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
+from archive import archive_of
+
+# Load env
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+PENDING = "in_attesa"
+OVERDUE = "scaduto"
+PAID = "pagato"
+OPEN_STATES = (PENDING, OVERDUE)
+
+# Balances equal within half a cent are consistent (float $inc)
+TOLERANCE = 0.005
+
+
+def _counted(payment: Optional[dict]) -> bool:
+    return bool(payment) and payment.get("visibile_utente", True) is not False
+
+
+def contribution(payment: Optional[dict]) -> dict:
+    """Ledger fields a payment adds to its user's balance"""
+    if not _counted(payment):
+        return {}
+    importo = float(payment.get("importo") or 0)
+    stato = payment.get("stato")
+    if stato in OPEN_STATES:
+        fields = {"da_pagare": importo, "pagamenti_aperti": 1}
+        if stato == OVERDUE:
+            fields["scaduto"] = importo
+        return fields
+    if stato == PAID:
+        paid_at = payment.get("data_pagamento") or payment.get("data_scadenza")
+        if paid_at:
+            return {f"pagato_per_anno.{paid_at.year}": importo}
+    return {}
+
+
+def _pending_due(payment: Optional[dict]) -> Optional[datetime]:
+    if _counted(payment) and payment.get("stato") == PENDING:
+        return payment.get("data_scadenza")
+    return None
+
+
+def ledger_changes(old: Optional[dict], new: Optional[dict]) -> List[Tuple[str, dict, Optional[datetime], bool]]:
+    """
+    (utente_id, $inc delta, pending due date added, pending due date removed)
+    for each user touched by a payment going from `old` to `new` (None = absent)
+    """
+    per_user = {}
+    for payment, sign in ((old, -1), (new, 1)):
+        if not payment:
+            continue
+        entry = per_user.setdefault(payment["utente_id"], [defaultdict(float), None, False])
+        for field, value in contribution(payment).items():
+            entry[0][field] += sign * value
+        due = _pending_due(payment)
+        if due is not None:
+            if sign > 0:
+                entry[1] = due
+            else:
+                entry[2] = True
+
+    changes = []
+    for user_id, (delta, added, removed) in per_user.items():
+        delta = {k: v for k, v in delta.items() if abs(v) > 1e-9}
+        # A pending payment that stays pending with the same due date changes nothing
+        if added is not None and removed and _pending_due(old) == added and old["utente_id"] == user_id:
+            added, removed = None, False
+        if delta or added is not None or removed:
+            changes.append((user_id, delta, added, removed))
+    return changes
+
+
+async def recompute_next_due(db, user_ids: Iterable[str]):
+    """Reset prossima_scadenza from the pending payments of the given users (one aggregation)"""
+    user_ids = list(set(user_ids))
+    if not user_ids:
+        return
+    rows = await db.pagamenti.aggregate([
+        {"$match": {"utente_id": {"$in": user_ids}, "stato": PENDING, "visibile_utente": {"$ne": False}}},
+        {"$group": {"_id": "$utente_id", "prossima_scadenza": {"$min": "$data_scadenza"}}}
+    ]).to_list(None)
+    next_due = {row["_id"]: row["prossima_scadenza"] for row in rows}
+    ops = [
+        UpdateOne({"utente_id": user_id}, {"$set": {"prossima_scadenza": next_due[user_id]}})
+        if user_id in next_due else
+        # Unset instead of null: $min never replaces a null
+        UpdateOne({"utente_id": user_id}, {"$unset": {"prossima_scadenza": ""}})
+        for user_id in user_ids
+    ]
+    await db.saldi.bulk_write(ops, ordered=False)
+
+
+async def apply_payment_changes(db, changes: Iterable[Tuple[Optional[dict], Optional[dict]]]):
+    """
+    Update the balances for a set of payment writes, given as (before, after)
+    pairs: (None, p) for an insert, (p, None) for a delete.
+    """
+    now = datetime.now(timezone.utc)
+    deltas = defaultdict(lambda: defaultdict(float))
+    next_due = {}
+    to_recompute = set()
+    for old, new in changes:
+        for user_id, delta, added, removed in ledger_changes(old, new):
+            for field, value in delta.items():
+                deltas[user_id][field] += value
+            if added is not None:
+                next_due[user_id] = min(added, next_due.get(user_id, added))
+            if removed:
+                to_recompute.add(user_id)
+
+    ops = []
+    for user_id in set(deltas) | set(next_due):
+        update = {"$set": {"data_modifica": now}}
+        delta = {
+            k: int(v) if k == "pagamenti_aperti" else round(v, 2)
+            for k, v in deltas[user_id].items() if abs(v) > 1e-9
+        }
+        if delta:
+            update["$inc"] = delta
+        if user_id in next_due:
+            update["$min"] = {"prossima_scadenza": next_due[user_id]}
+        ops.append(UpdateOne({"utente_id": user_id}, update, upsert=True))
+    if ops:
+        await db.saldi.bulk_write(ops, ordered=False)
+    await recompute_next_due(db, to_recompute)
+
+
+def balance_view(ledger: Optional[dict], user_id: str, year: Optional[int] = None) -> dict:
+    """API shape of a ledger document (an absent ledger is an empty balance)"""
+    ledger = ledger or {}
+    year = year or datetime.now(timezone.utc).year
+    return {
+        "utente_id": user_id,
+        "da_pagare": round(ledger.get("da_pagare", 0.0), 2),
+        "scaduto": round(ledger.get("scaduto", 0.0), 2),
+        "pagato_anno": round((ledger.get("pagato_per_anno") or {}).get(str(year), 0.0), 2),
+        "pagamenti_aperti": ledger.get("pagamenti_aperti", 0),
+        "prossima_scadenza": ledger.get("prossima_scadenza"),
+        "data_modifica": ledger.get("data_modifica"),
+    }
+
+
+# ===================== REBUILD =====================
+
+async def expected_ledgers(db, user_ids: Optional[List[str]] = None) -> dict:
+    """Ledgers recomputed from scratch from pagamenti (and their archive), keyed by utente_id"""
+    match = {"visibile_utente": {"$ne": False}}
+    if user_ids is not None:
+        match["utente_id"] = {"$in": user_ids}
+    ledgers = {}
+    projection = {"_id": 0, "utente_id": 1, "importo": 1, "stato": 1,
+                  "data_pagamento": 1, "data_scadenza": 1, "visibile_utente": 1}
+    # Archived payments of closed years still count in pagato_per_anno
+    for collection in ("pagamenti", archive_of("pagamenti")):
+        async for payment in db[collection].find(match, projection):
+            ledger = ledgers.setdefault(payment["utente_id"], {
+                "utente_id": payment["utente_id"], "da_pagare": 0.0, "scaduto": 0.0,
+                "pagamenti_aperti": 0, "pagato_per_anno": {}
+            })
+            for field, value in contribution(payment).items():
+                if field.startswith("pagato_per_anno."):
+                    year = field.split(".", 1)[1]
+                    ledger["pagato_per_anno"][year] = round(ledger["pagato_per_anno"].get(year, 0.0) + value, 2)
+                else:
+                    ledger[field] = round(ledger[field] + value, 2)
+            due = _pending_due(payment)
+            if due is not None and (ledger.get("prossima_scadenza") is None or due < ledger["prossima_scadenza"]):
+                ledger["prossima_scadenza"] = due
+    return ledgers
+
+
+def _differences(stored: dict, expected: dict) -> List[str]:
+    diffs = []
+    for field in ("da_pagare", "scaduto"):
+        if abs(stored.get(field, 0.0) - expected.get(field, 0.0)) > TOLERANCE:
+            diffs.append(f"{field}: {stored.get(field, 0.0)} != {expected.get(field, 0.0)}")
+    if stored.get("pagamenti_aperti", 0) != expected.get("pagamenti_aperti", 0):
+        diffs.append(f"pagamenti_aperti: {stored.get('pagamenti_aperti', 0)} != {expected.get('pagamenti_aperti', 0)}")
+    stored_years = stored.get("pagato_per_anno") or {}
+    expected_years = expected.get("pagato_per_anno") or {}
+    for year in set(stored_years) | set(expected_years):
+        if abs(stored_years.get(year, 0.0) - expected_years.get(year, 0.0)) > TOLERANCE:
+            diffs.append(f"pagato_per_anno.{year}: {stored_years.get(year, 0.0)} != {expected_years.get(year, 0.0)}")
+    stored_due = stored.get("prossima_scadenza")
+    expected_due = expected.get("prossima_scadenza")
+    if stored_due is not None and expected_due is not None:
+        if stored_due.replace(tzinfo=None) != expected_due.replace(tzinfo=None):
+            diffs.append(f"prossima_scadenza: {stored_due} != {expected_due}")
+    elif stored_due is not None or expected_due is not None:
+        diffs.append(f"prossima_scadenza: {stored_due} != {expected_due}")
+    return diffs
+
+
+async def check_ledgers(db) -> dict:
+    """utente_id -> list of differences between stored and recomputed ledgers"""
+    expected = await expected_ledgers(db)
+    stored = {doc["utente_id"]: doc async for doc in db.saldi.find({}, {"_id": 0})}
+    report = {}
+    for user_id in set(expected) | set(stored):
+        diffs = _differences(stored.get(user_id, {}), expected.get(user_id, {}))
+        if diffs:
+            report[user_id] = diffs
+    return report
+
+
+async def rebuild_ledgers(db, user_ids: Optional[List[str]] = None) -> int:
+    """Replace the ledgers (all, or of the given users) with values recomputed from pagamenti"""
+    now = datetime.now(timezone.utc)
+    expected = await expected_ledgers(db, user_ids)
+    ops = [
+        ReplaceOne({"utente_id": user_id}, {**ledger, "data_modifica": now}, upsert=True)
+        for user_id, ledger in expected.items()
+    ]
+    stale = {"utente_id": {"$nin": list(expected)}}
+    if user_ids is not None:
+        stale = {"utente_id": {"$in": [u for u in user_ids if u not in expected]}}
+    await db.saldi.delete_many(stale)
+    for start in range(0, len(ops), 1000):
+        await db.saldi.bulk_write(ops[start:start + 1000], ordered=False)
+    return len(ops)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Verifica o ricostruisce i saldi utente")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--check", action="store_true", help="Confronta i saldi con i pagamenti senza scrivere")
+    group.add_argument("--rebuild", action="store_true", help="Ricalcola tutti i saldi dai pagamenti")
+    return parser.parse_args(argv)
+
+
+async def main(args) -> int:
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'test_database')]
+    status = 0
+
+    if args.rebuild:
+        count = await rebuild_ledgers(db)
+        print(f"✅ {count} saldi ricalcolati")
+    else:
+        report = await check_ledgers(db)
+        for user_id, diffs in sorted(report.items()):
+            print(f"❌ {user_id}: {'; '.join(diffs)}")
+        if report:
+            print(f"{len(report)} saldi non allineati: eseguire python ledger.py --rebuild")
+            status = 1
+        else:
+            print("✅ Tutti i saldi sono allineati")
+
+    client.close()
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main(parse_args())))
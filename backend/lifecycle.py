@@ -0,0 +1,99 @@
+"""
+Avvio e arresto del processo: pool di connessioni, riscaldamento, readiness.
+
+After a deploy the first requests of each worker used to pay for what the
+process had not done yet: index creation, MongoDB server selection and
+connection setup, the first fill of the reference cache, loading the bcrypt
+backend (and, with WARM_HASH_POOL, starting the import hashing processes).
+The app lifespan now does all of it before the worker is declared ready,
+timing each step, and `/api/health/ready` answers 200 only from then on (and
+only while MongoDB answers a ping), so a load balancer sends traffic to warm
+workers only.
+
+On shutdown the worker stops being ready first, then waits up to
+SHUTDOWN_DRAIN_SECONDS for the shared reads still running in the background
+(whose callers went away) before closing the connections. The import hashing
+pool is shut down as well: chunks already hashing finish, queued ones are
+cancelled, so an import caught by the shutdown fails and has to be repeated.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Motor pool and timeouts (milliseconds); 0 leaves the driver default
+MONGO_POOL_SETTINGS = {
+    "maxPoolSize": ("MONGO_MAX_POOL_SIZE", 100),
+    "minPoolSize": ("MONGO_MIN_POOL_SIZE", 10),
+    "maxIdleTimeMS": ("MONGO_MAX_IDLE_TIME_MS", 300000),
+    "connectTimeoutMS": ("MONGO_CONNECT_TIMEOUT_MS", 5000),
+    "serverSelectionTimeoutMS": ("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+    "waitQueueTimeoutMS": ("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000),
+    "socketTimeoutMS": ("MONGO_SOCKET_TIMEOUT_MS", 0),
+}
+READY_PING_TIMEOUT = float(os.environ.get("READY_PING_TIMEOUT", "2"))
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "10"))
+# Off by default: the hashing processes cost memory on every worker, and imports are rare
+WARM_HASH_POOL = os.environ.get("WARM_HASH_POOL", "false").lower() == "true"
+
+
+def mongo_client_options() -> dict:
+    """AsyncIOMotorClient keyword arguments from the MONGO_* variables"""
+    options = {}
+    for option, (variable, default) in MONGO_POOL_SETTINGS.items():
+        value = int(os.environ.get(variable, default))
+        if value:
+            options[option] = value
+    return options
+
+
+async def open_connections(db, count: int):
+    """Concurrent pings, so the pool opens `count` connections before the first request"""
+    await asyncio.gather(*(db.command("ping") for _ in range(max(1, count))))
+
+
+async def ping(db) -> Optional[float]:
+    """MongoDB round trip in milliseconds, None when it does not answer in time"""
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), READY_PING_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Ping MongoDB fallito: {e.__class__.__name__}: {e}")
+        return None
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+class Lifecycle:
+    """Readiness of this worker and the duration of its startup steps"""
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.steps: Dict[str, float] = {}
+        self.started_at: Optional[float] = None
+
+    async def step(self, name: str, work: Awaitable):
+        started = time.perf_counter()
+        await work
+        self.steps[name] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(f"Avvio: {name} in {self.steps[name]} ms")
+
+    def mark_ready(self):
+        self.ready = True
+        self.started_at = time.monotonic()
+        logger.info(f"Worker pronto dopo {round(sum(self.steps.values()))} ms di riscaldamento")
+
+    def mark_draining(self):
+        self.ready = False
+        self.draining = True
+
+    def status(self) -> dict:
+        return {
+            "pronto": self.ready,
+            "in_chiusura": self.draining,
+            "avvio_ms": dict(self.steps),
+            "attivo_da_s": round(time.monotonic() - self.started_at) if self.started_at else None,
+        }
@@ -0,0 +1,233 @@
+"""
+Migrazioni dati batch e riprendibili per l'Accademia de 'I Musici'.
+
+Each migration walks a source collection in `_id` order, one batch at a time,
+and records its position in the `migrazioni` collection after every batch.
+An interrupted run picks up from the last completed batch; a completed
+migration is skipped unless `--force` is given.
+
+Esempi:
+    python migrations.py                        # tutte le migrazioni pendenti
+    python migrations.py embed_dettaglio_allievi --batch-size 500
+    python migrations.py --list
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from sync import SYNCED_COLLECTIONS
+
+# Load env
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+async def run_batched(
+    db,
+    name: str,
+    source: str,
+    apply_batch,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    force: bool = False,
+    query: dict = None
+):
+    """
+    Feed the documents of `source` matching `query` to `apply_batch(db, docs)`
+    in batches, checkpointing the last processed `_id` in `migrazioni` so the
+    run can be resumed.
+    """
+    state = await db.migrazioni.find_one({"_id": name}) or {}
+    if state.get("completata") and not force:
+        print(f"⏭  {name}: già completata")
+        return
+    if force:
+        state = {}
+
+    last_id = state.get("ultimo_id")
+    processed = state.get("processati", 0)
+    query = query or {}
+    total = await db[source].count_documents(query) if query else await db[source].estimated_document_count()
+    started = time.perf_counter()
+    print(f"▶  {name}: {source} ({total} documenti){' - ripresa da ' + str(last_id) if last_id else ''}")
+
+    while True:
+        page = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+        batch = await db[source].find(page).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        await apply_batch(db, batch)
+
+        last_id = batch[-1]["_id"]
+        processed += len(batch)
+        await db.migrazioni.update_one(
+            {"_id": name},
+            {"$set": {"ultimo_id": last_id, "processati": processed, "aggiornata": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        rate = processed / max(time.perf_counter() - started, 1e-6)
+        print(f"   {name}: {processed}/{total} ({processed * 100 // max(total, 1)}%) - {rate:.0f} doc/s")
+
+    await db.migrazioni.update_one(
+        {"_id": name},
+        {"$set": {"completata": True, "processati": processed, "aggiornata": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    print(f"✅ {name}: {processed} documenti in {time.perf_counter() - started:.1f}s")
+
+
+# ===================== MIGRATIONS =====================
+
+def _embed_detail_ops(batch: list) -> list:
+    """
+    Copy legacy detail documents into utenti.dettaglio. Users that already have
+    an embedded detail (written through the API after the deploy) are left alone.
+    """
+    ops = []
+    for detail in batch:
+        detail = {k: v for k, v in detail.items() if k != "_id"}
+        ops.append(UpdateOne(
+            {"id": detail["utente_id"], "dettaglio": {"$exists": False}},
+            {"$set": {"dettaglio": detail}}
+        ))
+    return ops
+
+
+async def _apply_embed_detail(db, batch: list):
+    ops = _embed_detail_ops(batch)
+    if ops:
+        await db.utenti.bulk_write(ops, ordered=False)
+
+
+async def embed_dettaglio_allievi(db, batch_size: int, force: bool):
+    """allievi_dettaglio -> utenti.dettaglio"""
+    await run_batched(db, "embed_dettaglio_allievi", "allievi_dettaglio", _apply_embed_detail, batch_size, force)
+
+
+async def embed_dettaglio_insegnanti(db, batch_size: int, force: bool):
+    """insegnanti_dettaglio -> utenti.dettaglio"""
+    await run_batched(db, "embed_dettaglio_insegnanti", "insegnanti_dettaglio", _apply_embed_detail, batch_size, force)
+
+
+async def backfill_iscrizioni(db, batch_size: int, force: bool):
+    """utenti.insegnante_id / corso_principale -> iscrizioni"""
+    courses = await db.corsi.find({"attivo": True}, {"_id": 0, "id": 1, "insegnante_id": 1, "strumento": 1}).to_list(None)
+    by_teacher_instrument = {(c["insegnante_id"], c["strumento"]): c for c in courses}
+    by_instrument = {}
+    for course in courses:
+        by_instrument.setdefault(course["strumento"], []).append(course)
+    skipped = []
+
+    async def apply_batch(db, batch):
+        now = datetime.now(timezone.utc)
+        ops = []
+        for student in batch:
+            strumento = (student.get("dettaglio") or {}).get("corso_principale")
+            teacher_id = student.get("insegnante_id")
+            course = by_teacher_instrument.get((teacher_id, strumento))
+            if not teacher_id and len(by_instrument.get(strumento, [])) == 1:
+                # Legacy link by instrument: only unambiguous when a single course teaches it
+                course = by_instrument[strumento][0]
+                teacher_id = course["insegnante_id"]
+            if not teacher_id:
+                skipped.append(student["id"])
+                continue
+            corso_id = course["id"] if course else None
+            ops.append(UpdateOne(
+                {"allievo_id": student["id"], "insegnante_id": teacher_id, "corso_id": corso_id, "data_fine": None},
+                {"$setOnInsert": {
+                    "id": str(uuid.uuid4()),
+                    "data_inizio": student.get("data_creazione") or now,
+                    "data_creazione": now
+                }},
+                upsert=True
+            ))
+        if ops:
+            await db.iscrizioni.bulk_write(ops, ordered=False)
+
+    await run_batched(db, "backfill_iscrizioni", "utenti", apply_batch, batch_size, force,
+                      query={"ruolo": "allievo"})
+    if skipped:
+        print(f"⚠️  {len(skipped)} allievi senza insegnante né corso univoco: iscriverli a mano da /api/iscrizioni")
+
+
+def _aware(value: datetime) -> datetime:
+    """MongoDB returns naive UTC datetimes"""
+    return value.replace(tzinfo=timezone.utc) if value and value.tzinfo is None else value
+
+
+async def backfill_data_modifica(db, batch_size: int, force: bool):
+    """data_creazione -> data_modifica (lezioni, compiti, pagamenti, presenze, notifiche)"""
+    async def apply_batch(db, batch, collection):
+        now = datetime.now(timezone.utc)
+        await db[collection].bulk_write([
+            UpdateOne(
+                {"_id": doc["_id"], "data_modifica": {"$exists": False}},
+                {"$set": {"data_modifica": min(_aware(doc.get("data_creazione")) or now, now)}}
+            )
+            for doc in batch
+        ], ordered=False)
+
+    for collection in SYNCED_COLLECTIONS:
+        await run_batched(
+            db, f"backfill_data_modifica_{collection}", collection,
+            lambda db, batch, collection=collection: apply_batch(db, batch, collection),
+            batch_size, force, query={"data_modifica": {"$exists": False}}
+        )
+    # One checkpoint per collection above; this one is for --list
+    await db.migrazioni.update_one(
+        {"_id": "backfill_data_modifica"},
+        {"$set": {"completata": True, "aggiornata": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+
+# Run in this order
+MIGRATIONS = {
+    "embed_dettaglio_allievi": embed_dettaglio_allievi,
+    "embed_dettaglio_insegnanti": embed_dettaglio_insegnanti,
+    "backfill_iscrizioni": backfill_iscrizioni,
+    "backfill_data_modifica": backfill_data_modifica,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Esegue le migrazioni dati")
+    parser.add_argument("names", nargs="*", metavar="MIGRAZIONE",
+                        help=f"Migrazioni da eseguire (default: tutte): {', '.join(MIGRATIONS)}")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--force", action="store_true", help="Riesegue anche le migrazioni completate")
+    parser.add_argument("--list", action="store_true", help="Mostra lo stato delle migrazioni")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in MIGRATIONS]
+    if unknown:
+        parser.error(f"migrazioni sconosciute: {', '.join(unknown)}")
+    return args
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'test_database')]
+
+    if args.list:
+        for name, func in MIGRATIONS.items():
+            state = await db.migrazioni.find_one({"_id": name}) or {}
+            status = "completata" if state.get("completata") else f"{state.get('processati', 0)} processati"
+            print(f"{name:<32} {status:<20} {func.__doc__}")
+    else:
+        for name in args.names or list(MIGRATIONS):
+            await MIGRATIONS[name](db, args.batch_size, args.force)
+
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
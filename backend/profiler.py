@@ -0,0 +1,272 @@
+"""
+Profiler on-demand delle richieste HTTP con output in formato flame graph.
+
+A sampling thread takes a snapshot of the asyncio task that serves the request
+every few milliseconds. While the task runs on the event loop the real thread
+stack is recorded; while it is suspended the chain of awaited coroutines is
+walked instead, so time spent waiting on MongoDB or HTTP calls shows up in the
+profile as well.
+
+The result is stored as collapsed stacks ("frame;frame;frame count"), the
+format read by flamegraph.pl, speedscope and most flame graph viewers.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+from urllib.parse import parse_qsl
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY_PARAM = ("__profile", "1")
+PROFILE_ID_HEADER = b"x-profile-id"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    filename = os.sep.join(code.co_filename.split(os.sep)[-2:])
+    return f"{name} ({filename}:{code.co_firstlineno})"
+
+
+def _await_target_label(awaitable) -> str:
+    if isinstance(awaitable, asyncio.Task):
+        return f"[await Task {awaitable.get_name()}]"
+    name = type(awaitable).__name__
+    if name == "FutureIter":
+        # Awaiting a plain Future goes through its __await__ iterator
+        name = "Future"
+    return f"[await {name}]"
+
+
+# Samplers running now, by interval: the switch interval is shared by the whole process, so
+# it is lowered for the smallest of them and restored only when the last one stops
+_switch_lock = threading.Lock()
+_active_intervals: Counter = Counter()
+_original_switch_interval: Optional[float] = None
+
+
+def _acquire_switch_interval(interval: float):
+    global _original_switch_interval
+    with _switch_lock:
+        if not _active_intervals:
+            _original_switch_interval = sys.getswitchinterval()
+        _active_intervals[interval] += 1
+        sys.setswitchinterval(min(_original_switch_interval, *_active_intervals))
+
+
+def _release_switch_interval(interval: float):
+    global _original_switch_interval
+    with _switch_lock:
+        _active_intervals[interval] -= 1
+        if _active_intervals[interval] <= 0:
+            del _active_intervals[interval]
+        if _active_intervals:
+            sys.setswitchinterval(min(_original_switch_interval, *_active_intervals))
+        else:
+            sys.setswitchinterval(_original_switch_interval)
+            _original_switch_interval = None
+
+
+class TaskSampler:
+    """Samples the stack of a single asyncio task from a background thread"""
+
+    def __init__(self, task: asyncio.Task, interval: float = 0.001):
+        self.task = task
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self.duration = 0.0
+        self._loop_thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._started = 0.0
+
+    def start(self):
+        # The sampler needs the GIL at least once per interval to see CPU-bound code
+        _acquire_switch_interval(self.interval)
+        self._started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.perf_counter() - self._started
+        _release_switch_interval(self.interval)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stack = self._sample()
+            if stack:
+                self.samples[";".join(stack)] += 1
+
+    def _sample(self) -> list:
+        coro = self.task.get_coro()
+        if coro is None or self.task.done():
+            return []
+        if coro.cr_running:
+            stack = self._running_stack(coro)
+            if stack:
+                return stack
+        return self._awaiting_stack(coro)
+
+    def _running_stack(self, coro) -> list:
+        """Thread stack from the task's root coroutine down to the current frame"""
+        frame = sys._current_frames().get(self._loop_thread_id)
+        root = coro.cr_frame
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            if frame is root:
+                stack.reverse()
+                return stack
+            frame = frame.f_back
+        return []
+
+    def _awaiting_stack(self, coro) -> list:
+        """Chain of suspended coroutines, ending with what the innermost one awaits"""
+        stack = []
+        current = coro
+        while current is not None:
+            frame = getattr(current, "cr_frame", None) or getattr(current, "gi_frame", None)
+            if frame is None:
+                break
+            stack.append(_frame_label(frame))
+            awaited = getattr(current, "cr_await", None)
+            if awaited is None:
+                awaited = getattr(current, "gi_yieldfrom", None)
+            if awaited is None or not (hasattr(awaited, "cr_frame") or hasattr(awaited, "gi_frame")):
+                if awaited is not None:
+                    stack.append(_await_target_label(awaited))
+                break
+            current = awaited
+        return stack
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+def collapsed_to_speedscope(collapsed: str, name: str, interval: float) -> dict:
+    """Convert collapsed stacks to a speedscope "sampled" profile"""
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+    for line in collapsed.splitlines():
+        stack, _, count = line.rpartition(" ")
+        if not stack:
+            continue
+        indices = []
+        for label in stack.split(";"):
+            if label not in frame_index:
+                frame_index[label] = len(frames)
+                frames.append({"name": label})
+            indices.append(frame_index[label])
+        samples.append(indices)
+        weights.append(int(count) * interval * 1000)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": name,
+        "exporter": "accademia-musici-profiler",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware that profiles a request when asked to.
+
+    A request is profiled when it carries the `X-Profile: 1` header or the
+    `__profile=1` query flag and `authorize` accepts it, or when it is picked
+    by random sampling (`sample_rate`). Every other request only pays for a
+    header lookup.
+    """
+
+    def __init__(
+        self,
+        app,
+        authorize: Callable[[dict], Awaitable[bool]],
+        store: Callable[[dict], Awaitable[None]],
+        sample_rate: float = 0.0,
+        interval: float = 0.001,
+    ):
+        self.app = app
+        self.authorize = authorize
+        self.store = store
+        self.sample_rate = sample_rate
+        self.interval = interval
+
+    def _requested(self, scope) -> bool:
+        query = scope.get("query_string", b"").decode("latin-1")
+        if PROFILE_QUERY_PARAM in parse_qsl(query):
+            return True
+        for key, value in scope["headers"]:
+            if key == PROFILE_HEADER:
+                return value not in (b"0", b"false")
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self._requested(scope):
+            if not await self.authorize(scope):
+                await self.app(scope, receive, send)
+                return
+        elif not (self.sample_rate and random.random() < self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        await self._profile(scope, receive, send)
+
+    async def _profile(self, scope, receive, send):
+        profile_id = str(uuid.uuid4())
+        status = {"code": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_ID_HEADER, profile_id.encode())
+                ]
+            await send(message)
+
+        sampler = TaskSampler(asyncio.current_task(), self.interval)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            await self.store({
+                "id": profile_id,
+                "metodo": scope["method"],
+                "percorso": scope["path"],
+                "query": scope.get("query_string", b"").decode("latin-1"),
+                "stato_http": status["code"],
+                "durata_ms": round(sampler.duration * 1000, 3),
+                "intervallo_ms": self.interval * 1000,
+                "campioni": sum(sampler.samples.values()),
+                "stack": sampler.collapsed(),
+                "data_creazione": datetime.now(timezone.utc),
+            })
+
+
+def speedscope_json(profile: dict) -> str:
+    name = f"{profile['metodo']} {profile['percorso']}"
+    interval = profile.get("intervallo_ms", 1.0) / 1000
+    return json.dumps(collapsed_to_speedscope(profile.get("stack", ""), name, interval))
@@ -0,0 +1,266 @@
+"""
+Limiti di frequenza per utente e per percorso (finestra scorrevole).
+
+Login and admin PIN checks run bcrypt on every attempt, and list, export
+and report endpoints are the most expensive reads: nothing stopped a client
+from hammering them. Each rule allows `limit` requests per `window` seconds
+to one principal: the client address for the login routes, the session
+token elsewhere (the address when there is none).
+
+Counting uses a sliding window counter: per (rule, principal) only the
+counts of the current and previous fixed windows are kept, and the previous
+one is weighted by how much of it still overlaps the sliding window. That
+is three numbers per active client, and a check is a dict lookup. Rejected
+requests answer 429 with Retry-After from the middleware, before the app:
+no session lookup, no MongoDB, no bcrypt.
+
+With RATE_LIMIT_SHARED=true the counts of allowed requests are also added
+up across workers in `limiti_richieste` (one upsert per request). A
+principal found over the limit there is blocked locally until its window
+ends, so rejections stay in memory in that mode as well.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+RATE_LIMIT_SHARED = os.environ.get("RATE_LIMIT_SHARED", "false").lower() == "true"
+# Behind a reverse proxy the client address is the first X-Forwarded-For entry
+RATE_LIMIT_TRUST_PROXY = os.environ.get("RATE_LIMIT_TRUST_PROXY", "false").lower() == "true"
+COLLECTION = "limiti_richieste"
+# Entries of clients that stopped sending requests are dropped past this size
+PRUNE_THRESHOLD = 10000
+
+PER_ADDRESS, PER_SESSION = "indirizzo", "sessione"
+
+
+@dataclass(frozen=True)
+class Rule:
+    method: str
+    path: str
+    limit: int
+    window: int
+    per: str = PER_SESSION
+
+    @property
+    def name(self) -> str:
+        return f"{self.method} {self.path}"
+
+
+DEFAULT_RULES = [
+    Rule("POST", "/api/auth/login", 10, 60, PER_ADDRESS),
+    Rule("POST", "/api/auth/admin/pin", 5, 60, PER_ADDRESS),
+    Rule("POST", "/api/auth/admin/google", 10, 60, PER_ADDRESS),
+    Rule("GET", "/api/utenti", 60, 60),
+    Rule("GET", "/api/presenze", 60, 60),
+    Rule("GET", "/api/lezioni", 60, 60),
+    Rule("GET", "/api/compiti", 60, 60),
+    Rule("GET", "/api/pagamenti", 60, 60),
+    Rule("GET", "/api/notifiche", 60, 60),
+    Rule("GET", "/api/export/presenze", 10, 60),
+    Rule("GET", "/api/export/pagamenti", 10, 60),
+    Rule("GET", "/api/export/compensi", 10, 60),
+    Rule("GET", "/api/report/finanziario", 20, 60),
+    Rule("GET", "/api/analytics/allievi", 20, 60),
+    Rule("POST", "/api/utenti/import", 5, 60),
+]
+
+RULE_PATTERN = re.compile(r"^(GET|POST|PUT|DELETE|PATCH)\s+(/\S*)\s*=\s*(\d+)\s*/\s*(\d+)\s*(indirizzo|sessione)?$")
+
+
+def parse_rules(spec: Optional[str], defaults: List[Rule] = DEFAULT_RULES) -> Dict[Tuple[str, str], Rule]:
+    """
+    The default rules, overridden by RATE_LIMITS: `METHOD path=limit/seconds[ per]`
+    separated by `;`, e.g. `POST /api/auth/login=5/60;GET /api/pagamenti=120/60`.
+    A limit of 0 removes the rule.
+    """
+    rules = {(rule.method, rule.path): rule for rule in defaults}
+    for entry in (spec or "").split(";"):
+        if not entry.strip():
+            continue
+        match = RULE_PATTERN.match(entry.strip())
+        if not match:
+            raise ValueError(f"RATE_LIMITS: regola non valida '{entry.strip()}'")
+        method, path, limit, window, per = match.groups()
+        key = (method, path.rstrip("/") or "/")
+        if int(limit) == 0:
+            rules.pop(key, None)
+            continue
+        previous = rules.get(key)
+        rules[key] = Rule(method, key[1], int(limit), int(window), per or (previous.per if previous else PER_SESSION))
+    return rules
+
+
+def estimate(previous: int, current: int, elapsed: float) -> float:
+    """Requests in the sliding window: the previous fixed window weighted by its overlap"""
+    return previous * (1 - elapsed) + current
+
+
+class RateLimiter:
+    """Sliding window counters per (rule, principal), in memory and optionally in MongoDB"""
+
+    def __init__(self, db=None, rules: Optional[Dict[Tuple[str, str], Rule]] = None, shared: bool = False):
+        self.collection = db[COLLECTION] if db is not None and shared else None
+        self.rules = rules if rules is not None else parse_rules(os.environ.get("RATE_LIMITS"))
+        # key -> [window index, count in that window, count in the previous one]
+        self._counters: Dict[str, List[int]] = {}
+        # key -> monotonic time until which the principal is rejected (shared mode)
+        self._blocked: Dict[str, float] = {}
+        self.rejected: Dict[str, int] = {}
+
+    def rule_for(self, method: str, path: str) -> Optional[Rule]:
+        return self.rules.get((method, path.rstrip("/") or "/"))
+
+    def _counter(self, key: str, index: int) -> List[int]:
+        counter = self._counters.get(key)
+        if counter is None:
+            if len(self._counters) >= PRUNE_THRESHOLD:
+                self._prune()
+            counter = self._counters[key] = [index, 0, 0]
+        elif counter[0] != index:
+            # Roll over: the current window becomes the previous one if adjacent
+            counter[2] = counter[1] if counter[0] == index - 1 else 0
+            counter[1] = 0
+            counter[0] = index
+        return counter
+
+    def _prune(self):
+        now = time.time()
+        for key in list(self._counters):
+            window = int(key.split("|", 1)[0])
+            if self._counters[key][0] < int(now // window) - 1:
+                del self._counters[key]
+        for key in [key for key, until in self._blocked.items() if until <= time.monotonic()]:
+            del self._blocked[key]
+
+    def check(self, rule: Rule, principal: str) -> Optional[int]:
+        """None when the request is allowed (and counted), else the seconds to wait"""
+        key = f"{rule.window}|{rule.name}|{principal}"
+        blocked_until = self._blocked.get(key)
+        if blocked_until is not None:
+            remaining = blocked_until - time.monotonic()
+            if remaining > 0:
+                return self._reject(rule, remaining)
+            del self._blocked[key]
+
+        now = time.time()
+        index, offset = divmod(now, rule.window)
+        counter = self._counter(key, int(index))
+        if estimate(counter[2], counter[1], offset / rule.window) >= rule.limit:
+            return self._reject(rule, self._retry_after(rule, counter, offset))
+        counter[1] += 1
+        return None
+
+    @staticmethod
+    def _retry_after(rule: Rule, counter: List[int], offset: float) -> float:
+        """Seconds until the weighted previous window has decayed enough to let one request in"""
+        previous, current = counter[2], counter[1]
+        if previous and current < rule.limit:
+            # previous * (1 - (offset + t) / window) + current < limit
+            wait = rule.window * (1 - (rule.limit - current) / previous) - offset
+            return max(wait, 0.001)
+        return rule.window - offset
+
+    def _reject(self, rule: Rule, wait: float) -> int:
+        self.rejected[rule.name] = self.rejected.get(rule.name, 0) + 1
+        return max(1, math.ceil(wait))
+
+    async def check_shared(self, rule: Rule, principal: str) -> Optional[int]:
+        """Count an allowed request across workers; None or the seconds to wait"""
+        now = datetime.now(timezone.utc)
+        index, offset = divmod(now.timestamp(), rule.window)
+        prefix = hashlib.sha256(f"{rule.name}|{principal}".encode()).hexdigest()
+        expires = now + timedelta(seconds=2 * rule.window)
+        current = await self.collection.find_one_and_update(
+            {"_id": f"{prefix}|{int(index)}"},
+            {"$inc": {"conteggio": 1}, "$setOnInsert": {"scadenza": expires}},
+            upsert=True, return_document=ReturnDocument.AFTER, projection={"conteggio": 1}
+        )
+        previous = await self.collection.find_one({"_id": f"{prefix}|{int(index) - 1}"}, {"conteggio": 1})
+        counter = [int(index), current["conteggio"] - 1, previous["conteggio"] if previous else 0]
+        if estimate(counter[2], counter[1], offset / rule.window) < rule.limit:
+            return None
+        wait = self._retry_after(rule, counter, offset)
+        self._blocked[f"{rule.window}|{rule.name}|{principal}"] = time.monotonic() + wait
+        return self._reject(rule, wait)
+
+    def metrics(self) -> dict:
+        return {
+            "condiviso": self.collection is not None,
+            "chiavi_attive": len(self._counters),
+            "rifiutate": dict(self.rejected),
+        }
+
+
+async def ensure_ratelimit_indexes(db):
+    await db[COLLECTION].create_index("scadenza", expireAfterSeconds=0)
+
+
+def client_address(scope: dict) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "sconosciuto"
+
+
+def session_token(scope: dict) -> Optional[str]:
+    """The session token as the app reads it (Bearer header or cookie), without validating it"""
+    for name, value in scope["headers"]:
+        if name == b"authorization" and value.startswith(b"Bearer "):
+            return value[7:].decode("latin-1")
+        if name == b"cookie":
+            for cookie in value.decode("latin-1").split(";"):
+                key, _, token = cookie.strip().partition("=")
+                if key == "session_token" and token:
+                    return token
+    return None
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 to requests over their rule's limit"""
+
+    def __init__(self, app, limiter: RateLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    def principal(self, rule: Rule, scope: dict) -> str:
+        if rule.per == PER_SESSION:
+            token = session_token(scope)
+            if token:
+                return "s:" + hashlib.sha256(token.encode()).hexdigest()[:32]
+        return "a:" + client_address(scope)
+
+    async def __call__(self, scope, receive, send):
+        rule = self.limiter.rule_for(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        principal = self.principal(rule, scope)
+        wait = self.limiter.check(rule, principal)
+        if wait is None and self.limiter.collection is not None:
+            wait = await self.limiter.check_shared(rule, principal)
+        if wait is None:
+            await self.app(scope, receive, send)
+            return
+
+        body = json.dumps({"detail": f"Troppe richieste: riprovare tra {wait} secondi"}, ensure_ascii=False).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(wait).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
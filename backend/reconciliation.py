@@ -0,0 +1,361 @@
+"""
+Riconciliazione dell'estratto conto bancario con i pagamenti in attesa/scaduti.
+
+Bank transactions (CSV or CAMT.053 XML) are matched against an in-memory index
+of the open payments built once per run: payer name tokens point to students,
+each student's payments are scored on amount and period. Typos in names are
+handled with difflib on the token vocabulary, amounts within a small tolerance
+are accepted as near misses, and every payment is assigned at most once (best
+score first).
+
+The module only parses and matches; applying the confirmed matches is done by
+server.py, one conditional update per payment.
+"""
+import csv
+import io
+import os
+import re
+import unicodedata
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from difflib import SequenceMatcher, get_close_matches
+from typing import Dict, List, Optional, Tuple
+
+# Matches at or above this score are proposed; "certo" also needs exact amount and name
+MIN_SCORE = 0.6
+MIN_NAME_SCORE = 0.75
+CERTAIN_NAME_SCORE = 0.9
+AMBIGUITY_MARGIN = 0.05
+NAME_TOKEN_CUTOFF = 0.8
+# Near misses: up to 2% of the amount, at least 1 euro (bank fees, rounding)
+AMOUNT_TOLERANCE_RATIO = 0.02
+AMOUNT_TOLERANCE_MIN = 1.0
+PERIOD_WINDOW_DAYS = 45
+
+WEIGHTS = {"nome": 0.55, "importo": 0.25, "periodo": 0.2}
+
+MONTHS = [
+    "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno",
+    "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre"
+]
+# Words that show up in every transfer description and say nothing about the payer
+STOPWORDS = {
+    "bonifico", "sepa", "da", "a", "di", "del", "della", "per", "favore", "ordinante", "causale",
+    "quota", "mensile", "annuale", "retta", "pagamento", "rata", "mese", "anno", "accademia",
+    "musici", "sct", "inst", "istantaneo", "rif", "trn", "cro", "id", "ord", "ben", "e", "il", "la",
+} | set(MONTHS)
+
+# Column names as they appear in Italian and international bank exports
+COLUMN_ALIASES = {
+    "data": ("data", "data_operazione", "data_contabile", "data_valuta", "booking_date", "date", "valuta"),
+    "importo": ("importo", "amount", "importo_eur", "avere", "accrediti", "entrate", "credit"),
+    "dare": ("dare", "addebiti", "uscite", "debit"),
+    "ordinante": ("ordinante", "nome", "controparte", "debitore", "payer", "nome_ordinante", "mittente"),
+    "causale": ("causale", "descrizione", "descrizione_operazione", "description", "dettagli", "remittance_info"),
+}
+
+
+class StatementError(Exception):
+    """The uploaded file is not a bank statement we can read"""
+
+
+# ===================== PARSING =====================
+
+def _normalize_header(name) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", str(name or "").strip().lower()).strip("_")
+
+
+def _strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def tokens(text: Optional[str]) -> List[str]:
+    """Lowercase alphabetic tokens without accents, stopwords and initials"""
+    words = re.findall(r"[a-z]+", _strip_accents(text or "").lower())
+    return [w for w in words if len(w) > 1 and w not in STOPWORDS]
+
+
+def parse_amount(value) -> Optional[float]:
+    """'1.234,56' / '1234.56' / '-150,00 €' -> float"""
+    if value is None:
+        return None
+    text = re.sub(r"[^\d,.\-+]", "", str(value))
+    if not text:
+        return None
+    if "," in text and "." in text:
+        # The last separator is the decimal one
+        if text.rfind(",") > text.rfind("."):
+            text = text.replace(".", "").replace(",", ".")
+        else:
+            text = text.replace(",", "")
+    elif "," in text:
+        text = text.replace(",", ".")
+    try:
+        return round(float(text), 2)
+    except ValueError:
+        return None
+
+
+def parse_date(value) -> Optional[datetime]:
+    text = str(value or "").strip()[:10]
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y"):
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _find_column(headers: List[str], field: str) -> Optional[str]:
+    for alias in COLUMN_ALIASES[field]:
+        if alias in headers:
+            return alias
+    return None
+
+
+def _parse_csv(content: bytes) -> List[dict]:
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = content.decode("latin-1")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    reader.fieldnames = [_normalize_header(h) for h in reader.fieldnames or []]
+    headers = reader.fieldnames
+    columns = {field: _find_column(headers, field) for field in COLUMN_ALIASES}
+    if not columns["data"] or not (columns["importo"] or columns["dare"]):
+        raise StatementError("Colonne data/importo non trovate nell'estratto conto")
+
+    transactions = []
+    for number, row in enumerate(reader, start=2):
+        amount = parse_amount(row.get(columns["importo"])) if columns["importo"] else None
+        if amount is None and columns["dare"]:
+            debit = parse_amount(row.get(columns["dare"]))
+            amount = -abs(debit) if debit else None
+        date = parse_date(row.get(columns["data"]))
+        if amount is None or date is None:
+            continue
+        transactions.append({
+            "riga": number,
+            "data": date,
+            "importo": amount,
+            "ordinante": (row.get(columns["ordinante"]) or "").strip() if columns["ordinante"] else "",
+            "causale": (row.get(columns["causale"]) or "").strip() if columns["causale"] else "",
+        })
+    return transactions
+
+
+def _local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child(element, *path):
+    """Namespace-agnostic lookup of a nested child"""
+    for name in path:
+        if element is None:
+            return None
+        element = next((c for c in element if _local(c.tag) == name), None)
+    return element
+
+
+def _text(element, *path) -> str:
+    found = _child(element, *path)
+    return (found.text or "").strip() if found is not None else ""
+
+
+def _parse_camt(content: bytes) -> List[dict]:
+    """CAMT.053 (ISO 20022 statement): one transaction per Ntry"""
+    try:
+        root = ET.fromstring(content)
+    except ET.ParseError as e:
+        raise StatementError(f"XML non valido: {e}")
+
+    transactions = []
+    entries = [el for el in root.iter() if _local(el.tag) == "Ntry"]
+    for number, entry in enumerate(entries, start=1):
+        amount = parse_amount(_text(entry, "Amt"))
+        if amount is None:
+            continue
+        if _text(entry, "CdtDbtInd") == "DBIT":
+            amount = -amount
+        date = parse_date(_text(entry, "BookgDt", "Dt") or _text(entry, "ValDt", "Dt")
+                          or _text(entry, "BookgDt", "DtTm"))
+        details = _child(entry, "NtryDtls", "TxDtls")
+        payer = _text(details, "RltdPties", "Dbtr", "Nm") or _text(details, "RltdPties", "Dbtr", "Pty", "Nm")
+        remittance = " ".join(
+            (el.text or "").strip() for el in (details.iter() if details is not None else [])
+            if _local(el.tag) == "Ustrd"
+        ) or _text(entry, "AddtlNtryInf")
+        if date is None:
+            continue
+        transactions.append({
+            "riga": number,
+            "data": date,
+            "importo": amount,
+            "ordinante": payer,
+            "causale": remittance,
+        })
+    return transactions
+
+
+def parse_statement(filename: str, content: bytes) -> List[dict]:
+    """Transactions of a bank export: riga, data, importo (negative = debit), ordinante, causale"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".xml" or content.lstrip()[:5] == b"<?xml":
+        transactions = _parse_camt(content)
+    elif extension in (".csv", ".txt", ""):
+        transactions = _parse_csv(content)
+    else:
+        raise StatementError("Formato non supportato (csv | camt.053 xml)")
+    if not transactions:
+        raise StatementError("Nessun movimento trovato nel file")
+    return transactions
+
+
+# ===================== MATCHING =====================
+
+class PaymentIndex:
+    """
+    Open payments indexed for matching: name token -> students, student ->
+    payments. Built once per reconciliation run.
+    """
+
+    def __init__(self, payments: List[dict], names: Dict[str, Tuple[str, str]]):
+        self.by_user: Dict[str, List[dict]] = {}
+        self.user_tokens: Dict[str, List[str]] = {}
+        self.token_users: Dict[str, set] = {}
+        for payment in payments:
+            self.by_user.setdefault(payment["utente_id"], []).append(payment)
+        for user_id in self.by_user:
+            nome, cognome = names.get(user_id, ("", ""))
+            user_tokens = tokens(f"{nome} {cognome}")
+            self.user_tokens[user_id] = user_tokens
+            for token in user_tokens:
+                self.token_users.setdefault(token, set()).add(user_id)
+        self.vocabulary = list(self.token_users)
+        self._close: Dict[str, List[str]] = {}
+
+    def close_tokens(self, token: str) -> List[Tuple[str, float]]:
+        """
+        Vocabulary tokens equal or similar to `token` with their similarity
+        (memoized: statements repeat the same words over and over)
+        """
+        if token in self.token_users:
+            return [(token, 1.0)]
+        if token not in self._close:
+            self._close[token] = [
+                (match, SequenceMatcher(None, token, match).ratio())
+                for match in get_close_matches(token, self.vocabulary, n=3, cutoff=NAME_TOKEN_CUTOFF)
+            ]
+        return self._close[token]
+
+    def name_scores(self, text_tokens: List[str]) -> Dict[str, float]:
+        """
+        Students whose name appears in the transaction text, scored as the
+        average over their name tokens of the best similarity found
+        """
+        best: Dict[str, Dict[str, float]] = {}
+        for token in text_tokens:
+            for match, ratio in self.close_tokens(token):
+                for user_id in self.token_users[match]:
+                    found = best.setdefault(user_id, {})
+                    if ratio > found.get(match, 0.0):
+                        found[match] = ratio
+        return {
+            user_id: sum(found.values()) / len(self.user_tokens[user_id])
+            for user_id, found in best.items()
+        }
+
+
+def amount_score(paid: float, due: float) -> float:
+    diff = abs(paid - due)
+    if diff < 0.005:
+        return 1.0
+    tolerance = max(AMOUNT_TOLERANCE_MIN, due * AMOUNT_TOLERANCE_RATIO)
+    if diff > tolerance:
+        return 0.0
+    # Near misses never score as high as an exact amount
+    return 0.5 + 0.4 * (1 - diff / tolerance)
+
+
+def period_score(transaction: dict, payment: dict) -> float:
+    due = payment["data_scadenza"]
+    date = transaction["data"]
+    if MONTHS[due.month - 1] in transaction["causale"].lower():
+        return 1.0
+    if (date.year, date.month) == (due.year, due.month):
+        return 1.0
+    days = abs((date.replace(tzinfo=None) - due.replace(tzinfo=None)).days)
+    return 0.5 if days <= PERIOD_WINDOW_DAYS else 0.0
+
+
+def match_transactions(transactions: List[dict], index: PaymentIndex) -> Tuple[List[dict], List[dict]]:
+    """
+    Best assignment of incoming transactions to open payments.
+    Returns (matches, unmatched transactions); each match carries the score
+    components and esito "certo" or "probabile".
+    """
+    pairs = []
+    for position, transaction in enumerate(transactions):
+        if transaction["importo"] <= 0:
+            continue
+        text_tokens = tokens(f"{transaction['ordinante']} {transaction['causale']}")
+        for user_id, name in index.name_scores(text_tokens).items():
+            # Matching only the first name (or only the surname) is not enough
+            if name < MIN_NAME_SCORE:
+                continue
+            for payment in index.by_user[user_id]:
+                amount = amount_score(transaction["importo"], payment["importo"])
+                if not amount:
+                    continue
+                period = period_score(transaction, payment)
+                score = WEIGHTS["nome"] * name + WEIGHTS["importo"] * amount + WEIGHTS["periodo"] * period
+                if score >= MIN_SCORE:
+                    pairs.append((score, position, payment, name, amount, period))
+
+    # A transaction that fits two students equally well (homonyms) is never certain
+    best_by_user: Dict[int, Dict[str, float]] = {}
+    for score, position, payment, *_ in pairs:
+        users = best_by_user.setdefault(position, {})
+        users[payment["utente_id"]] = max(score, users.get(payment["utente_id"], 0.0))
+
+    def ambiguous(position: int, user_id: str, score: float) -> bool:
+        return any(
+            other != user_id and other_score >= score - AMBIGUITY_MARGIN
+            for other, other_score in best_by_user[position].items()
+        )
+
+    # Greedy assignment, best score first: each transaction and payment used once
+    pairs.sort(key=lambda pair: (-pair[0], pair[2]["data_scadenza"]))
+    used_transactions = set()
+    used_payments = set()
+    matches = []
+    for score, position, payment, name, amount, period in pairs:
+        if position in used_transactions or payment["id"] in used_payments:
+            continue
+        used_transactions.add(position)
+        used_payments.add(payment["id"])
+        certain = (
+            amount == 1.0 and name >= CERTAIN_NAME_SCORE and period >= 0.5
+            and not ambiguous(position, payment["utente_id"], score)
+        )
+        matches.append({
+            "transazione": transactions[position],
+            "pagamento_id": payment["id"],
+            "utente_id": payment["utente_id"],
+            "importo_dovuto": payment["importo"],
+            "descrizione": payment.get("descrizione"),
+            "punteggio": round(score, 3),
+            "punteggi": {"nome": round(name, 3), "importo": round(amount, 3), "periodo": period},
+            "esito": "certo" if certain else "probabile",
+        })
+
+    unmatched = [
+        t for position, t in enumerate(transactions)
+        if position not in used_transactions and t["importo"] > 0
+    ]
+    matches.sort(key=lambda m: m["transazione"]["riga"])
+    return matches, unmatched
@@ -0,0 +1,132 @@
+"""
+Cache in-process dei dati di riferimento: utenti, corsi e impostazioni.
+
+Lists of courses, lessons and payments attach the name of the same few
+hundred teachers, students and courses to every row. The cache keeps, per
+worker, the non-sensitive fields of every user (USER_FIELDS: never password
+hashes, admin notes or personal details), the courses and the settings
+document. It is warmed at startup and kept fresh by the invalidation bus:
+a write to one document drops that entry, a write without a document id
+(bulk import, seed, deletes seen by the change stream) drops the whole
+collection. Entries missing after an invalidation are read back from
+MongoDB on first use, many ids in one query.
+"""
+import logging
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+USER_FIELDS = ("id", "nome", "cognome", "email", "ruolo", "attivo", "strumento", "insegnante_id")
+COURSE_FIELDS = ("id", "nome", "strumento", "insegnante_id", "descrizione", "attivo")
+# Marks ids known not to exist, so dangling references do not hit MongoDB every time
+MISSING = object()
+
+
+class _Table:
+    """Documents of one collection by `id`, filled on demand"""
+
+    def __init__(self, collection, fields: Iterable[str]):
+        self.collection = collection
+        self.projection = {"_id": 0, **{field: 1 for field in fields}}
+        self.entries: Dict[str, object] = {}
+        # Bumped on every invalidation: a read started before it must not fill the table
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, doc_id: Optional[str] = None):
+        self.generation += 1
+        if doc_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(doc_id, None)
+
+    async def load(self, query: Optional[dict] = None) -> int:
+        generation = self.generation
+        docs = await self.collection.find(query or {}, self.projection).to_list(None)
+        if generation == self.generation:
+            self.entries.update((doc["id"], doc) for doc in docs)
+        return len(docs)
+
+    async def get_many(self, ids: Iterable[Optional[str]]) -> Dict[str, dict]:
+        wanted = {doc_id for doc_id in ids if doc_id}
+        missing = [doc_id for doc_id in wanted if doc_id not in self.entries]
+        self.hits += len(wanted) - len(missing)
+        self.misses += len(missing)
+        found = {}
+        if missing:
+            generation = self.generation
+            docs = await self.collection.find({"id": {"$in": missing}}, self.projection).to_list(None)
+            found = {doc["id"]: doc for doc in docs}
+            if generation == self.generation:
+                for doc_id in missing:
+                    self.entries[doc_id] = found.get(doc_id, MISSING)
+        result = {}
+        for doc_id in wanted:
+            doc = found.get(doc_id) or self.entries.get(doc_id)
+            if doc is not None and doc is not MISSING:
+                result[doc_id] = doc
+        return result
+
+    def metrics(self) -> dict:
+        return {"voci": len(self.entries), "hit": self.hits, "miss": self.misses}
+
+
+class ReferenceCache:
+    """
+    Read-only lookups of users, courses and settings. Returned documents are
+    shared by every request: read them, copy what goes into a response.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.users = _Table(db.utenti, USER_FIELDS)
+        self.courses = _Table(db.corsi, COURSE_FIELDS)
+        self._settings: Optional[dict] = None
+        self._settings_generation = 0
+
+    def subscribe(self, bus):
+        bus.subscribe("utenti", lambda _, doc_id: self.users.invalidate(doc_id))
+        bus.subscribe("corsi", lambda _, doc_id: self.courses.invalidate(doc_id))
+        bus.subscribe("impostazioni", lambda *_: self.invalidate_settings())
+
+    async def warm(self):
+        users = await self.users.load()
+        courses = await self.courses.load()
+        await self.settings()
+        logger.info(f"Cache dati di riferimento: {users} utenti, {courses} corsi")
+
+    # ===================== LOOKUPS =====================
+
+    async def user(self, user_id: Optional[str]) -> Optional[dict]:
+        return (await self.users.get_many([user_id])).get(user_id)
+
+    async def users_by_id(self, user_ids: Iterable[Optional[str]]) -> Dict[str, dict]:
+        return await self.users.get_many(user_ids)
+
+    async def course(self, course_id: Optional[str]) -> Optional[dict]:
+        return (await self.courses.get_many([course_id])).get(course_id)
+
+    async def courses_by_id(self, course_ids: Iterable[Optional[str]]) -> Dict[str, dict]:
+        return await self.courses.get_many(course_ids)
+
+    async def settings(self) -> Optional[dict]:
+        """The settings document, None while it has never been saved"""
+        if self._settings is None:
+            generation = self._settings_generation
+            settings = await self.db.impostazioni.find_one({}, {"_id": 0})
+            if generation != self._settings_generation:
+                return settings
+            self._settings = settings
+        return self._settings
+
+    def invalidate_settings(self):
+        self._settings_generation += 1
+        self._settings = None
+
+    def metrics(self) -> dict:
+        return {
+            "utenti": self.users.metrics(),
+            "corsi": self.courses.metrics(),
+            "impostazioni": self._settings is not None,
+        }
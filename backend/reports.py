@@ -0,0 +1,242 @@
+"""
+Report finanziario per periodo con cache per mese.
+
+The whole report is one aggregation: pagamenti of the period, unioned with
+the attendance rollups of the same months, split by a $facet into monthly revenue,
+outstanding/overdue fees, revenue by instrument (through iscrizioni -> corsi)
+and teacher payroll.
+
+Results are cached in `report_finanziari`, one document per requested period
+with the list of months it covers. A write to pagamenti or presenze deletes
+only the cached reports that cover the months it touched.
+
+Each invalidation also bumps a generation per month in `report_generazioni`
+(the "*" generation for clear_reports) before deleting. The report handler
+reads the generations of its months before aggregating, and store_report
+keeps the result only if they have not moved since: a report computed from
+data older than an invalidation that ran meanwhile is never cached.
+"""
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+FEE_TYPES = ["mensile", "annuale"]
+COMPENSATION_TYPE = "compenso_insegnante"
+PAID = "pagato"
+OPEN_STATES = ["in_attesa", "scaduto"]
+PRESENT, ABSENT, JUSTIFIED = "presente", "assente", "giustificato"
+DEFAULT_QUOTA = 30.0
+# Generation bumped by clear_reports, part of every report's generations
+ALL_MONTHS = "*"
+
+
+def parse_month(value: str) -> datetime:
+    """'YYYY-MM' -> first instant of that month"""
+    return datetime.strptime(value, "%Y-%m")
+
+
+def next_month(month: datetime) -> datetime:
+    return month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+
+
+def months_between(start: datetime, end: datetime) -> List[str]:
+    """'YYYY-MM' of every month in [start, end)"""
+    months = []
+    current = start
+    while current < end:
+        months.append(current.strftime("%Y-%m"))
+        current = next_month(current)
+    return months
+
+
+def period_bounds(da: str, a: str) -> Tuple[datetime, datetime]:
+    """[first day of `da`, first day of the month after `a`)"""
+    start = parse_month(da)
+    end = next_month(parse_month(a))
+    if end <= start:
+        raise ValueError("Il periodo deve terminare dopo l'inizio")
+    return start, end
+
+
+def document_months(*docs: Optional[dict], fields: Iterable[str]) -> set:
+    """Months touched by the date fields of the given documents (before/after a write)"""
+    months = set()
+    for doc in docs:
+        if not doc:
+            continue
+        for field in fields:
+            value = doc.get(field)
+            if isinstance(value, datetime):
+                months.add(value.strftime("%Y-%m"))
+    return months
+
+
+def payroll_stages() -> list:
+    """
+    Attendance count rows (see rollups.attendance_pipeline) -> one row per
+    teacher with the compensation rules of /compensi/calcolo: present and
+    absent are paid, justified only when recovered
+    """
+    return [
+        {"$group": {
+            "_id": "$insegnante_id",
+            "presenti": {"$sum": "$presenti"},
+            "assenti": {"$sum": "$assenti"},
+            "giustificati": {"$sum": "$giustificati"},
+            "recuperi": {"$sum": "$recuperi"}
+        }},
+        {"$lookup": {"from": "compensi", "localField": "_id", "foreignField": "insegnante_id", "as": "compensi"}},
+        {"$lookup": {"from": "utenti", "localField": "_id", "foreignField": "id", "as": "insegnante"}},
+        {"$project": {
+            "_id": 0,
+            "insegnante_id": "$_id",
+            "nome": {"$arrayElemAt": ["$insegnante.nome", 0]},
+            "cognome": {"$arrayElemAt": ["$insegnante.cognome", 0]},
+            "presenti": 1,
+            "assenti": 1,
+            "giustificati": 1,
+            "recuperi": 1,
+            "lezioni_pagate": {"$add": ["$presenti", "$assenti", "$recuperi"]},
+            "quota_per_presenza": {"$ifNull": [{"$arrayElemAt": ["$compensi.quota_per_presenza", 0]}, DEFAULT_QUOTA]}
+        }},
+        {"$addFields": {"totale_compenso": {"$multiply": ["$lezioni_pagate", "$quota_per_presenza"]}}},
+        {"$sort": {"cognome": 1, "nome": 1}}
+    ]
+
+
+def financial_report_pipeline(start: datetime, end: datetime, archived: bool = False) -> list:
+    """
+    Single aggregation over pagamenti (+ presenze_mensili via $unionWith) for
+    [start, end); `archived` also unions pagamenti_archivio, for periods that
+    reach the closed academic years
+    """
+    in_period = {"$gte": start, "$lt": end}
+    paid_fees = {"_sorgente": "pagamenti", "tipo": {"$in": FEE_TYPES}, "stato": PAID, "data_pagamento": in_period}
+    payments = [
+        {"$match": {"$or": [{"data_scadenza": in_period}, {"data_pagamento": in_period}]}},
+        {"$project": {"_id": 0, "utente_id": 1, "tipo": 1, "stato": 1, "importo": 1,
+                      "data_scadenza": 1, "data_pagamento": 1, "_sorgente": {"$literal": "pagamenti"}}},
+    ]
+
+    pipeline = list(payments)
+    if archived:
+        pipeline.append({"$unionWith": {"coll": "pagamenti_archivio", "pipeline": payments}})
+
+    return pipeline + [
+        # Report periods are whole months: payroll reads the monthly rollups
+        {"$unionWith": {"coll": "presenze_mensili", "pipeline": [
+            {"$match": {"mese": {"$in": months_between(start, end)}}},
+            {"$project": {"_id": 0, "insegnante_id": 1, "presenti": 1, "assenti": 1, "giustificati": 1,
+                          "recuperi": 1, "_sorgente": {"$literal": "presenze"}}}
+        ]}},
+        {"$facet": {
+            "ricavi_mensili": [
+                {"$match": paid_fees},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m", "date": "$data_pagamento"}},
+                    "totale": {"$sum": "$importo"},
+                    "pagamenti": {"$sum": 1}
+                }},
+                {"$project": {"_id": 0, "mese": "$_id", "totale": 1, "pagamenti": 1}},
+                {"$sort": {"mese": 1}}
+            ],
+            "da_incassare": [
+                {"$match": {"_sorgente": "pagamenti", "tipo": {"$in": FEE_TYPES},
+                            "stato": {"$in": OPEN_STATES}, "data_scadenza": in_period}},
+                {"$group": {"_id": "$stato", "totale": {"$sum": "$importo"}, "pagamenti": {"$sum": 1}}},
+                {"$project": {"_id": 0, "stato": "$_id", "totale": 1, "pagamenti": 1}}
+            ],
+            "per_strumento": [
+                {"$match": paid_fees},
+                {"$lookup": {"from": "iscrizioni", "localField": "utente_id", "foreignField": "allievo_id", "as": "iscrizioni"}},
+                {"$lookup": {"from": "corsi", "localField": "iscrizioni.corso_id", "foreignField": "id", "as": "corsi"}},
+                # A student in several courses is counted under the first one
+                {"$group": {
+                    "_id": {"$ifNull": [{"$arrayElemAt": ["$corsi.strumento", 0]}, "non_assegnato"]},
+                    "totale": {"$sum": "$importo"},
+                    "pagamenti": {"$sum": 1},
+                    "allievi": {"$addToSet": "$utente_id"}
+                }},
+                {"$project": {"_id": 0, "strumento": "$_id", "totale": 1, "pagamenti": 1, "allievi": {"$size": "$allievi"}}},
+                {"$sort": {"totale": -1}}
+            ],
+            "compensi_insegnanti": [{"$match": {"_sorgente": "presenze"}}] + payroll_stages(),
+            "compensi_pagati": [
+                {"$match": {"_sorgente": "pagamenti", "tipo": COMPENSATION_TYPE, "stato": PAID, "data_pagamento": in_period}},
+                {"$group": {"_id": None, "totale": {"$sum": "$importo"}, "pagamenti": {"$sum": 1}}},
+                {"$project": {"_id": 0}}
+            ]
+        }}
+    ]
+
+
+def summarize(facets: dict) -> dict:
+    """Report totals on top of the facet rows"""
+    open_by_state = {row["stato"]: row for row in facets["da_incassare"]}
+    payroll = facets["compensi_insegnanti"]
+    paid_compensations = facets["compensi_pagati"][0] if facets["compensi_pagati"] else {}
+    return {
+        "totali": {
+            "ricavi": round(sum(row["totale"] for row in facets["ricavi_mensili"]), 2),
+            "da_incassare": round(sum(row["totale"] for row in facets["da_incassare"]), 2),
+            "scaduto": round(open_by_state.get("scaduto", {}).get("totale", 0.0), 2),
+            "compensi_maturati": round(sum(row["totale_compenso"] for row in payroll), 2),
+            "compensi_pagati": round(paid_compensations.get("totale", 0.0), 2),
+        },
+        **facets,
+    }
+
+
+# ===================== CACHE =====================
+
+def cache_key(da: str, a: str) -> str:
+    return f"{da}:{a}"
+
+
+async def cached_report(db, da: str, a: str) -> Optional[dict]:
+    doc = await db.report_finanziari.find_one({"_id": cache_key(da, a)})
+    return doc["report"] if doc else None
+
+
+async def report_generation(db, months: List[str]) -> Dict[str, int]:
+    """Invalidation generations of `months` and of the whole cache, read before computing a report"""
+    docs = await db.report_generazioni.find({"_id": {"$in": [ALL_MONTHS, *months]}}).to_list(None)
+    found = {doc["_id"]: doc["generazione"] for doc in docs}
+    return {key: found.get(key, 0) for key in sorted([ALL_MONTHS, *months])}
+
+
+async def store_report(db, da: str, a: str, months: List[str], report: dict, generation: Dict[str, int]) -> bool:
+    """
+    Cache the report unless the months were invalidated since `generation` was
+    read. The generations are checked again after the write: an invalidation
+    that bumped them in between may have deleted before the write landed.
+    """
+    if await report_generation(db, months) != generation:
+        return False
+    key = cache_key(da, a)
+    await db.report_finanziari.replace_one(
+        {"_id": key},
+        {"mesi": months, "generazioni": generation, "report": report, "data_creazione": datetime.now(timezone.utc)},
+        upsert=True
+    )
+    if await report_generation(db, months) != generation:
+        await db.report_finanziari.delete_one({"_id": key, "generazioni": generation})
+        return False
+    return True
+
+
+async def invalidate_reports(db, months: Iterable[str]):
+    """Drop the cached reports covering any of `months`"""
+    months = sorted(set(months))
+    if months:
+        await db.report_generazioni.bulk_write([
+            UpdateOne({"_id": month}, {"$inc": {"generazione": 1}}, upsert=True) for month in months
+        ], ordered=False)
+        await db.report_finanziari.delete_many({"mesi": {"$in": months}})
+
+
+async def clear_reports(db):
+    """Drop every cached report (e.g. after a change of compensation rates)"""
+    await db.report_generazioni.update_one({"_id": ALL_MONTHS}, {"$inc": {"generazione": 1}}, upsert=True)
+    await db.report_finanziari.delete_many({})
@@ -0,0 +1,286 @@
+"""
+Rollup mensile delle presenze (collection `presenze_mensili`).
+
+One document per (mese, insegnante, corso, allievo) with the number of
+presenze in each state and the recovered lessons, so attendance analytics
+and payroll over a year read a few hundred rollups instead of every event.
+The attendance handlers apply each write as a $inc on the rollup of the
+event's month; the rebuild job recomputes the rollups from presenze.
+
+Periods that do not start or end on a month boundary read the whole months
+from the rollups and only the partial months from presenze.
+
+Esempi:
+    python rollups.py --check                  # confronta i rollup con le presenze
+    python rollups.py --rebuild                # ricalcola tutti i rollup
+    python rollups.py --rebuild --mese 2026-03
+"""
+import argparse
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne
+from archive import archive_of
+from reports import PRESENT, ABSENT, JUSTIFIED, next_month
+
+# Load env
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+COUNT_FIELDS = ("presenti", "assenti", "giustificati", "recuperi", "totale")
+KEY_FIELDS = ("insegnante_id", "corso_id", "allievo_id")
+
+
+def month_of(value: datetime) -> str:
+    return value.strftime("%Y-%m")
+
+
+def rollup_id(mese: str, insegnante_id, corso_id, allievo_id) -> str:
+    return f"{mese}|{insegnante_id or ''}|{corso_id or ''}|{allievo_id or ''}"
+
+
+def event_counts(record: dict) -> dict:
+    """Counters a single presenza adds to its rollup"""
+    stato = record.get("stato")
+    return {
+        "presenti": int(stato == PRESENT),
+        "assenti": int(stato == ABSENT),
+        "giustificati": int(stato == JUSTIFIED),
+        "recuperi": int(stato == JUSTIFIED and record.get("recupero_data") is not None),
+        "totale": 1,
+    }
+
+
+def event_count_fields() -> dict:
+    """event_counts as aggregation expressions, for stages reading presenze"""
+    def flag(condition):
+        return {"$cond": [condition, 1, 0]}
+
+    return {
+        "presenti": flag({"$eq": ["$stato", PRESENT]}),
+        "assenti": flag({"$eq": ["$stato", ABSENT]}),
+        "giustificati": flag({"$eq": ["$stato", JUSTIFIED]}),
+        "recuperi": flag({"$and": [{"$eq": ["$stato", JUSTIFIED]}, {"$gt": ["$recupero_data", None]}]}),
+        "totale": {"$literal": 1},
+    }
+
+
+def rollup_changes(old: Optional[dict], new: Optional[dict]) -> dict:
+    """rollup _id -> (key fields, $inc delta) for a presenza going from `old` to `new`"""
+    changes = {}
+    for record, sign in ((old, -1), (new, 1)):
+        if not record or not record.get("data"):
+            continue
+        mese = month_of(record["data"])
+        key = rollup_id(mese, *(record.get(field) for field in KEY_FIELDS))
+        fields, delta = changes.setdefault(key, (
+            {"mese": mese, **{field: record.get(field) for field in KEY_FIELDS}},
+            defaultdict(int)
+        ))
+        for field, value in event_counts(record).items():
+            delta[field] += sign * value
+    return {
+        key: (fields, {k: v for k, v in delta.items() if v})
+        for key, (fields, delta) in changes.items()
+    }
+
+
+async def apply_attendance_changes(db, changes: Iterable[Tuple[Optional[dict], Optional[dict]]]):
+    """
+    Update the rollups for a set of attendance writes, given as (before, after)
+    pairs: (None, p) for an insert, (p, None) for a delete.
+    """
+    now = datetime.now(timezone.utc)
+    merged = {}
+    for old, new in changes:
+        for key, (fields, delta) in rollup_changes(old, new).items():
+            entry = merged.setdefault(key, (fields, defaultdict(int)))
+            for field, value in delta.items():
+                entry[1][field] += value
+
+    ops = [
+        UpdateOne(
+            {"_id": key},
+            {"$inc": {k: v for k, v in delta.items() if v}, "$set": {"data_modifica": now},
+             "$setOnInsert": fields},
+            upsert=True
+        )
+        for key, (fields, delta) in merged.items() if any(delta.values())
+    ]
+    if ops:
+        await db.presenze_mensili.bulk_write(ops, ordered=False)
+        # A rollup whose last presenza was deleted or moved no longer exists
+        await db.presenze_mensili.delete_many({"_id": {"$in": list(merged)}, "totale": {"$lte": 0}})
+
+
+# ===================== QUERIES =====================
+
+def split_period(start: datetime, end: datetime) -> Tuple[List[str], Optional[dict]]:
+    """
+    Split [start, end] into the whole months to read from the rollups and a
+    `data` filter for the presenze of the partial months (None if there are none).
+    """
+    first = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if first < start:
+        first = next_month(first)
+    months = []
+    current = first
+    while next_month(current) <= end:
+        months.append(month_of(current))
+        current = next_month(current)
+
+    if not months:
+        return [], {"data": {"$gte": start, "$lte": end}}
+    ranges = []
+    if start < first:
+        ranges.append({"data": {"$gte": start, "$lt": first}})
+    if current <= end:
+        ranges.append({"data": {"$gte": current, "$lte": end}})
+    if not ranges:
+        return months, None
+    return months, ranges[0] if len(ranges) == 1 else {"$or": ranges}
+
+
+def attendance_pipeline(
+    start: datetime,
+    end: datetime,
+    match: Optional[dict] = None,
+    archived: bool = False
+) -> list:
+    """
+    Pipeline on presenze_mensili producing count rows (KEY_FIELDS + COUNT_FIELDS)
+    for the presenze in [start, end] matching `match`: rollups for the whole
+    months, presenze via $unionWith for the partial ones (and presenze_archivio
+    too when `archived`, i.e. the period reaches the closed academic years).
+    """
+    match = match or {}
+    months, partial = split_period(start, end)
+    projection = {"_id": 0, "mese": 1, **{field: 1 for field in KEY_FIELDS + COUNT_FIELDS}}
+    pipeline = [
+        {"$match": {**match, "mese": {"$in": months}}},
+        {"$project": projection},
+    ]
+    if partial is not None:
+        events = [
+            {"$match": {**match, **partial}},
+            {"$project": {
+                "_id": 0,
+                "mese": {"$dateToString": {"format": "%Y-%m", "date": "$data"}},
+                **{field: 1 for field in KEY_FIELDS},
+                **event_count_fields()
+            }}
+        ]
+        pipeline.append({"$unionWith": {"coll": "presenze", "pipeline": events}})
+        if archived:
+            pipeline.append({"$unionWith": {"coll": archive_of("presenze"), "pipeline": events}})
+    return pipeline
+
+
+def sum_counts(group_id) -> dict:
+    """$group stage adding up the count rows of attendance_pipeline"""
+    return {"$group": {"_id": group_id, **{field: {"$sum": f"${field}"} for field in COUNT_FIELDS}}}
+
+
+# ===================== REBUILD =====================
+
+async def expected_rollups(db, months: Optional[List[str]] = None) -> dict:
+    """Rollups recomputed from scratch from presenze (and their archive), keyed by rollup _id"""
+    match = {}
+    if months:
+        bounds = [datetime.strptime(m, "%Y-%m") for m in months]
+        match = {"$or": [{"data": {"$gte": b, "$lt": next_month(b)}} for b in bounds]}
+    pipeline = [
+        {"$match": match},
+        {"$project": {
+            "mese": {"$dateToString": {"format": "%Y-%m", "date": "$data"}},
+            **{field: 1 for field in KEY_FIELDS},
+            **event_count_fields()
+        }},
+        sum_counts({"mese": "$mese", **{field: f"${field}" for field in KEY_FIELDS}})
+    ]
+    rollups = {}
+    # Months of closed academic years live in the archive (a month can be split during archival)
+    for collection in ("presenze", archive_of("presenze")):
+        async for row in db[collection].aggregate(pipeline, allowDiskUse=True):
+            key_fields = row.pop("_id")
+            key = rollup_id(key_fields["mese"], *(key_fields.get(field) for field in KEY_FIELDS))
+            rollup = rollups.setdefault(key, {
+                "mese": key_fields["mese"], **{f: key_fields.get(f) for f in KEY_FIELDS},
+                **{field: 0 for field in COUNT_FIELDS}
+            })
+            for field in COUNT_FIELDS:
+                rollup[field] += row[field]
+    return rollups
+
+
+async def check_rollups(db) -> dict:
+    """rollup _id -> list of differences between stored and recomputed rollups"""
+    expected = await expected_rollups(db)
+    stored = {doc["_id"]: doc async for doc in db.presenze_mensili.find({})}
+    report = {}
+    for key in set(expected) | set(stored):
+        diffs = [
+            f"{field}: {stored.get(key, {}).get(field, 0)} != {expected.get(key, {}).get(field, 0)}"
+            for field in COUNT_FIELDS
+            if stored.get(key, {}).get(field, 0) != expected.get(key, {}).get(field, 0)
+        ]
+        if diffs:
+            report[key] = diffs
+    return report
+
+
+async def rebuild_rollups(db, months: Optional[List[str]] = None) -> int:
+    """Replace the rollups (all, or of the given months) with values recomputed from presenze"""
+    now = datetime.now(timezone.utc)
+    expected = await expected_rollups(db, months)
+    ops = [
+        ReplaceOne({"_id": key}, {**rollup, "data_modifica": now}, upsert=True)
+        for key, rollup in expected.items()
+    ]
+    stale = {"_id": {"$nin": list(expected)}}
+    if months:
+        stale["mese"] = {"$in": months}
+    await db.presenze_mensili.delete_many(stale)
+    for start in range(0, len(ops), 1000):
+        await db.presenze_mensili.bulk_write(ops[start:start + 1000], ordered=False)
+    return len(ops)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Verifica o ricostruisce i rollup mensili delle presenze")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--check", action="store_true", help="Confronta i rollup con le presenze senza scrivere")
+    group.add_argument("--rebuild", action="store_true", help="Ricalcola i rollup dalle presenze")
+    parser.add_argument("--mese", action="append", help="Limita la ricostruzione al mese YYYY-MM (ripetibile)")
+    return parser.parse_args(argv)
+
+
+async def main(args) -> int:
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'test_database')]
+    status = 0
+
+    if args.rebuild:
+        count = await rebuild_rollups(db, args.mese)
+        print(f"✅ {count} rollup ricalcolati")
+    else:
+        report = await check_rollups(db)
+        for key, diffs in sorted(report.items()):
+            print(f"❌ {key}: {'; '.join(diffs)}")
+        if report:
+            print(f"{len(report)} rollup non allineati: eseguire python rollups.py --rebuild")
+            status = 1
+        else:
+            print("✅ Tutti i rollup sono allineati")
+
+    client.close()
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(asyncio.run(main(parse_args())))
@@ -1,15 +1,31 @@
 """
-Script per popolare il database con utenti di test per l'Accademia de 'I Musici'
+Generatore di dati sintetici per l'Accademia de 'I Musici'.
+
+Creates the demo accounts (see README credentials) plus any volume of
+synthetic utenti, dettagli, corsi, lezioni, presenze, pagamenti, compiti and
+notifiche with realistic distributions. Documents are written with batched
+`insert_many` calls and every distinct password is hashed only once, so a
+dataset of a million documents takes seconds rather than hours.
+
+Esempi:
+    python seed_data.py                                   # scala di default
+    python seed_data.py --allievi 10000 --insegnanti 200 --presenze 1000000
+    python seed_data.py --no-reset --allievi 500          # aggiunge senza pulire
 """
+import argparse
 import asyncio
+import itertools
 import os
-import sys
-from datetime import datetime, timezone
+import random
+import time
+from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 from passlib.context import CryptContext
-import uuid
+from ledger import rebuild_ledgers
+from rollups import rebuild_rollups
+from sync import SYNCED_COLLECTIONS
 
 # Load env
 ROOT_DIR = Path(__file__).parent
@@ -18,174 +34,479 @@ load_dotenv(ROOT_DIR / '.env')
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+BATCH_SIZE = 5000
+MAX_BATCHES_IN_FLIGHT = 4
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ.get('DB_NAME', 'test_database')]
+COLLECTIONS = [
+    "utenti", "accesso_amministrazione", "allievi_dettaglio", "insegnanti_dettaglio", "sessioni",
+    "corsi", "iscrizioni", "presenze", "pagamenti", "notifiche", "compiti", "lezioni", "compensi", "saldi",
+    "presenze_mensili", "report_finanziari", "report_generazioni", "eliminazioni",
+]
+
+# Volume of synthetic data on top of the demo accounts
+DEFAULT_SCALE = {
+    "insegnanti": 20,
+    "allievi": 300,
+    "corsi_per_insegnante": 2,
+    "presenze": 20000,
+    "mesi": 10,
+    "notifiche": 30,
+    "compiti_per_allievo": 3,
+}
+
+# Used by /api/seed: demo accounts with a few months of history
+DEMO_SCALE = {
+    "insegnanti": 0,
+    "allievi": 0,
+    "corsi_per_insegnante": 1,
+    "presenze": 200,
+    "mesi": 3,
+    "notifiche": 2,
+    "compiti_per_allievo": 1,
+}
+
+ADMIN_CREDENTIALS = {"email": "acc.imusici@gmail.com", "password": "Accademia2026", "pin": "1234"}
+TEACHER_PASSWORD = "teacher123"
+STUDENT_PASSWORD = "student123"
+
+DEMO_TEACHERS = [
+    {"nome": "Mario", "cognome": "Rossi", "email": "mario.rossi@musici.it", "strumento": "pianoforte"},
+    {"nome": "Lucia", "cognome": "Bianchi", "email": "lucia.bianchi@musici.it", "strumento": "violino"},
+    {"nome": "Paolo", "cognome": "Verdi", "email": "paolo.verdi@musici.it", "strumento": "chitarra"},
+    {"nome": "Anna", "cognome": "Neri", "email": "anna.neri@musici.it", "strumento": "canto"},
+]
+
+DEMO_STUDENTS = [
+    {"nome": "Giulia", "cognome": "Ferrari", "email": "giulia.ferrari@email.it", "strumento": "pianoforte"},
+    {"nome": "Marco", "cognome": "Romano", "email": "marco.romano@email.it", "strumento": "pianoforte"},
+    {"nome": "Sara", "cognome": "Conti", "email": "sara.conti@email.it", "strumento": "violino"},
+    {"nome": "Luca", "cognome": "Esposito", "email": "luca.esposito@email.it", "strumento": "chitarra"},
+    {"nome": "Anna", "cognome": "Bruno", "email": "anna.bruno@email.it", "strumento": "canto"},
+]
+
+# Share of students per instrument
+INSTRUMENT_WEIGHTS = {
+    "pianoforte": 30, "chitarra": 25, "canto": 15, "violino": 12, "chitarra_elettrica": 10, "percussioni": 8,
+}
+
+FIRST_NAMES = [
+    "Giulia", "Marco", "Sara", "Luca", "Anna", "Francesco", "Chiara", "Alessandro", "Martina", "Lorenzo",
+    "Sofia", "Matteo", "Aurora", "Leonardo", "Giorgia", "Andrea", "Alice", "Riccardo", "Elena", "Tommaso",
+    "Beatrice", "Gabriele", "Emma", "Davide", "Ginevra", "Federico", "Greta", "Pietro", "Camilla", "Simone",
+]
+LAST_NAMES = [
+    "Rossi", "Russo", "Ferrari", "Esposito", "Bianchi", "Romano", "Colombo", "Ricci", "Marino", "Greco",
+    "Bruno", "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo", "Lombardi", "Moretti",
+    "Barbieri", "Fontana", "Santoro", "Mariani", "Rinaldi", "Caruso", "Ferrara", "Galli", "Martini", "Leone",
+]
+
+ATTENDANCE_STATES = ["presente", "assente", "giustificato"]
+ATTENDANCE_WEIGHTS = [82, 11, 7]
+RECOVERY_RATE = 0.6
+LESSON_HOURS = ["15:00", "16:00", "17:00", "18:00", "19:00"]
+
+
+class PasswordHasher:
+    """Hashes every distinct password once and reuses the hash"""
+
+    def __init__(self):
+        self._hashes = {}
+
+    async def prepare(self, passwords):
+        """Hash the passwords in worker threads, so bcrypt does not block the event loop"""
+        missing = [p for p in dict.fromkeys(passwords) if p not in self._hashes]
+        hashes = await asyncio.gather(*(asyncio.to_thread(pwd_context.hash, p) for p in missing))
+        self._hashes.update(zip(missing, hashes))
+
+    def __call__(self, password: str) -> str:
+        if password not in self._hashes:
+            self._hashes[password] = pwd_context.hash(password)
+        return self._hashes[password]
+
+
+class BatchWriter:
+    """Buffers documents per collection and writes them with insert_many"""
+
+    def __init__(self, db):
+        self.db = db
+        self.buffers = {}
+        self.counts = {}
+        self._pending = set()
+        self._slots = asyncio.Semaphore(MAX_BATCHES_IN_FLIGHT)
+
+    async def add(self, collection: str, doc: dict):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(doc)
+        if len(buffer) >= BATCH_SIZE:
+            await self._flush(collection)
+
+    async def add_many(self, collection: str, docs: list):
+        self.buffers.setdefault(collection, []).extend(docs)
+        if len(self.buffers[collection]) >= BATCH_SIZE:
+            await self._flush(collection)
+
+    async def _flush(self, collection: str):
+        batch = self.buffers.pop(collection, [])
+        if not batch:
+            return
+        self.counts[collection] = self.counts.get(collection, 0) + len(batch)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._write(collection, batch))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _write(self, collection: str, batch: list):
+        if collection in SYNCED_COLLECTIONS:
+            # Synthetic history looks as if it was last modified when it was created (never in the future)
+            now = datetime.now(timezone.utc)
+            for doc in batch:
+                doc.setdefault("data_modifica", min(doc.get("data_creazione") or now, now))
+        try:
+            await self.db[collection].insert_many(batch, ordered=False)
+        finally:
+            self._slots.release()
+
+    async def close(self) -> dict:
+        for collection in list(self.buffers):
+            await self._flush(collection)
+        if self._pending:
+            await asyncio.gather(*self._pending)
+        return self.counts
+
+
+async def generate_dataset(db, scale: dict = None, seed: int = 42, reset: bool = False) -> dict:
+    """
+    Generate demo accounts plus synthetic data at the given scale.
+    Returns the number of documents written per collection.
+    """
+    scale = {**DEFAULT_SCALE, **(scale or {})}
+    rng = random.Random(seed)
+    hash_password = PasswordHasher()
+    await hash_password.prepare([
+        ADMIN_CREDENTIALS["password"], ADMIN_CREDENTIALS["pin"], TEACHER_PASSWORD, STUDENT_PASSWORD
+    ])
+    writer = BatchWriter(db)
+    now = datetime.now(timezone.utc)
+
+    def new_id() -> str:
+        # Same layout as uuid4, formatted by hand: uuid.UUID() dominates the runtime otherwise
+        h = "%032x" % rng.getrandbits(128)
+        return f"{h[:8]}-{h[8:12]}-4{h[13:16]}-a{h[17:20]}-{h[20:]}"
+
+    if reset:
+        for name in COLLECTIONS:
+            await db[name].delete_many({})
 
-async def seed_database():
-    """Popola il database con utenti e dati di test"""
-    print("🌱 Inizio popolamento database...")
-    
-    # Clear existing data
-    await db.utenti.delete_many({})
-    await db.accesso_amministrazione.delete_many({})
-    await db.allievi_dettaglio.delete_many({})
-    await db.insegnanti_dettaglio.delete_many({})
-    await db.sessioni.delete_many({})
-    await db.corsi.delete_many({})
-    await db.presenze.delete_many({})
-    await db.pagamenti.delete_many({})
-    await db.notifiche.delete_many({})
-    await db.compiti.delete_many({})
-    await db.lezioni.delete_many({})
-    await db.compensi.delete_many({})
-    print("✅ Database pulito")
-    
     # 1. AMMINISTRATORE
-    admin_id = str(uuid.uuid4())
-    admin_user = {
+    admin_id = new_id()
+    await writer.add("utenti", {
         "id": admin_id,
         "ruolo": "amministratore",
         "nome": "Admin",
         "cognome": "Accademia",
-        "email": "acc.imusici@gmail.com",
-        "password_hash": hash_password("Accademia2026"),
+        "email": ADMIN_CREDENTIALS["email"],
+        "password_hash": hash_password(ADMIN_CREDENTIALS["password"]),
         "data_nascita": None,
         "attivo": True,
         "first_login": False,
-        "data_creazione": datetime.now(timezone.utc),
+        "data_creazione": now,
         "ultimo_accesso": None,
         "note_admin": "Amministratore principale"
-    }
-    await db.utenti.insert_one(admin_user)
-    
-    # Admin access (PIN + Google)
-    admin_access = {
-        "id": str(uuid.uuid4()),
+    })
+    await writer.add("accesso_amministrazione", {
+        "id": new_id(),
         "utente_id": admin_id,
-        "pin_hash": hash_password("1234"),  # PIN di default
+        "pin_hash": hash_password(ADMIN_CREDENTIALS["pin"]),
         "pin_attivo": True,
         "google_id": None,
         "ultimo_accesso": None
-    }
-    await db.accesso_amministrazione.insert_one(admin_access)
-    print(f"✅ Amministratore creato: acc.imusici@gmail.com / Accademia2026")
-    
-    # 2. INSEGNANTI
-    teachers = [
-        {"nome": "Mario", "cognome": "Rossi", "email": "mario.rossi@musici.it", "strumento": "pianoforte"},
-        {"nome": "Lucia", "cognome": "Bianchi", "email": "lucia.bianchi@musici.it", "strumento": "violino"},
-        {"nome": "Paolo", "cognome": "Verdi", "email": "paolo.verdi@musici.it", "strumento": "chitarra"},
-        {"nome": "Anna", "cognome": "Neri", "email": "anna.neri@musici.it", "strumento": "canto"},
-    ]
-    
-    teacher_ids = {}
+    })
+
+    # 2. INSEGNANTI (demo + sintetici) e CORSI
+    instruments = list(INSTRUMENT_WEIGHTS)
+    teachers = [dict(t) for t in DEMO_TEACHERS]
+    for i in range(scale["insegnanti"]):
+        nome, cognome = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        teachers.append({
+            "nome": nome,
+            "cognome": cognome,
+            "email": f"{nome}.{cognome}.{i}@musici.it".lower().replace(" ", ""),
+            "strumento": instruments[i % len(instruments)],
+        })
+
+    courses_by_instrument = {}
+    teacher_ids = []
     for teacher in teachers:
-        teacher_id = str(uuid.uuid4())
-        teacher_ids[teacher["strumento"]] = teacher_id
-        
-        user = {
+        teacher_id = new_id()
+        teacher_ids.append(teacher_id)
+        # Details are embedded in the user document
+        await writer.add("utenti", {
             "id": teacher_id,
             "ruolo": "insegnante",
             "nome": teacher["nome"],
             "cognome": teacher["cognome"],
             "email": teacher["email"],
-            "password_hash": hash_password("teacher123"),
+            "password_hash": hash_password(TEACHER_PASSWORD),
             "data_nascita": None,
             "attivo": True,
             "first_login": False,
-            "data_creazione": datetime.now(timezone.utc),
+            "data_creazione": now,
             "ultimo_accesso": None,
             "note_admin": None,
-            "strumento": teacher["strumento"]
-        }
-        await db.utenti.insert_one(user)
-        
-        # Teacher detail
-        teacher_detail = {
-            "id": str(uuid.uuid4()),
-            "utente_id": teacher_id,
-            "specializzazione": teacher["strumento"],
-            "compenso_orario": 30.0,
-            "note": None
-        }
-        await db.insegnanti_dettaglio.insert_one(teacher_detail)
-        
-        print(f"✅ Insegnante creato: {teacher['email']} / teacher123 ({teacher['strumento']})")
-    
-    # 3. ALLIEVI
-    students = [
-        {"nome": "Giulia", "cognome": "Ferrari", "email": "giulia.ferrari@email.it", "strumento": "pianoforte"},
-        {"nome": "Marco", "cognome": "Romano", "email": "marco.romano@email.it", "strumento": "pianoforte"},
-        {"nome": "Sara", "cognome": "Conti", "email": "sara.conti@email.it", "strumento": "violino"},
-        {"nome": "Luca", "cognome": "Esposito", "email": "luca.esposito@email.it", "strumento": "chitarra"},
-        {"nome": "Anna", "cognome": "Bruno", "email": "anna.bruno@email.it", "strumento": "canto"},
-    ]
-    
-    for student in students:
-        student_id = str(uuid.uuid4())
-        
-        user = {
+            "strumento": teacher["strumento"],
+            "dettaglio": {
+                "id": new_id(),
+                "utente_id": teacher_id,
+                "specializzazione": teacher["strumento"],
+                "compenso_orario": rng.choice([28.0, 30.0, 32.0, 35.0]),
+                "note": None
+            }
+        })
+        await writer.add("compensi", {
+            "id": new_id(),
+            "insegnante_id": teacher_id,
+            "corso_id": None,
+            "quota_per_presenza": 30.0,
+            "data_creazione": now
+        })
+        for n in range(scale["corsi_per_insegnante"]):
+            course = {
+                "id": new_id(),
+                "nome": f"Corso di {teacher['strumento'].replace('_', ' ').capitalize()}" + (f" {n + 1}" if n else ""),
+                "strumento": teacher["strumento"],
+                "insegnante_id": teacher_id,
+                "descrizione": f"Corso completo di {teacher['strumento'].replace('_', ' ')}",
+                "attivo": True,
+                "data_creazione": now
+            }
+            courses_by_instrument.setdefault(teacher["strumento"], []).append(course)
+            await writer.add("corsi", course)
+
+    # 3. ALLIEVI (demo + sintetici), each enrolled in one course of their instrument
+    available = [i for i in instruments if i in courses_by_instrument]
+    weights = [INSTRUMENT_WEIGHTS[i] for i in available]
+    students = [dict(s) for s in DEMO_STUDENTS]
+    for i in range(scale["allievi"]):
+        nome, cognome = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        students.append({
+            "nome": nome,
+            "cognome": cognome,
+            "email": f"{nome}.{cognome}.{i}@allievi.musici.it".lower().replace(" ", ""),
+            "strumento": rng.choices(available, weights)[0],
+        })
+
+    enrolled = []
+    for index, student in enumerate(students):
+        student_id = new_id()
+        course = rng.choice(courses_by_instrument[student["strumento"]])
+        birth = (now - timedelta(days=rng.randint(6 * 365, 25 * 365))).strftime("%Y-%m-%d")
+        enrolled.append({"id": student_id, "corso": course})
+        await writer.add("utenti", {
             "id": student_id,
             "ruolo": "allievo",
             "nome": student["nome"],
             "cognome": student["cognome"],
             "email": student["email"],
-            "password_hash": hash_password("student123"),
-            "data_nascita": "2005-01-01",
-            "attivo": True,
+            "password_hash": hash_password(STUDENT_PASSWORD),
+            "data_nascita": birth,
+            "attivo": index < len(DEMO_STUDENTS) or rng.random() > 0.03,
             "first_login": False,
-            "data_creazione": datetime.now(timezone.utc),
+            "data_creazione": now,
             "ultimo_accesso": None,
             "note_admin": None,
-            "insegnante_id": teacher_ids.get(student["strumento"])
-        }
-        await db.utenti.insert_one(user)
-        
-        # Student detail
-        student_detail = {
-            "id": str(uuid.uuid4()),
-            "utente_id": student_id,
-            "telefono": "3331234567",
-            "data_nascita": "2005-01-01",
-            "corso_principale": student["strumento"],
-            "note": None
-        }
-        await db.allievi_dettaglio.insert_one(student_detail)
-        
-        print(f"✅ Allievo creato: {student['email']} / student123 ({student['strumento']})")
-    
-    # 4. CORSI
-    for strumento, teacher_id in teacher_ids.items():
-        corso_id = str(uuid.uuid4())
-        corso = {
-            "id": corso_id,
-            "nome": f"Corso di {strumento.capitalize()}",
-            "strumento": strumento,
-            "insegnante_id": teacher_id,
-            "descrizione": f"Corso completo di {strumento}",
-            "attivo": True,
-            "data_creazione": datetime.now(timezone.utc)
-        }
-        await db.corsi.insert_one(corso)
-        print(f"✅ Corso creato: {strumento}")
-    
-    print("\n🎉 Database popolato con successo!")
+            "insegnante_id": course["insegnante_id"],
+            "dettaglio": {
+                "id": new_id(),
+                "utente_id": student_id,
+                "telefono": f"3{rng.randint(10, 99)}{rng.randint(1000000, 9999999)}",
+                "data_nascita": birth,
+                "corso_principale": student["strumento"],
+                "note": None
+            }
+        })
+        await writer.add("iscrizioni", {
+            "id": new_id(),
+            "allievo_id": student_id,
+            "corso_id": course["id"],
+            "insegnante_id": course["insegnante_id"],
+            "data_inizio": now - timedelta(days=30 * scale["mesi"]),
+            "data_fine": None,
+            "data_creazione": now
+        })
+
+    # 4. LEZIONI - one per week per course over the period
+    start = (now - timedelta(days=30 * scale["mesi"])).replace(hour=0, minute=0, second=0, microsecond=0)
+    weeks = max(1, (now - start).days // 7 + 2)
+    for courses in courses_by_instrument.values():
+        for course in courses:
+            ora = rng.choice(LESSON_HOURS)
+            first = start + timedelta(days=rng.randrange(7))
+            for w in range(weeks):
+                await writer.add("lezioni", {
+                    "id": new_id(),
+                    "corso_id": course["id"],
+                    "insegnante_id": course["insegnante_id"],
+                    "data": first + timedelta(weeks=w),
+                    "ora": ora,
+                    "durata": rng.choice([45, 60, 60, 90]),
+                    "note": None,
+                    "data_creazione": now
+                })
+
+    # 5. PRESENZE - some students attend (and get recorded) much more than others
+    days = [start + timedelta(days=d) for d in range((now - start).days or 1)]
+    recovery_delays = [timedelta(days=d) for d in range(3, 22)]
+    student_weights = list(itertools.accumulate(rng.paretovariate(2.0) for _ in enrolled))
+    state_weights = list(itertools.accumulate(ATTENDANCE_WEIGHTS))
+    remaining = scale["presenze"]
+    while remaining > 0:
+        chunk = min(remaining, BATCH_SIZE)
+        remaining -= chunk
+        picks = rng.choices(enrolled, cum_weights=student_weights, k=chunk)
+        states = rng.choices(ATTENDANCE_STATES, cum_weights=state_weights, k=chunk)
+        dates = rng.choices(days, k=chunk)
+        docs = []
+        for student, stato, day in zip(picks, states, dates):
+            recovered = stato == "giustificato" and rng.random() < RECOVERY_RATE
+            docs.append({
+                "id": new_id(),
+                "corso_id": student["corso"]["id"],
+                "lezione_id": None,
+                "allievo_id": student["id"],
+                "insegnante_id": student["corso"]["insegnante_id"],
+                "data": day,
+                "stato": stato,
+                "recupero_data": day + rng.choice(recovery_delays) if recovered else None,
+                "note": None,
+                "data_creazione": day
+            })
+        await writer.add_many("presenze", docs)
+
+    # 6. PAGAMENTI - monthly fee per student and monthly compensation per teacher
+    months = []
+    cursor = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(scale["mesi"]):
+        months.append(cursor)
+        cursor = (cursor - timedelta(days=1)).replace(day=1)
+
+    for month in months:
+        due = month.replace(day=7, hour=23, minute=59, second=59)
+        mese = month.strftime("%Y-%m")
+        current = month.year == now.year and month.month == now.month
+        for student in enrolled:
+            roll = rng.random()
+            if current and due >= now:
+                stato = "pagato" if roll < 0.4 else "in_attesa"
+            else:
+                stato = "pagato" if roll < 0.9 else ("scaduto" if roll < 0.97 else "in_attesa")
+            paid_at = due + timedelta(days=rng.randint(-10, 12)) if stato == "pagato" else None
+            await writer.add("pagamenti", {
+                "id": new_id(),
+                "utente_id": student["id"],
+                "tipo": "mensile",
+                "importo": 150.0,
+                "descrizione": f"Quota mensile {mese}",
+                "data_scadenza": due,
+                "stato": stato,
+                "data_pagamento": min(paid_at, now) if paid_at else None,
+                "tolleranza_giorni": 0,
+                "visibile_utente": True,
+                "data_creazione": month
+            })
+        for teacher_id in teacher_ids:
+            await writer.add("pagamenti", {
+                "id": new_id(),
+                "utente_id": teacher_id,
+                "tipo": "compenso_insegnante",
+                "importo": float(rng.randint(20, 80) * 30),
+                "descrizione": f"Compenso {mese}",
+                "data_scadenza": due + timedelta(days=30),
+                "stato": "in_attesa" if current else "pagato",
+                "data_pagamento": None if current else due + timedelta(days=30),
+                "tolleranza_giorni": 0,
+                "visibile_utente": True,
+                "data_creazione": month
+            })
+
+    # 7. COMPITI
+    for student in enrolled:
+        for _ in range(scale["compiti_per_allievo"]):
+            due = now + timedelta(days=rng.randint(-60, 21))
+            await writer.add("compiti", {
+                "id": new_id(),
+                "insegnante_id": student["corso"]["insegnante_id"],
+                "allievo_id": student["id"],
+                "titolo": rng.choice(["Scale maggiori", "Arpeggi", "Studio n. 3", "Lettura a prima vista", "Brano del saggio"]),
+                "descrizione": "Esercitarsi ogni giorno per almeno 20 minuti",
+                "data_scadenza": due,
+                "completato": due < now and rng.random() < 0.7,
+                "data_creazione": due - timedelta(days=14)
+            })
+
+    # 8. NOTIFICHE - mostly broadcast, some targeted
+    sample_notifications = [
+        ("Benvenuti!", "Benvenuti nella nuova app dell'Accademia de 'I Musici'."),
+        ("Concerto di fine anno", "Il concerto si terrà il 20 Dicembre."),
+        ("Chiusura festiva", "L'accademia resterà chiusa durante le festività."),
+        ("Saggio di primavera", "Le iscrizioni al saggio sono aperte."),
+    ]
+    for i in range(scale["notifiche"]):
+        titolo, messaggio = sample_notifications[i % len(sample_notifications)]
+        targeted = i >= 2 and rng.random() < 0.3
+        await writer.add("notifiche", {
+            "id": new_id(),
+            "titolo": titolo,
+            "messaggio": messaggio,
+            "tipo": rng.choice(["pagamento", "lezione"]) if targeted else "generale",
+            "destinatari_tipo": "singoli" if targeted else "tutti",
+            "destinatari_ids": [s["id"] for s in rng.sample(enrolled, min(len(enrolled), rng.randint(1, 20)))] if targeted else [],
+            "filtro_pagamento": None,
+            "attivo": rng.random() > 0.2,
+            "data_creazione": now - timedelta(days=rng.randrange(30 * scale["mesi"] or 1))
+        })
+
+    counts = await writer.close()
+    # Payments were bulk-inserted: derive the balances from them in one pass
+    counts["saldi"] = await rebuild_ledgers(db)
+    counts["presenze_mensili"] = await rebuild_rollups(db)
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Popola il database con dati di test")
+    for key, value in DEFAULT_SCALE.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key, type=int, default=value)
+    parser.add_argument("--seed", type=int, default=42, help="Seed per dati riproducibili")
+    parser.add_argument("--no-reset", dest="reset", action="store_false", help="Non svuotare il database prima")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ.get('DB_NAME', 'test_database')]
+    scale = {key: getattr(args, key) for key in DEFAULT_SCALE}
+
+    print("🌱 Inizio popolamento database...")
+    started = time.perf_counter()
+    counts = await generate_dataset(db, scale, seed=args.seed, reset=args.reset)
+    elapsed = time.perf_counter() - started
+    client.close()
+
+    for name, count in sorted(counts.items()):
+        print(f"✅ {name}: {count}")
+    print(f"\n🎉 Database popolato con successo! {sum(counts.values())} documenti in {elapsed:.1f}s")
     print("\n📋 CREDENZIALI DI ACCESSO:")
     print("\n🔐 Amministratore:")
-    print("   Email: acc.imusici@gmail.com")
-    print("   Password: Accademia2026")
-    print("   PIN: 1234")
+    print(f"   Email: {ADMIN_CREDENTIALS['email']}")
+    print(f"   Password: {ADMIN_CREDENTIALS['password']}")
+    print(f"   PIN: {ADMIN_CREDENTIALS['pin']}")
     print("\n👨‍🏫 Insegnanti:")
     print("   Email: [nome].[cognome]@musici.it")
-    print("   Password: teacher123")
+    print(f"   Password: {TEACHER_PASSWORD}")
     print("\n🎓 Allievi:")
     print("   Email: [nome].[cognome]@email.it")
-    print("   Password: student123")
+    print(f"   Password: {STUDENT_PASSWORD}")
+
 
 if __name__ == "__main__":
-    asyncio.run(seed_database())
+    asyncio.run(main(parse_args()))
@@ -1,30 +1,110 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Response, Request, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Response, Request, Depends, UploadFile, File, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
 import os
+import asyncio
 import logging
-import httpx
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 from enum import Enum
+from contextlib import asynccontextmanager
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from profiler import ProfilerMiddleware, speedscope_json
+from user_import import (
+    read_rows, validate_row, build_detail, temporary_password, hash_passwords, shutdown_pool, warm_pool,
+    FULL_BCRYPT_ROUNDS,
+    ImportFileError, ImportUnavailable
+)
+from ledger import apply_payment_changes, balance_view
+from reports import (
+    financial_report_pipeline, payroll_stages, summarize as summarize_report, period_bounds, months_between,
+    document_months, cached_report, store_report, invalidate_reports, clear_reports, report_generation
+)
+from rollups import apply_attendance_changes, attendance_pipeline, sum_counts
+from analytics import cached_student_analytics, clear_analytics_cache
+from archive import (
+    ensure_archive_indexes, find_across, stream_across, ensure_not_archived, reaches_archive,
+    archive_closed_years, ArchivedRecord
+)
+from singleflight import reads as coalesced_reads, shared_find
+from invalidation import InvalidationBus
+from refcache import ReferenceCache
+from batch import AUTH_SCOPE_KEY, BatchError, run_batch
+from dashboards import cached_dashboard, student_dashboard, teacher_dashboard
+from sync import InvalidCursor, changes_since, ensure_sync_indexes, record_deletions
+from fieldsets import InvalidFields, projection, wants
+from idempotency import IdempotencyMiddleware, IdempotencyStore, ensure_idempotency_indexes
+from ratelimit import RATE_LIMIT_SHARED, RateLimiter, RateLimitMiddleware, ensure_ratelimit_indexes
+from upstream import GOOGLE_AUTH_URL, UpstreamClient, UpstreamRejected, UpstreamUnavailable
+from lifecycle import (
+    SHUTDOWN_DRAIN_SECONDS, WARM_HASH_POOL, Lifecycle, mongo_client_options, open_connections, ping
+)
+from reconciliation import parse_statement, match_transactions, PaymentIndex, StatementError
+from exports import (
+    export_stream, ExportUnavailable, FORMATS as EXPORT_FORMATS,
+    PRESENZE_COLUMNS, PAGAMENTI_COLUMNS, COMPENSI_COLUMNS
+)
+from seed_data import generate_dataset, DEMO_SCALE, ADMIN_CREDENTIALS, TEACHER_PASSWORD, STUDENT_PASSWORD
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection (pool size and timeouts from the MONGO_* variables)
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+mongo_options = mongo_client_options()
+client = AsyncIOMotorClient(mongo_url, **mongo_options)
 db = client[os.environ.get('DB_NAME', 'test_database')]
 
+# In-process caches subscribe here to hear about writes made by any worker
+invalidation_bus = InvalidationBus(db)
+# Users (non-sensitive fields), courses and settings used to enrich list responses
+reference_data = ReferenceCache(db)
+reference_data.subscribe(invalidation_bus)
+# Responses of POSTs sent with an Idempotency-Key, replayed to retries
+idempotency_keys = IdempotencyStore(db)
+# Per-route request limits (RATE_LIMITS), counted in memory and optionally across workers
+rate_limiter = RateLimiter(db, shared=RATE_LIMIT_SHARED)
+# Pooled client for the Google OAuth session exchange of the admin login
+google_auth = UpstreamClient(GOOGLE_AUTH_URL)
+# Startup steps and readiness of this worker
+lifecycle = Lifecycle()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Everything the first requests would otherwise pay for, done before the worker is ready"""
+    await lifecycle.step("indici", ensure_indexes())
+    await lifecycle.step("connessioni_mongo", open_connections(db, mongo_options.get("minPoolSize", 1)))
+    await lifecycle.step("bus_invalidazioni", invalidation_bus.start())
+    await lifecycle.step("dati_riferimento", reference_data.warm())
+    await lifecycle.step("google_auth", google_auth.start())
+    # The first bcrypt call loads and self-tests the backend
+    await lifecycle.step("bcrypt", asyncio.to_thread(hash_password, "riscaldamento"))
+    if WARM_HASH_POOL:
+        await lifecycle.step("processi_hash", warm_pool())
+    lifecycle.mark_ready()
+    try:
+        yield
+    finally:
+        lifecycle.mark_draining()
+        still_running = await coalesced_reads.drain(SHUTDOWN_DRAIN_SECONDS)
+        if still_running:
+            logger.warning(f"Chiusura: {still_running} letture condivise interrotte")
+        await invalidation_bus.stop()
+        await google_auth.close()
+        # Waits for the hash chunks already running and cancels the queued ones, in a thread
+        await asyncio.to_thread(shutdown_pool)
+        client.close()
+
 # Create the main app without a prefix
-app = FastAPI(title="Accademia de 'I Musici' API")
+app = FastAPI(title="Accademia de 'I Musici' API", lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -36,14 +116,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (hashes below min_rounds, e.g. from bulk imports, are upgraded at login)
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__min_rounds=12)
 
 # JWT Configuration
 SECRET_KEY = os.environ.get("SECRET_KEY", "accademia-musici-secret-key-2025")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 7
 
+# Request profiler (X-Profile: 1 header or ?__profile=1, admin only)
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "1"))
+
 # ===================== ENUMS =====================
 class UserRole(str, Enum):
     ADMIN = "amministratore"
@@ -162,7 +246,7 @@ class Session(BaseModel):
     data_creazione: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     data_scadenza: datetime
 
-# 4. ALLIEVI_DETTAGLIO - Student details
+# 4. ALLIEVI_DETTAGLIO - Student details (embedded in utenti.dettaglio)
 class StudentDetail(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     utente_id: str
@@ -177,7 +261,7 @@ class StudentDetailCreate(BaseModel):
     corso_principale: Optional[str] = None
     note: Optional[str] = None
 
-# 5. INSEGNANTI_DETTAGLIO - Teacher details
+# 5. INSEGNANTI_DETTAGLIO - Teacher details (embedded in utenti.dettaglio)
 class TeacherDetail(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     utente_id: str
@@ -235,6 +319,27 @@ class CourseUpdate(BaseModel):
     descrizione: Optional[str] = None
     attivo: Optional[bool] = None
 
+# Enrollment Models (ISCRIZIONI) - student <-> course/teacher with validity dates
+class Enrollment(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    allievo_id: str
+    corso_id: Optional[str] = None  # None = assigned to a teacher without a specific course
+    insegnante_id: str
+    data_inizio: datetime
+    data_fine: Optional[datetime] = None  # None = still active
+    data_creazione: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class EnrollmentCreate(BaseModel):
+    allievo_id: str
+    corso_id: Optional[str] = None
+    insegnante_id: Optional[str] = None  # Defaults to the course teacher
+    data_inizio: Optional[str] = None  # YYYY-MM-DD, default today
+    data_fine: Optional[str] = None  # YYYY-MM-DD
+
+class EnrollmentUpdate(BaseModel):
+    data_inizio: Optional[str] = None
+    data_fine: Optional[str] = None
+
 # Lesson Models
 class Lesson(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -355,6 +460,16 @@ class AdminGoogleRequest(BaseModel):
     email: str
     session_id: str  # From Google OAuth
 
+# Batch Models
+class BatchSubRequest(BaseModel):
+    percorso: str  # e.g. /api/pagamenti?stato=in_attesa
+    metodo: str = "GET"
+    id: Optional[str] = None
+    intestazioni: Optional[dict] = None
+
+class BatchRequest(BaseModel):
+    richieste: List[BatchSubRequest]
+
 # ===================== HELPER FUNCTIONS =====================
 
 def hash_password(password: str) -> str:
@@ -391,6 +506,10 @@ async def get_session_token(request: Request) -> Optional[str]:
 
 async def get_current_user(request: Request) -> Optional[dict]:
     """Get current user from session token"""
+    # Sub-requests of a batch carry the user authenticated by the batch call
+    if AUTH_SCOPE_KEY in request.scope:
+        return request.scope[AUTH_SCOPE_KEY]
+    
     token = await get_session_token(request)
     if not token:
         return None
@@ -438,6 +557,176 @@ async def require_teacher_or_admin(request: Request) -> dict:
         raise HTTPException(status_code=403, detail="Accesso negato")
     return user
 
+async def upsert_embedded_detail(user_id: str, ruolo: UserRole, detail_data: dict) -> Optional[dict]:
+    """
+    Create/update the detail subdocument of a student or teacher in one round-trip.
+    An existing detail keeps its id; returns None if no user with that role exists.
+    """
+    return await db.utenti.find_one_and_update(
+        {"id": user_id, "ruolo": ruolo.value},
+        [{"$set": {"dettaglio": {"$mergeObjects": [
+            {"id": str(uuid.uuid4())},
+            {"$ifNull": ["$dettaglio", {}]},
+            {"$literal": detail_data}
+        ]}}}],
+        projection={"_id": 0, "dettaglio": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+def active_enrollment_filter(at: Optional[datetime] = None) -> dict:
+    """Enrollments valid at the given moment (default: now)"""
+    at = at or datetime.now(timezone.utc)
+    return {
+        "data_inizio": {"$lte": at},
+        "$or": [{"data_fine": None}, {"data_fine": {"$gt": at}}]
+    }
+
+def enrolled_students_pipeline(match: dict) -> list:
+    """Aggregation from iscrizioni to the (active, de-duplicated) student documents"""
+    return [
+        {"$match": match},
+        {"$lookup": {"from": "utenti", "localField": "allievo_id", "foreignField": "id", "as": "allievo"}},
+        {"$unwind": "$allievo"},
+        {"$match": {"allievo.attivo": True}},
+        {"$group": {"_id": "$allievo.id", "allievo": {"$first": "$allievo"}}},
+        {"$replaceRoot": {"newRoot": "$allievo"}},
+        {"$project": {"_id": 0, "password_hash": 0}},
+        {"$sort": {"cognome": 1, "nome": 1}}
+    ]
+
+async def enroll_student(allievo_id: str, insegnante_id: str, corso_id: Optional[str] = None):
+    """Open an enrollment starting today"""
+    now = datetime.now(timezone.utc)
+    await db.iscrizioni.insert_one({
+        "id": str(uuid.uuid4()),
+        "allievo_id": allievo_id,
+        "corso_id": corso_id,
+        "insegnante_id": insegnante_id,
+        "data_inizio": now,
+        "data_fine": None,
+        "data_creazione": now
+    })
+
+async def ensure_indexes():
+    """Create the indexes the queries rely on (idempotent)"""
+    await db.utenti.create_index("id", unique=True)
+    await db.utenti.create_index("email")
+    await db.iscrizioni.create_index("id", unique=True)
+    # Teacher roster, course roster and student's courses: one index each
+    await db.iscrizioni.create_index([("insegnante_id", 1), ("data_fine", 1), ("allievo_id", 1)])
+    await db.iscrizioni.create_index([("corso_id", 1), ("data_fine", 1), ("allievo_id", 1)])
+    await db.iscrizioni.create_index([("allievo_id", 1), ("data_fine", 1), ("corso_id", 1)])
+    await db.saldi.create_index("utente_id", unique=True)
+    # Open payments of a user by due date (ledger next due date, reminders)
+    await db.pagamenti.create_index([("utente_id", 1), ("stato", 1), ("data_scadenza", 1)])
+    # Period filters of the financial report
+    await db.pagamenti.create_index("data_scadenza")
+    await db.pagamenti.create_index("data_pagamento")
+    await db.presenze.create_index("data")
+    await db.report_finanziari.create_index("mesi")
+    await db.presenze_mensili.create_index([("mese", 1), ("insegnante_id", 1)])
+    await ensure_archive_indexes(db)
+    # Active notifications, broadcast or per recipient, newest first
+    await db.notifiche.create_index([("attivo", 1), ("destinatari_ids", 1), ("data_creazione", -1)])
+    # Upcoming lessons of a teacher or of a course, open assignments (dashboards)
+    await db.lezioni.create_index([("insegnante_id", 1), ("data", 1)])
+    await db.lezioni.create_index([("corso_id", 1), ("data", 1)])
+    await db.compiti.create_index([("allievo_id", 1), ("completato", 1), ("data_scadenza", 1)])
+    await db.compiti.create_index([("insegnante_id", 1), ("completato", 1), ("data_scadenza", 1)])
+    await ensure_sync_indexes(db)
+    await ensure_idempotency_indexes(db)
+    await ensure_ratelimit_indexes(db)
+
+async def record_payment_changes(changes: list):
+    """
+    Keep what is derived from pagamenti in sync after a write: balances and
+    cached reports. `changes` are (before, after) pairs, None for absent.
+    """
+    await apply_payment_changes(db, changes)
+    await invalidate_reports(db, document_months(
+        *[doc for pair in changes for doc in pair], fields=("data_scadenza", "data_pagamento")
+    ))
+
+async def record_attendance_changes(changes: list):
+    """Same as record_payment_changes, for presenze: monthly rollups and cached reports"""
+    await apply_attendance_changes(db, changes)
+    await invalidate_reports(db, document_months(*[doc for pair in changes for doc in pair], fields=("data",)))
+
+def list_projection(collection: str, current_user: dict, fields: Optional[str], default: Optional[dict] = None) -> dict:
+    """Projection for the `fields` parameter of a list (400 for fields the role cannot ask for)"""
+    try:
+        return projection(collection, current_user["ruolo"], fields, default or {"_id": 0})
+    except InvalidFields as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def not_found_or_archived(collection: str, doc_id: str, detail: str):
+    """404 for a missing document, 409 if it was moved to the archive (read-only)"""
+    try:
+        await ensure_not_archived(db, collection, doc_id)
+    except ArchivedRecord as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    raise HTTPException(status_code=404, detail=detail)
+
+def if_match_version(request: Request) -> Optional[int]:
+    """Version the client last read, from `If-Match: "<versione>"` (None: no check)"""
+    value = request.headers.get("if-match")
+    if value is None or value.strip() == "*":
+        return None
+    try:
+        return int(value.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match non valido: atteso il numero di versione")
+
+def set_etag(response: Response, doc: dict):
+    response.headers["ETag"] = f'"{doc.get("versione", 0)}"'
+
+async def versioned_update(
+    collection: str, doc_id: str, update_dict: dict, request: Request, detail: str,
+    scope: Optional[dict] = None, projection: Optional[dict] = None, before: bool = False
+) -> dict:
+    """
+    Apply `update_dict` and bump `versione` in one round trip, returning the
+    updated document (the previous one with `before`). With If-Match the
+    write only happens on the version the client read: otherwise 409, so
+    concurrent edits do not silently overwrite each other. `scope` narrows
+    the documents the caller may change; a document outside it is a 403.
+    Documents written before versioning count as version 0.
+    """
+    query = {"id": doc_id, **(scope or {})}
+    version = if_match_version(request)
+    if version is not None:
+        query["versione"] = version if version else {"$in": [0, None]}
+    projection = projection or {"_id": 0}
+
+    if update_dict:
+        doc = await db[collection].find_one_and_update(
+            query, {"$set": update_dict, "$inc": {"versione": 1}}, projection=projection,
+            return_document=ReturnDocument.BEFORE if before else ReturnDocument.AFTER
+        )
+    else:
+        doc = await db[collection].find_one(query, projection)
+    if doc is not None:
+        return doc
+
+    # Failure path only: tell the reasons apart
+    current = await db[collection].find_one({"id": doc_id}, {"_id": 0, "versione": 1, **{k: 1 for k in scope or {}}})
+    if current is None:
+        if collection in ("pagamenti", "presenze"):
+            await not_found_or_archived(collection, doc_id, detail)
+        raise HTTPException(status_code=404, detail=detail)
+    if any(current.get(field) != value for field, value in (scope or {}).items()):
+        raise HTTPException(status_code=403, detail="Non autorizzato")
+    raise HTTPException(
+        status_code=409,
+        detail=f"Modificato da un altro utente (versione {current.get('versione', 0)}): ricaricare e riprovare"
+    )
+
+def updated_from(before: dict, update_dict: dict) -> dict:
+    """The document after `versioned_update(..., before=True)`, without reading it back"""
+    if not update_dict:
+        return before
+    return {**before, **update_dict, "versione": before.get("versione", 0) + 1}
+
 # ===================== AUTH ROUTES =====================
 
 @api_router.post("/auth/login")
@@ -457,6 +746,12 @@ async def login(login_data: LoginRequest, request: Request, response: Response):
     if not verify_password(login_data.password, user.get("password_hash", "")):
         raise HTTPException(status_code=401, detail="Email o password non validi")
     
+    if pwd_context.needs_update(user["password_hash"]):
+        await db.utenti.update_one(
+            {"id": user["id"]},
+            {"$set": {"password_hash": hash_password(login_data.password)}}
+        )
+    
     # Create session
     token = create_access_token({"sub": user["id"], "ruolo": user["ruolo"]})
     scadenza = datetime.now(timezone.utc) + timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS)
@@ -500,15 +795,9 @@ async def login(login_data: LoginRequest, request: Request, response: Response):
         "attivo": user["attivo"]
     }
     
-    # Add details based on role
-    if user["ruolo"] == UserRole.STUDENT.value:
-        detail = await db.allievi_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user_response["dettaglio"] = detail
-    elif user["ruolo"] == UserRole.TEACHER.value:
-        detail = await db.insegnanti_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user_response["dettaglio"] = detail
+    # Student/teacher details are embedded in the user document
+    if user.get("dettaglio"):
+        user_response["dettaglio"] = user["dettaglio"]
     
     return {"user": user_response, "token": token}
 
@@ -564,19 +853,16 @@ async def admin_google_verify(google_data: AdminGoogleRequest, request: Request,
         raise HTTPException(status_code=401, detail="Credenziali non valide")
     
     # Exchange session_id with Emergent Auth
-    async with httpx.AsyncClient() as client:
-        try:
-            auth_response = await client.get(
-                "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data",
-                headers={"X-Session-ID": google_data.session_id}
-            )
-            if auth_response.status_code != 200:
-                raise HTTPException(status_code=401, detail="Sessione Google non valida")
-            
-            google_data_resp = auth_response.json()
-        except Exception as e:
-            logger.error(f"Google auth error: {e}")
-            raise HTTPException(status_code=500, detail="Errore di autenticazione Google")
+    try:
+        google_data_resp = await google_auth.get_json(headers={"X-Session-ID": google_data.session_id})
+    except UpstreamRejected:
+        raise HTTPException(status_code=401, detail="Sessione Google non valida")
+    except UpstreamUnavailable as e:
+        logger.error(f"Google auth error: {e}")
+        raise HTTPException(
+            status_code=503, detail="Autenticazione Google non disponibile, riprovare più tardi",
+            headers={"Retry-After": str(google_auth.breaker.retry_after())}
+        )
     
     # Verify email matches
     if google_data_resp.get("email", "").lower() != user["email"].lower():
@@ -654,15 +940,9 @@ async def get_me(request: Request):
         "ultimo_accesso": user.get("ultimo_accesso")
     }
     
-    # Add details based on role
-    if user["ruolo"] == UserRole.STUDENT.value:
-        detail = await db.allievi_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user_response["dettaglio"] = detail
-    elif user["ruolo"] == UserRole.TEACHER.value:
-        detail = await db.insegnanti_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user_response["dettaglio"] = detail
+    # Student/teacher details are embedded in the user document
+    if user.get("dettaglio"):
+        user_response["dettaglio"] = user["dettaglio"]
     
     return user_response
 
@@ -682,10 +962,12 @@ async def logout(request: Request, response: Response):
 async def get_users(
     request: Request,
     ruolo: Optional[str] = None,
-    attivo: Optional[bool] = None
+    attivo: Optional[bool] = None,
+    fields: Optional[str] = None
 ):
-    """Get all users (Admin only)"""
-    await require_admin(request)
+    """Get all users (Admin only); `fields` limits the returned fields"""
+    current_user = await require_admin(request)
+    fields_projection = list_projection("utenti", current_user, fields, {"_id": 0, "password_hash": 0})
     
     query = {}
     if ruolo:
@@ -693,19 +975,8 @@ async def get_users(
     if attivo is not None:
         query["attivo"] = attivo
     
-    users = await db.utenti.find(query, {"_id": 0, "password_hash": 0}).to_list(1000)
-    
-    # Add details for each user
-    for user in users:
-        if user["ruolo"] == UserRole.STUDENT.value:
-            detail = await db.allievi_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-            if detail:
-                user["dettaglio"] = detail
-        elif user["ruolo"] == UserRole.TEACHER.value:
-            detail = await db.insegnanti_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-            if detail:
-                user["dettaglio"] = detail
-    
+    # Details come embedded in each user document
+    users = await db.utenti.find(query, fields_projection).to_list(1000)
     return users
 
 @api_router.get("/utenti/{user_id}")
@@ -721,16 +992,6 @@ async def get_user(user_id: str, request: Request):
     if not user:
         raise HTTPException(status_code=404, detail="Utente non trovato")
     
-    # Add details
-    if user["ruolo"] == UserRole.STUDENT.value:
-        detail = await db.allievi_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user["dettaglio"] = detail
-    elif user["ruolo"] == UserRole.TEACHER.value:
-        detail = await db.insegnanti_dettaglio.find_one({"utente_id": user["id"]}, {"_id": 0})
-        if detail:
-            user["dettaglio"] = detail
-    
     return user
 
 @api_router.get("/utenti/check-duplicates")
@@ -794,6 +1055,11 @@ async def create_user(user_data: UserCreate, request: Request):
     }
     
     result = await db.utenti.insert_one(new_user)
+    await invalidation_bus.notify("utenti", user_id)
+    
+    # Students assigned to a teacher get an enrollment
+    if user_data.ruolo == UserRole.STUDENT and user_data.insegnante_id:
+        await enroll_student(user_id, user_data.insegnante_id)
     
     # Create admin access if role is admin
     if user_data.ruolo == UserRole.ADMIN:
@@ -813,16 +1079,177 @@ async def create_user(user_data: UserCreate, request: Request):
     new_user.pop("_id", None)
     return new_user
 
+@api_router.post("/utenti/import")
+async def import_users(request: Request, file: UploadFile = File(...), dry_run: bool = False):
+    """
+    Bulk import students, teachers and admins from CSV/XLSX (Admin only).
+    Columns: ruolo, nome, cognome, email, password (optional, a temporary one is
+    generated), data_nascita, note_admin, strumento, insegnante_email and the
+    detail columns (telefono, corso_principale, specializzazione, compenso_orario, note).
+    Returns one report entry per row; with dry_run nothing is written.
+    """
+    await require_admin(request)
+    
+    try:
+        rows = read_rows(file.filename, await file.read())
+    except ImportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ImportFileError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Validate rows; line 1 of the file is the header
+    report = []
+    candidates = []
+    emails = set()
+    for number, row in enumerate(rows, start=2):
+        entry = {"riga": number, "email": (row.get("email") or "").lower(), "esito": "errore"}
+        report.append(entry)
+        error = validate_row(row)
+        if not error and entry["email"] in emails:
+            error = "Email ripetuta nel file"
+        if error:
+            entry["motivo"] = error
+            continue
+        emails.add(entry["email"])
+        candidates.append((entry, row))
+    
+    # One query for the emails already registered and one for the referenced teachers
+    existing = await db.utenti.find({"email": {"$in": list(emails)}}, {"_id": 0, "email": 1}).to_list(None)
+    existing = {u["email"] for u in existing}
+    teacher_emails = [r["insegnante_email"].lower() for _, r in candidates if r.get("insegnante_email")]
+    teachers = await db.utenti.find(
+        {"email": {"$in": teacher_emails}, "ruolo": UserRole.TEACHER.value},
+        {"_id": 0, "email": 1, "id": 1}
+    ).to_list(None)
+    teacher_ids = {t["email"]: t["id"] for t in teachers}
+    
+    accepted = []
+    for entry, row in candidates:
+        if entry["email"] in existing:
+            entry["motivo"] = "Email già registrata"
+            continue
+        entry["id"] = str(uuid.uuid4())
+        accepted.append((entry, row, row["ruolo"].lower()))
+    # Teachers created by this same file can be referenced by its students
+    teacher_ids.update({e["email"]: e["id"] for e, _, ruolo in accepted if ruolo == UserRole.TEACHER.value})
+    
+    to_create = []
+    for entry, row, ruolo in accepted:
+        teacher_email = (row.get("insegnante_email") or "").lower()
+        if ruolo == UserRole.STUDENT.value and teacher_email and teacher_email not in teacher_ids:
+            entry.pop("id")
+            entry["motivo"] = f"Insegnante non trovato: {teacher_email}"
+            continue
+        to_create.append((entry, row, ruolo))
+    
+    if dry_run:
+        for entry, _, _ in to_create:
+            entry.pop("id")
+            entry["esito"] = "valido"
+        return {
+            "totale": len(rows),
+            "validi": len(to_create),
+            "errori": len(rows) - len(to_create),
+            "righe": report
+        }
+    
+    # Hash every password (and the default PIN of new admins) across the process pool
+    passwords = []
+    for entry, row, ruolo in to_create:
+        if not row.get("password"):
+            row["password"] = entry["password_temporanea"] = temporary_password()
+        passwords.append(row["password"])
+    admins = [entry["id"] for entry, _, ruolo in to_create if ruolo == UserRole.ADMIN.value]
+    hashes, pins = await asyncio.gather(
+        hash_passwords(passwords),
+        hash_passwords(["1234"] * len(admins), rounds=FULL_BCRYPT_ROUNDS)
+    )
+    pin_hashes = dict(zip(admins, pins))
+    
+    now = datetime.now(timezone.utc)
+    users = []
+    for (entry, row, ruolo), password_hash in zip(to_create, hashes):
+        user = {
+            "id": entry["id"],
+            "ruolo": ruolo,
+            "nome": row["nome"],
+            "cognome": row["cognome"],
+            "email": entry["email"],
+            "password_hash": password_hash,
+            "data_nascita": row.get("data_nascita"),
+            "attivo": True,
+            "first_login": True,
+            "data_creazione": now,
+            "ultimo_accesso": None,
+            "note_admin": row.get("note_admin"),
+            "insegnante_id": teacher_ids.get((row.get("insegnante_email") or "").lower()) if ruolo == UserRole.STUDENT.value else None,
+            "strumento": row.get("strumento") if ruolo == UserRole.TEACHER.value else None
+        }
+        detail = build_detail(ruolo, row)
+        if detail is not None:
+            user["dettaglio"] = {"id": str(uuid.uuid4()), "utente_id": entry["id"], **detail}
+        users.append(user)
+    
+    failed = set()
+    if users:
+        try:
+            await db.utenti.insert_many(users, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            logger.error(f"Import utenti: {len(failed)} righe non scritte")
+        await invalidation_bus.notify("utenti")
+    
+    created = []
+    for i, (user, (entry, _, _)) in enumerate(zip(users, to_create)):
+        if i in failed:
+            entry.pop("id")
+            entry.pop("password_temporanea", None)
+            entry["motivo"] = "Errore di scrittura"
+        else:
+            entry["esito"] = "creato"
+            created.append(user)
+    
+    enrollments = [
+        {
+            "id": str(uuid.uuid4()),
+            "allievo_id": user["id"],
+            "corso_id": None,
+            "insegnante_id": user["insegnante_id"],
+            "data_inizio": now,
+            "data_fine": None,
+            "data_creazione": now
+        }
+        for user in created if user["insegnante_id"]
+    ]
+    admin_access = [
+        {
+            "id": str(uuid.uuid4()),
+            "utente_id": user["id"],
+            "pin_hash": pin_hashes[user["id"]],
+            "pin_attivo": True,
+            "google_id": None,
+            "ultimo_accesso": None
+        }
+        for user in created if user["id"] in pin_hashes
+    ]
+    if enrollments:
+        await db.iscrizioni.insert_many(enrollments)
+    if admin_access:
+        await db.accesso_amministrazione.insert_many(admin_access)
+    
+    logger.info(f"Import utenti: {len(created)} creati su {len(rows)} righe")
+    return {
+        "totale": len(rows),
+        "creati": len(created),
+        "errori": len(rows) - len(created),
+        "righe": report
+    }
+
 @api_router.put("/utenti/{user_id}")
-async def update_user(user_id: str, user_data: UserUpdate, request: Request):
+async def update_user(user_id: str, user_data: UserUpdate, request: Request, response: Response):
     """Update a user (Admin only)"""
     await require_admin(request)
     
-    # Check user exists
-    existing = await db.utenti.find_one({"id": user_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Utente non trovato")
-    
     update_dict = {}
     if user_data.nome is not None:
         update_dict["nome"] = user_data.nome
@@ -849,10 +1276,29 @@ async def update_user(user_id: str, user_data: UserUpdate, request: Request):
     if user_data.strumento is not None:
         update_dict["strumento"] = user_data.strumento
     
+    existing = await versioned_update(
+        "utenti", user_id, update_dict, request, "Utente non trovato",
+        projection={"_id": 0, "password_hash": 0}, before=True
+    )
     if update_dict:
-        await db.utenti.update_one({"id": user_id}, {"$set": update_dict})
-    
-    user = await db.utenti.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
+        await invalidation_bus.notify("utenti", user_id)
+    
+    # Moving a student to another teacher closes the course-less enrollment and opens a new one
+    if (
+        existing["ruolo"] == UserRole.STUDENT.value
+        and user_data.insegnante_id is not None
+        and user_data.insegnante_id != existing.get("insegnante_id")
+    ):
+        await db.iscrizioni.update_many(
+            {"allievo_id": user_id, "corso_id": None, "data_fine": None},
+            {"$set": {"data_fine": datetime.now(timezone.utc)}}
+        )
+        if user_data.insegnante_id:
+            await enroll_student(user_id, user_data.insegnante_id)
+    
+    user = updated_from(existing, update_dict)
+    user.pop("password_hash", None)
+    set_etag(response, user)
     return user
 
 @api_router.delete("/utenti/{user_id}")
@@ -863,12 +1309,13 @@ async def delete_user(user_id: str, request: Request):
     result = await db.utenti.delete_one({"id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Utente non trovato")
+    await invalidation_bus.notify("utenti", user_id)
     
     # Clean up related data
     await db.sessioni.delete_many({"utente_id": user_id})
     await db.accesso_amministrazione.delete_many({"utente_id": user_id})
-    await db.allievi_dettaglio.delete_many({"utente_id": user_id})
-    await db.insegnanti_dettaglio.delete_many({"utente_id": user_id})
+    await db.iscrizioni.delete_many({"allievo_id": user_id})
+    await db.saldi.delete_one({"utente_id": user_id})
     
     return {"message": "Utente eliminato"}
 
@@ -879,12 +1326,6 @@ async def create_student_detail(user_id: str, detail: StudentDetailCreate, reque
     """Create/update student details (Admin only)"""
     await require_admin(request)
     
-    # Verify user exists and is a student
-    user = await db.utenti.find_one({"id": user_id, "ruolo": UserRole.STUDENT.value})
-    if not user:
-        raise HTTPException(status_code=404, detail="Allievo non trovato")
-    
-    # Upsert detail
     detail_data = {
         "utente_id": user_id,
         "telefono": detail.telefono,
@@ -893,14 +1334,11 @@ async def create_student_detail(user_id: str, detail: StudentDetailCreate, reque
         "note": detail.note
     }
     
-    existing = await db.allievi_dettaglio.find_one({"utente_id": user_id})
-    if existing:
-        await db.allievi_dettaglio.update_one({"utente_id": user_id}, {"$set": detail_data})
-    else:
-        detail_data["id"] = str(uuid.uuid4())
-        await db.allievi_dettaglio.insert_one(detail_data)
+    user = await upsert_embedded_detail(user_id, UserRole.STUDENT, detail_data)
+    if not user:
+        raise HTTPException(status_code=404, detail="Allievo non trovato")
     
-    return await db.allievi_dettaglio.find_one({"utente_id": user_id}, {"_id": 0})
+    return user["dettaglio"]
 
 # ===================== TEACHER DETAIL ROUTES =====================
 
@@ -909,12 +1347,6 @@ async def create_teacher_detail(user_id: str, detail: TeacherDetailCreate, reque
     """Create/update teacher details (Admin only)"""
     await require_admin(request)
     
-    # Verify user exists and is a teacher
-    user = await db.utenti.find_one({"id": user_id, "ruolo": UserRole.TEACHER.value})
-    if not user:
-        raise HTTPException(status_code=404, detail="Insegnante non trovato")
-    
-    # Upsert detail
     detail_data = {
         "utente_id": user_id,
         "specializzazione": detail.specializzazione,
@@ -922,14 +1354,11 @@ async def create_teacher_detail(user_id: str, detail: TeacherDetailCreate, reque
         "note": detail.note
     }
     
-    existing = await db.insegnanti_dettaglio.find_one({"utente_id": user_id})
-    if existing:
-        await db.insegnanti_dettaglio.update_one({"utente_id": user_id}, {"$set": detail_data})
-    else:
-        detail_data["id"] = str(uuid.uuid4())
-        await db.insegnanti_dettaglio.insert_one(detail_data)
+    user = await upsert_embedded_detail(user_id, UserRole.TEACHER, detail_data)
+    if not user:
+        raise HTTPException(status_code=404, detail="Insegnante non trovato")
     
-    return await db.insegnanti_dettaglio.find_one({"utente_id": user_id}, {"_id": 0})
+    return user["dettaglio"]
 
 # ===================== ADMIN PIN MANAGEMENT =====================
 
@@ -959,16 +1388,13 @@ async def update_admin_pin(user_id: str, request: Request):
 
 # ===================== ATTENDANCE ROUTES =====================
 
-@api_router.get("/presenze")
-async def get_attendance(
-    request: Request,
+def attendance_query(
+    current_user: dict,
     allievo_id: Optional[str] = None,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None
-):
-    """Get attendance records"""
-    current_user = await require_auth(request)
-    
+) -> dict:
+    """Attendance filter for the current user, shared by the list and the export"""
     query = {}
     
     # Filter based on role
@@ -990,7 +1416,23 @@ async def get_attendance(
         else:
             query["data"] = {"$lte": datetime.fromisoformat(to_date)}
     
-    records = await db.presenze.find(query, {"_id": 0}).sort("data", -1).to_list(500)
+    return query
+
+@api_router.get("/presenze")
+async def get_attendance(
+    request: Request,
+    allievo_id: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get attendance records"""
+    current_user = await require_auth(request)
+    fields_projection = list_projection("presenze", current_user, fields)
+    
+    query = attendance_query(current_user, allievo_id, from_date, to_date)
+    # Closed academic years are read from the archive only if from_date reaches them
+    records = await find_across(db, "presenze", query, fields_projection, sort=-1, limit=500)
     return records
 
 @api_router.post("/presenze")
@@ -1008,24 +1450,22 @@ async def create_attendance(attendance_data: AttendanceCreate, request: Request)
         "stato": attendance_data.stato.value,
         "recupero_data": datetime.fromisoformat(attendance_data.recupero_data) if attendance_data.recupero_data else None,
         "note": attendance_data.note,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.presenze.insert_one(record)
     record.pop("_id", None)
+    await record_attendance_changes([(None, record)])
     return record
 
 @api_router.put("/presenze/{attendance_id}")
-async def update_attendance(attendance_id: str, request: Request):
+async def update_attendance(attendance_id: str, request: Request, response: Response):
     """Update attendance record (ADMIN ONLY - teachers cannot modify after save)"""
     current_user = await require_auth(request)
     
     body = await request.json()
     
-    existing = await db.presenze.find_one({"id": attendance_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Presenza non trovata")
-    
     # RULE: Only admin can modify attendance records after creation
     if current_user["ruolo"] != UserRole.ADMIN.value:
         raise HTTPException(status_code=403, detail="Solo l'amministratore può modificare le presenze salvate")
@@ -1039,19 +1479,28 @@ async def update_attendance(attendance_id: str, request: Request):
         update_dict["recupero_data"] = datetime.fromisoformat(body["recupero_data"]) if body["recupero_data"] else None
     
     if update_dict:
-        await db.presenze.update_one({"id": attendance_id}, {"$set": update_dict})
+        update_dict["data_modifica"] = datetime.now(timezone.utc)
     
-    return await db.presenze.find_one({"id": attendance_id}, {"_id": 0})
+    existing = await versioned_update(
+        "presenze", attendance_id, update_dict, request, "Presenza non trovata", before=True
+    )
+    record = updated_from(existing, update_dict)
+    if update_dict:
+        await record_attendance_changes([(existing, record)])
+    set_etag(response, record)
+    return record
 
 @api_router.delete("/presenze/{attendance_id}")
 async def delete_attendance(attendance_id: str, request: Request):
     """Delete attendance record (Admin only)"""
     await require_admin(request)
     
-    result = await db.presenze.delete_one({"id": attendance_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Presenza non trovata")
+    deleted = await db.presenze.find_one_and_delete({"id": attendance_id}, projection={"_id": 0})
+    if not deleted:
+        await not_found_or_archived("presenze", attendance_id, "Presenza non trovata")
     
+    await record_deletions(db, "presenze", [deleted])
+    await record_attendance_changes([(deleted, None)])
     return {"message": "Presenza eliminata"}
 
 # ===================== COURSE ROUTES =====================
@@ -1076,11 +1525,12 @@ async def get_courses(
     if attivo is not None:
         query["attivo"] = attivo
     
-    courses = await db.corsi.find(query, {"_id": 0}).to_list(500)
+    courses = await shared_find(db.corsi, query, {"_id": 0}, limit=500)
     
     # Add teacher info
+    teachers = await reference_data.users_by_id(course.get("insegnante_id") for course in courses)
     for course in courses:
-        teacher = await db.utenti.find_one({"id": course["insegnante_id"]}, {"_id": 0, "password_hash": 0})
+        teacher = teachers.get(course.get("insegnante_id"))
         if teacher:
             course["insegnante"] = {"nome": teacher["nome"], "cognome": teacher["cognome"]}
     
@@ -1102,11 +1552,12 @@ async def create_course(course_data: CourseCreate, request: Request):
     }
     
     await db.corsi.insert_one(course)
+    await invalidation_bus.notify("corsi", course["id"])
     course.pop("_id", None)
     return course
 
 @api_router.put("/corsi/{course_id}")
-async def update_course(course_id: str, request: Request):
+async def update_course(course_id: str, request: Request, response: Response):
     """Update course (Admin only)"""
     await require_admin(request)
     
@@ -1124,12 +1575,10 @@ async def update_course(course_id: str, request: Request):
     if "attivo" in body:
         update_dict["attivo"] = body["attivo"]
     
+    course = await versioned_update("corsi", course_id, update_dict, request, "Corso non trovato")
     if update_dict:
-        await db.corsi.update_one({"id": course_id}, {"$set": update_dict})
-    
-    course = await db.corsi.find_one({"id": course_id}, {"_id": 0})
-    if not course:
-        raise HTTPException(status_code=404, detail="Corso non trovato")
+        await invalidation_bus.notify("corsi", course_id)
+    set_etag(response, course)
     return course
 
 @api_router.delete("/corsi/{course_id}")
@@ -1140,6 +1589,9 @@ async def delete_course(course_id: str, request: Request):
     result = await db.corsi.delete_one({"id": course_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Corso non trovato")
+    await invalidation_bus.notify("corsi", course_id)
+    
+    await db.iscrizioni.delete_many({"corso_id": course_id})
     
     return {"message": "Corso eliminato"}
 
@@ -1151,10 +1603,12 @@ async def get_lessons(
     corso_id: Optional[str] = None,
     insegnante_id: Optional[str] = None,
     from_date: Optional[str] = None,
-    to_date: Optional[str] = None
+    to_date: Optional[str] = None,
+    fields: Optional[str] = None
 ):
     """Get lessons"""
     current_user = await require_auth(request)
+    fields_projection = list_projection("lezioni", current_user, fields)
     
     query = {}
     
@@ -1175,16 +1629,21 @@ async def get_lessons(
         else:
             query["data"] = {"$lte": datetime.fromisoformat(to_date)}
     
-    lessons = await db.lezioni.find(query, {"_id": 0}).sort("data", 1).to_list(500)
+    lessons = await db.lezioni.find(query, fields_projection).sort("data", 1).to_list(500)
     
     # Add course and teacher info
-    for lesson in lessons:
-        course = await db.corsi.find_one({"id": lesson["corso_id"]}, {"_id": 0})
-        if course:
-            lesson["corso"] = {"nome": course["nome"], "strumento": course["strumento"]}
-        teacher = await db.utenti.find_one({"id": lesson["insegnante_id"]}, {"_id": 0, "password_hash": 0})
-        if teacher:
-            lesson["insegnante"] = {"nome": teacher["nome"], "cognome": teacher["cognome"]}
+    if wants(fields, "corso"):
+        courses = await reference_data.courses_by_id(lesson.get("corso_id") for lesson in lessons)
+        for lesson in lessons:
+            course = courses.get(lesson.get("corso_id"))
+            if course:
+                lesson["corso"] = {"nome": course["nome"], "strumento": course["strumento"]}
+    if wants(fields, "insegnante"):
+        teachers = await reference_data.users_by_id(lesson.get("insegnante_id") for lesson in lessons)
+        for lesson in lessons:
+            teacher = teachers.get(lesson.get("insegnante_id"))
+            if teacher:
+                lesson["insegnante"] = {"nome": teacher["nome"], "cognome": teacher["cognome"]}
     
     return lessons
 
@@ -1201,7 +1660,8 @@ async def create_lesson(lesson_data: LessonCreate, request: Request):
         "ora": lesson_data.ora,
         "durata": lesson_data.durata,
         "note": None,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.lezioni.insert_one(lesson)
@@ -1209,7 +1669,7 @@ async def create_lesson(lesson_data: LessonCreate, request: Request):
     return lesson
 
 @api_router.put("/lezioni/{lesson_id}")
-async def update_lesson(lesson_id: str, request: Request):
+async def update_lesson(lesson_id: str, request: Request, response: Response):
     """Update lesson (Admin only)"""
     await require_admin(request)
     
@@ -1226,11 +1686,10 @@ async def update_lesson(lesson_id: str, request: Request):
         update_dict["note"] = body["note"]
     
     if update_dict:
-        await db.lezioni.update_one({"id": lesson_id}, {"$set": update_dict})
+        update_dict["data_modifica"] = datetime.now(timezone.utc)
     
-    lesson = await db.lezioni.find_one({"id": lesson_id}, {"_id": 0})
-    if not lesson:
-        raise HTTPException(status_code=404, detail="Lezione non trovata")
+    lesson = await versioned_update("lezioni", lesson_id, update_dict, request, "Lezione non trovata")
+    set_etag(response, lesson)
     return lesson
 
 @api_router.delete("/lezioni/{lesson_id}")
@@ -1238,9 +1697,10 @@ async def delete_lesson(lesson_id: str, request: Request):
     """Delete lesson (Admin only)"""
     await require_admin(request)
     
-    result = await db.lezioni.delete_one({"id": lesson_id})
-    if result.deleted_count == 0:
+    deleted = await db.lezioni.find_one_and_delete({"id": lesson_id}, projection={"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Lezione non trovata")
+    await record_deletions(db, "lezioni", [deleted])
     
     return {"message": "Lezione eliminata"}
 
@@ -1279,6 +1739,8 @@ async def create_compensation(comp_data: TeacherCompensationCreate, request: Req
     }
     
     await db.compensi.insert_one(compensation)
+    # Payroll in every cached report depends on the rates
+    await clear_reports(db)
     compensation.pop("_id", None)
     return compensation
 
@@ -1297,6 +1759,7 @@ async def update_compensation(comp_id: str, request: Request):
     
     if update_dict:
         await db.compensi.update_one({"id": comp_id}, {"$set": update_dict})
+        await clear_reports(db)
     
     compensation = await db.compensi.find_one({"id": comp_id}, {"_id": 0})
     if not compensation:
@@ -1311,6 +1774,7 @@ async def delete_compensation(comp_id: str, request: Request):
     result = await db.compensi.delete_one({"id": comp_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Compenso non trovato")
+    await clear_reports(db)
     
     return {"message": "Compenso eliminato"}
 
@@ -1341,33 +1805,20 @@ async def calculate_teacher_compensation(
     comp = await db.compensi.find_one({"insegnante_id": insegnante_id}, {"_id": 0})
     quota = comp["quota_per_presenza"] if comp else 30.0  # Default
     
-    # Get attendance records
-    query = {
-        "insegnante_id": insegnante_id,
-        "data": {
-            "$gte": datetime.fromisoformat(from_date),
-            "$lte": datetime.fromisoformat(to_date)
-        }
-    }
-    
-    records = await db.presenze.find(query, {"_id": 0}).to_list(1000)
-    
-    # Calculate
-    presenti = 0
-    assenti = 0
-    giustificati = 0
-    recuperi = 0
-    
-    for r in records:
-        if r["stato"] == AttendanceStatus.PRESENT.value:
-            presenti += 1
-        elif r["stato"] == AttendanceStatus.ABSENT.value:
-            assenti += 1
-        elif r["stato"] == AttendanceStatus.JUSTIFIED.value:
-            giustificati += 1
-            # Check if there's a recovery date
-            if r.get("recupero_data"):
-                recuperi += 1
+    # Attendance counts: monthly rollups for whole months, presenze for the rest
+    start = datetime.fromisoformat(from_date)
+    pipeline = attendance_pipeline(
+        start,
+        datetime.fromisoformat(to_date),
+        {"insegnante_id": insegnante_id},
+        archived=await reaches_archive(db, "presenze", start)
+    ) + [sum_counts(None)]
+    rows = await db.presenze_mensili.aggregate(pipeline).to_list(1)
+    counts = rows[0] if rows else {}
+    presenti = counts.get("presenti", 0)
+    assenti = counts.get("assenti", 0)
+    giustificati = counts.get("giustificati", 0)
+    recuperi = counts.get("recuperi", 0)
     
     # Compenso = (presenti + assenti + recuperi) * quota
     # Giustificati senza recupero = NON pagati
@@ -1411,20 +1862,35 @@ async def update_overdue_payments(request: Request):
     # Get payments and check tolerance
     payments = await db.pagamenti.find(query, {"_id": 0}).to_list(1000)
     
-    updated_count = 0
+    overdue = []
     for payment in payments:
         tolerance = payment.get("tolleranza_giorni", PAYMENT_TOLERANCE_DAYS)
         due_date = payment["data_scadenza"]
+        if due_date.tzinfo is None:
+            due_date = due_date.replace(tzinfo=timezone.utc)
         
         # Add tolerance days
         actual_due_date = due_date + timedelta(days=tolerance)
         
         if today > actual_due_date:
-            await db.pagamenti.update_one(
-                {"id": payment["id"]},
-                {"$set": {"stato": PaymentStatus.OVERDUE.value}}
-            )
-            updated_count += 1
+            overdue.append(payment)
+    
+    # One conditional update per payment: one paid (or already flagged) since it was
+    # read is not touched, and only the payments moved here reach the balances
+    now = datetime.now(timezone.utc)
+    
+    async def flag(payment: dict) -> Optional[dict]:
+        return await db.pagamenti.find_one_and_update(
+            {"id": payment["id"], "stato": PaymentStatus.PENDING.value},
+            {"$set": {"stato": PaymentStatus.OVERDUE.value, "data_modifica": now}, "$inc": {"versione": 1}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    
+    flagged = [before for before in await asyncio.gather(*(flag(p) for p in overdue)) if before is not None]
+    if flagged:
+        await record_payment_changes([(p, {**p, "stato": PaymentStatus.OVERDUE.value}) for p in flagged])
+    updated_count = len(flagged)
     
     return {
         "message": f"Aggiornati {updated_count} pagamenti a SCADUTO",
@@ -1462,17 +1928,18 @@ async def create_monthly_payments(request: Request):
         "attivo": True
     }, {"_id": 0}).to_list(500)
     
-    created_count = 0
+    # Students that already have a payment for this month, in one query
+    existing = await db.pagamenti.find({
+        "utente_id": {"$in": [s["id"] for s in students]},
+        "tipo": PaymentType.MONTHLY.value,
+        "descrizione": {"$regex": mese}
+    }, {"_id": 0, "utente_id": 1}).to_list(None)
+    already_billed = {p["utente_id"] for p in existing}
+    
+    payments = []
     for student in students:
-        # Check if payment already exists for this month
-        existing = await db.pagamenti.find_one({
-            "utente_id": student["id"],
-            "tipo": PaymentType.MONTHLY.value,
-            "descrizione": {"$regex": mese}
-        })
-        
-        if not existing:
-            payment = {
+        if student["id"] not in already_billed:
+            payments.append({
                 "id": str(uuid.uuid4()),
                 "utente_id": student["id"],
                 "tipo": PaymentType.MONTHLY.value,
@@ -1483,10 +1950,14 @@ async def create_monthly_payments(request: Request):
                 "data_pagamento": None,
                 "tolleranza_giorni": PAYMENT_TOLERANCE_DAYS,
                 "visibile_utente": True,
-                "data_creazione": datetime.now(timezone.utc)
-            }
-            await db.pagamenti.insert_one(payment)
-            created_count += 1
+                "data_creazione": datetime.now(timezone.utc),
+                "data_modifica": datetime.now(timezone.utc)
+            })
+    
+    if payments:
+        await db.pagamenti.insert_many(payments)
+        await record_payment_changes([(None, p) for p in payments])
+    created_count = len(payments)
     
     return {
         "message": f"Creati {created_count} pagamenti mensili per {mese}",
@@ -1530,7 +2001,8 @@ async def create_payment_reminders(request: Request):
         "destinatari_ids": user_ids,
         "filtro_pagamento": tipo_avviso,
         "attivo": True,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.notifiche.insert_one(notification)
@@ -1567,8 +2039,9 @@ async def get_expiring_payments(
     payments = await db.pagamenti.find(query, {"_id": 0}).to_list(500)
     
     # Add user info
+    users = await reference_data.users_by_id(payment.get("utente_id") for payment in payments)
     for payment in payments:
-        user = await db.utenti.find_one({"id": payment["utente_id"]}, {"_id": 0, "password_hash": 0})
+        user = users.get(payment.get("utente_id"))
         if user:
             payment["utente"] = {"nome": user["nome"], "cognome": user["cognome"], "email": user["email"]}
     
@@ -1577,6 +2050,23 @@ async def get_expiring_payments(
         "payments": payments
     }
 
+@api_router.post("/automazioni/archivia-anni-chiusi")
+async def archive_closed_academic_years(request: Request, dry_run: bool = False):
+    """
+    Move presenze, paid pagamenti and inactive notifiche of the closed academic
+    years to the archive collections (same job as `python archive.py`). Admin only.
+    """
+    await require_admin(request)
+    
+    result = await archive_closed_years(db, dry_run=dry_run)
+    if not dry_run:
+        clear_analytics_cache()
+    total = sum(result["documenti"].values())
+    return {
+        "message": f"{total} documenti {'da archiviare' if dry_run else 'archiviati'}",
+        **result
+    }
+
 # ===================== SETTINGS API =====================
 
 @api_router.get("/impostazioni")
@@ -1584,7 +2074,7 @@ async def get_settings(request: Request):
     """Get system settings (Admin only)"""
     await require_admin(request)
     
-    settings = await db.impostazioni.find_one({}, {"_id": 0})
+    settings = await reference_data.settings()
     if not settings:
         # Default settings
         settings = {
@@ -1594,8 +2084,10 @@ async def get_settings(request: Request):
             "annual_reminder_days": 30
         }
         await db.impostazioni.insert_one(settings)
+        await invalidation_bus.notify("impostazioni")
+        settings.pop("_id", None)
     
-    return settings
+    return dict(settings)
 
 @api_router.put("/impostazioni")
 async def update_settings(request: Request):
@@ -1616,6 +2108,7 @@ async def update_settings(request: Request):
     
     if update_dict:
         await db.impostazioni.update_one({}, {"$set": update_dict}, upsert=True)
+        await invalidation_bus.notify("impostazioni")
     
     return await db.impostazioni.find_one({}, {"_id": 0})
 
@@ -1625,10 +2118,12 @@ async def update_settings(request: Request):
 async def get_assignments(
     request: Request,
     allievo_id: Optional[str] = None,
-    completato: Optional[bool] = None
+    completato: Optional[bool] = None,
+    fields: Optional[str] = None
 ):
     """Get assignments"""
     current_user = await require_auth(request)
+    fields_projection = list_projection("compiti", current_user, fields)
     
     query = {}
     
@@ -1646,7 +2141,7 @@ async def get_assignments(
     if completato is not None:
         query["completato"] = completato
     
-    assignments = await db.compiti.find(query, {"_id": 0}).sort("data_scadenza", 1).to_list(500)
+    assignments = await db.compiti.find(query, fields_projection).sort("data_scadenza", 1).to_list(500)
     return assignments
 
 @api_router.post("/compiti")
@@ -1662,7 +2157,8 @@ async def create_assignment(assignment_data: AssignmentCreate, request: Request)
         "descrizione": assignment_data.descrizione,
         "data_scadenza": datetime.fromisoformat(assignment_data.data_scadenza),
         "completato": False,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.compiti.insert_one(assignment)
@@ -1670,22 +2166,18 @@ async def create_assignment(assignment_data: AssignmentCreate, request: Request)
     return assignment
 
 @api_router.put("/compiti/{assignment_id}")
-async def update_assignment(assignment_id: str, request: Request):
+async def update_assignment(assignment_id: str, request: Request, response: Response):
     """Update assignment"""
     current_user = await require_auth(request)
     
     body = await request.json()
     
-    existing = await db.compiti.find_one({"id": assignment_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Compito non trovato")
-    
     update_dict = {}
+    scope = None
     
-    # Students can only mark as completed
+    # Students can only mark their own assignments as completed
     if current_user["ruolo"] == UserRole.STUDENT.value:
-        if current_user["id"] != existing["allievo_id"]:
-            raise HTTPException(status_code=403, detail="Non autorizzato")
+        scope = {"allievo_id": current_user["id"]}
         if "completato" in body:
             update_dict["completato"] = body["completato"]
     else:
@@ -1700,33 +2192,37 @@ async def update_assignment(assignment_id: str, request: Request):
             update_dict["completato"] = body["completato"]
     
     if update_dict:
-        await db.compiti.update_one({"id": assignment_id}, {"$set": update_dict})
+        update_dict["data_modifica"] = datetime.now(timezone.utc)
     
-    return await db.compiti.find_one({"id": assignment_id}, {"_id": 0})
+    assignment = await versioned_update(
+        "compiti", assignment_id, update_dict, request, "Compito non trovato", scope=scope
+    )
+    set_etag(response, assignment)
+    return assignment
 
 @api_router.delete("/compiti/{assignment_id}")
 async def delete_assignment(assignment_id: str, request: Request):
     """Delete assignment"""
     await require_teacher_or_admin(request)
     
-    result = await db.compiti.delete_one({"id": assignment_id})
-    if result.deleted_count == 0:
+    deleted = await db.compiti.find_one_and_delete({"id": assignment_id}, projection={"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Compito non trovato")
+    await record_deletions(db, "compiti", [deleted])
     
     return {"message": "Compito eliminato"}
 
 # ===================== PAYMENT ROUTES =====================
 
-@api_router.get("/pagamenti")
-async def get_payments(
-    request: Request,
+def payments_query(
+    current_user: dict,
     utente_id: Optional[str] = None,
     tipo: Optional[str] = None,
-    stato: Optional[str] = None
-):
-    """Get payments"""
-    current_user = await require_auth(request)
-    
+    stato: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
+) -> dict:
+    """Payment filter for the current user, shared by the list and the export"""
     query = {}
     
     # Non-admin users can only see their own payments
@@ -1741,8 +2237,30 @@ async def get_payments(
         query["tipo"] = tipo
     if stato:
         query["stato"] = stato
+    # Due-date range
+    if from_date:
+        query["data_scadenza"] = {"$gte": datetime.fromisoformat(from_date)}
+    if to_date:
+        query.setdefault("data_scadenza", {})["$lte"] = datetime.fromisoformat(to_date)
+    
+    return query
+
+@api_router.get("/pagamenti")
+async def get_payments(
+    request: Request,
+    utente_id: Optional[str] = None,
+    tipo: Optional[str] = None,
+    stato: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Get payments (archived years are included when from_date reaches them)"""
+    current_user = await require_auth(request)
+    fields_projection = list_projection("pagamenti", current_user, fields)
     
-    payments = await db.pagamenti.find(query, {"_id": 0}).sort("data_scadenza", 1).to_list(1000)
+    query = payments_query(current_user, utente_id, tipo, stato, from_date, to_date)
+    payments = await find_across(db, "pagamenti", query, fields_projection, sort=1, limit=1000)
     return payments
 
 @api_router.post("/pagamenti")
@@ -1759,23 +2277,20 @@ async def create_payment(payment_data: PaymentCreate, request: Request):
         "data_scadenza": datetime.fromisoformat(payment_data.data_scadenza),
         "stato": PaymentStatus.PENDING.value,
         "visibile_utente": True,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.pagamenti.insert_one(payment)
     payment.pop("_id", None)
+    await record_payment_changes([(None, payment)])
     return payment
 
 @api_router.put("/pagamenti/{payment_id}")
-async def update_payment(payment_id: str, request: Request):
+async def update_payment(payment_id: str, request: Request, response: Response):
     """Update payment (Admin only)"""
     await require_admin(request)
     
-    # Verifica che il pagamento esista
-    existing = await db.pagamenti.find_one({"id": payment_id}, {"_id": 0})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Pagamento non trovato")
-    
     body = await request.json()
     logger.info(f"Aggiornamento pagamento {payment_id}: {body}")
     
@@ -1796,10 +2311,15 @@ async def update_payment(payment_id: str, request: Request):
         update_dict["visibile_utente"] = body["visibile_utente"]
     
     if update_dict:
-        result = await db.pagamenti.update_one({"id": payment_id}, {"$set": update_dict})
-        logger.info(f"Update result: modified_count={result.modified_count}")
+        update_dict["data_modifica"] = datetime.now(timezone.utc)
     
-    payment = await db.pagamenti.find_one({"id": payment_id}, {"_id": 0})
+    existing = await versioned_update(
+        "pagamenti", payment_id, update_dict, request, "Pagamento non trovato", before=True
+    )
+    payment = updated_from(existing, update_dict)
+    if update_dict:
+        await record_payment_changes([(existing, payment)])
+    set_etag(response, payment)
     return payment
 
 @api_router.delete("/pagamenti/{payment_id}")
@@ -1807,35 +2327,204 @@ async def delete_payment(payment_id: str, request: Request):
     """Delete payment (Admin only)"""
     await require_admin(request)
     
-    result = await db.pagamenti.delete_one({"id": payment_id})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Pagamento non trovato")
+    deleted = await db.pagamenti.find_one_and_delete({"id": payment_id}, projection={"_id": 0})
+    if not deleted:
+        await not_found_or_archived("pagamenti", payment_id, "Pagamento non trovato")
     
+    await record_deletions(db, "pagamenti", [deleted])
+    await record_payment_changes([(deleted, None)])
     return {"message": "Pagamento eliminato"}
 
+@api_router.get("/saldi/{utente_id}")
+async def get_balance(utente_id: str, request: Request):
+    """
+    Financial position of a user: outstanding, overdue, paid this year, next
+    due date. Users can read their own balance, admins anyone's.
+    """
+    current_user = await require_auth(request)
+    if current_user["ruolo"] != UserRole.ADMIN.value and current_user["id"] != utente_id:
+        raise HTTPException(status_code=403, detail="Non autorizzato")
+    
+    ledger = await db.saldi.find_one({"utente_id": utente_id}, {"_id": 0})
+    return balance_view(ledger, utente_id)
+
+# ===================== RECONCILIATION ROUTES =====================
+
+async def apply_reconciliation(reconciliation_id: str, matches: List[dict]) -> List[str]:
+    """
+    Mark the matched payments as paid on the transaction date; returns the ids
+    of the payments this call moved to paid. Each payment is updated on its own,
+    conditionally on its open state, so a payment paid meanwhile (by hand or by
+    a concurrent confirmation) is neither counted twice in the balances nor
+    listed as applied by this run.
+    """
+    open_states = [PaymentStatus.PENDING.value, PaymentStatus.OVERDUE.value]
+    now = datetime.now(timezone.utc)
+    
+    async def pay(match: dict) -> Optional[dict]:
+        return await db.pagamenti.find_one_and_update(
+            {"id": match["pagamento_id"], "stato": {"$in": open_states}},
+            {
+                "$set": {
+                    "stato": PaymentStatus.PAID.value,
+                    "data_pagamento": match["transazione"]["data"],
+                    "riconciliazione_id": reconciliation_id,
+                    "data_modifica": now
+                },
+                "$inc": {"versione": 1}
+            },
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+    
+    befores = await asyncio.gather(*(pay(m) for m in matches))
+    applied = [(m, before) for m, before in zip(matches, befores) if before is not None]
+    if not applied:
+        return []
+    await record_payment_changes([
+        (before, {**before, "stato": PaymentStatus.PAID.value, "data_pagamento": m["transazione"]["data"]})
+        for m, before in applied
+    ])
+    applied_ids = [m["pagamento_id"] for m, _ in applied]
+    await db.riconciliazioni.update_one(
+        {"id": reconciliation_id},
+        {"$addToSet": {"applicati": {"$each": applied_ids}}}
+    )
+    return applied_ids
+
+@api_router.post("/riconciliazioni")
+async def create_reconciliation(request: Request, file: UploadFile = File(...), applica_certi: bool = False):
+    """
+    Match a bank statement (CSV or CAMT.053) against pending/overdue fees (Admin only).
+    Returns the proposed matches; with applica_certi the certain ones are applied at once.
+    """
+    current_user = await require_admin(request)
+    
+    try:
+        transactions = parse_statement(file.filename, await file.read())
+    except StatementError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Open fees and their students' names, one query each
+    payments = await db.pagamenti.find(
+        {
+            "stato": {"$in": [PaymentStatus.PENDING.value, PaymentStatus.OVERDUE.value]},
+            "tipo": {"$in": [PaymentType.MONTHLY.value, PaymentType.ANNUAL.value]}
+        },
+        {"_id": 0, "id": 1, "utente_id": 1, "importo": 1, "data_scadenza": 1, "descrizione": 1}
+    ).to_list(None)
+    users = await db.utenti.find(
+        {"id": {"$in": list({p["utente_id"] for p in payments})}},
+        {"_id": 0, "id": 1, "nome": 1, "cognome": 1}
+    ).to_list(None)
+    names = {u["id"]: (u["nome"], u["cognome"]) for u in users}
+    
+    started = datetime.now(timezone.utc)
+    matches, unmatched = match_transactions(transactions, PaymentIndex(payments, names))
+    for match in matches:
+        match["nome"] = " ".join(names.get(match["utente_id"], ("", "")))
+    
+    reconciliation = {
+        "id": str(uuid.uuid4()),
+        "file": file.filename,
+        "movimenti": len(transactions),
+        "abbinamenti": matches,
+        "non_abbinati": unmatched,
+        "applicati": [],
+        "creato_da": current_user["id"],
+        "data_creazione": started
+    }
+    await db.riconciliazioni.insert_one(reconciliation)
+    reconciliation.pop("_id", None)
+    logger.info(
+        f"Riconciliazione {reconciliation['id']}: {len(transactions)} movimenti, "
+        f"{len(matches)} abbinati in {(datetime.now(timezone.utc) - started).total_seconds():.2f}s"
+    )
+    
+    if applica_certi:
+        certain = [m for m in matches if m["esito"] == "certo"]
+        reconciliation["applicati"] = await apply_reconciliation(reconciliation["id"], certain)
+    
+    return reconciliation
+
+@api_router.get("/riconciliazioni/{reconciliation_id}")
+async def get_reconciliation(reconciliation_id: str, request: Request):
+    """Get a reconciliation run with its matches (Admin only)"""
+    await require_admin(request)
+    
+    reconciliation = await db.riconciliazioni.find_one({"id": reconciliation_id}, {"_id": 0})
+    if not reconciliation:
+        raise HTTPException(status_code=404, detail="Riconciliazione non trovata")
+    return reconciliation
+
+@api_router.post("/riconciliazioni/{reconciliation_id}/conferma")
+async def confirm_reconciliation(reconciliation_id: str, request: Request):
+    """
+    Apply the confirmed matches of a reconciliation run (Admin only).
+    Body: {"pagamento_ids": [...]}; without it every "certo" match is applied.
+    """
+    await require_admin(request)
+    
+    reconciliation = await db.riconciliazioni.find_one({"id": reconciliation_id}, {"_id": 0})
+    if not reconciliation:
+        raise HTTPException(status_code=404, detail="Riconciliazione non trovata")
+    
+    body = await request.json() if await request.body() else {}
+    confirmed = body.get("pagamento_ids")
+    matches = reconciliation["abbinamenti"]
+    if confirmed is None:
+        matches = [m for m in matches if m["esito"] == "certo"]
+    else:
+        matches = [m for m in matches if m["pagamento_id"] in set(confirmed)]
+    already = set(reconciliation.get("applicati", []))
+    matches = [m for m in matches if m["pagamento_id"] not in already]
+    
+    updated = len(await apply_reconciliation(reconciliation_id, matches))
+    return {
+        "message": f"Registrati {updated} pagamenti",
+        "updated_count": updated,
+        "non_aggiornati": len(matches) - updated
+    }
+
 # ===================== NOTIFICATION ROUTES =====================
 
 @api_router.get("/notifiche")
 async def get_notifications(
     request: Request,
-    attivo_only: bool = True
+    attivo_only: bool = True,
+    fields: Optional[str] = None
 ):
     """Get notifications"""
     current_user = await require_auth(request)
+    fields_projection = list_projection("notifiche", current_user, fields)
     
     query = {}
     if attivo_only:
         query["attivo"] = True
-    
-    # Filter by recipient
-    if current_user["ruolo"] != UserRole.ADMIN.value:
-        query["$or"] = [
-            {"destinatari_ids": {"$size": 0}},  # All users
-            {"destinatari_ids": current_user["id"]}
-        ]
-    
-    notifications = await db.notifiche.find(query, {"_id": 0}).sort("data_creazione", -1).to_list(100)
-    return notifications
+    is_admin = current_user["ruolo"] == UserRole.ADMIN.value
+    
+    if not attivo_only:
+        # Filter by recipient
+        if not is_admin:
+            query["$or"] = [
+                {"destinatari_ids": {"$size": 0}},  # All users
+                {"destinatari_ids": current_user["id"]}
+            ]
+        return await find_across(db, "notifiche", query, fields_projection, sort=-1, limit=100)
+    
+    # Only inactive notifications are ever archived. The active ones for everybody
+    # are the same for every user: one shared read, plus the user's own ones
+    newest = [("data_creazione", -1)]
+    if is_admin:
+        return await shared_find(db.notifiche, query, fields_projection, newest, 100)
+    broadcast = await shared_find(
+        db.notifiche, {**query, "destinatari_ids": {"$size": 0}}, fields_projection, newest, 100
+    )
+    targeted = await db.notifiche.find(
+        {**query, "destinatari_ids": current_user["id"]}, fields_projection
+    ).sort(newest).to_list(100)
+    notifications = sorted(broadcast + targeted, key=lambda n: n["data_creazione"], reverse=True)
+    return notifications[:100]
 
 @api_router.post("/notifiche")
 async def create_notification(notif_data: NotificationCreate, request: Request):
@@ -1851,7 +2540,8 @@ async def create_notification(notif_data: NotificationCreate, request: Request):
         "destinatari_ids": notif_data.destinatari_ids,
         "filtro_pagamento": notif_data.filtro_pagamento,
         "attivo": True,
-        "data_creazione": datetime.now(timezone.utc)
+        "data_creazione": datetime.now(timezone.utc),
+        "data_modifica": datetime.now(timezone.utc)
     }
     
     await db.notifiche.insert_one(notification)
@@ -1859,7 +2549,7 @@ async def create_notification(notif_data: NotificationCreate, request: Request):
     return notification
 
 @api_router.put("/notifiche/{notification_id}")
-async def update_notification(notification_id: str, request: Request):
+async def update_notification(notification_id: str, request: Request, response: Response):
     """Update notification (Admin only)"""
     await require_admin(request)
     
@@ -1874,11 +2564,10 @@ async def update_notification(notification_id: str, request: Request):
         update_dict["attivo"] = body["attivo"]
     
     if update_dict:
-        await db.notifiche.update_one({"id": notification_id}, {"$set": update_dict})
+        update_dict["data_modifica"] = datetime.now(timezone.utc)
     
-    notification = await db.notifiche.find_one({"id": notification_id}, {"_id": 0})
-    if not notification:
-        raise HTTPException(status_code=404, detail="Notifica non trovata")
+    notification = await versioned_update("notifiche", notification_id, update_dict, request, "Notifica non trovata")
+    set_etag(response, notification)
     return notification
 
 @api_router.delete("/notifiche/{notification_id}")
@@ -1886,48 +2575,329 @@ async def delete_notification(notification_id: str, request: Request):
     """Delete notification (Admin only)"""
     await require_admin(request)
     
-    result = await db.notifiche.delete_one({"id": notification_id})
-    if result.deleted_count == 0:
+    deleted = await db.notifiche.find_one_and_delete({"id": notification_id}, projection={"_id": 0})
+    if not deleted:
         raise HTTPException(status_code=404, detail="Notifica non trovata")
+    await record_deletions(db, "notifiche", [deleted])
     
     return {"message": "Notifica eliminata"}
 
+# ===================== EXPORT ROUTES =====================
+
+EXPORT_BATCH_SIZE = 1000
+
+async def streaming_export(rows, formato: str, columns: list, filename: str) -> StreamingResponse:
+    if formato not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato non supportato (csv | ndjson | parquet)")
+    try:
+        body = await export_stream(rows, formato, columns)
+    except ExportUnavailable as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    
+    media_type, extension = EXPORT_FORMATS[formato]
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d")
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}-{stamp}.{extension}"'}
+    )
+
+@api_router.get("/export/presenze")
+async def export_attendance(
+    request: Request,
+    formato: str = "csv",
+    allievo_id: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
+):
+    """Stream attendance records as CSV, NDJSON or Parquet (same filters as /presenze)"""
+    current_user = await require_auth(request)
+    
+    query = attendance_query(current_user, allievo_id, from_date, to_date)
+    rows = stream_across(db, "presenze", query, {"_id": 0}, EXPORT_BATCH_SIZE)
+    return await streaming_export(rows, formato, PRESENZE_COLUMNS, "presenze")
+
+@api_router.get("/export/pagamenti")
+async def export_payments(
+    request: Request,
+    formato: str = "csv",
+    utente_id: Optional[str] = None,
+    tipo: Optional[str] = None,
+    stato: Optional[str] = None,
+    from_date: Optional[str] = None,
+    to_date: Optional[str] = None
+):
+    """Stream payments as CSV, NDJSON or Parquet (same filters as /pagamenti)"""
+    current_user = await require_auth(request)
+    
+    query = payments_query(current_user, utente_id, tipo, stato, from_date, to_date)
+    rows = stream_across(db, "pagamenti", query, {"_id": 0}, EXPORT_BATCH_SIZE)
+    return await streaming_export(rows, formato, PAGAMENTI_COLUMNS, "pagamenti")
+
+@api_router.get("/export/compensi")
+async def export_compensations(
+    request: Request,
+    from_date: str,
+    to_date: str,
+    formato: str = "csv",
+    insegnante_id: Optional[str] = None
+):
+    """
+    Stream the compensation report of every teacher for a period, with the same
+    rules as /compensi/calcolo/{insegnante_id}, computed in one aggregation.
+    """
+    current_user = await require_teacher_or_admin(request)
+    
+    match = {}
+    # Teachers can only export their own report
+    if current_user["ruolo"] == UserRole.TEACHER.value:
+        match["insegnante_id"] = current_user["id"]
+    elif insegnante_id:
+        match["insegnante_id"] = insegnante_id
+    
+    start = datetime.fromisoformat(from_date)
+    pipeline = attendance_pipeline(
+        start,
+        datetime.fromisoformat(to_date),
+        match,
+        archived=await reaches_archive(db, "presenze", start)
+    ) + payroll_stages()
+    cursor = db.presenze_mensili.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)
+    return await streaming_export(cursor, formato, COMPENSI_COLUMNS, "compensi")
+
+# ===================== ENROLLMENT ROUTES =====================
+
+@api_router.get("/iscrizioni")
+async def get_enrollments(
+    request: Request,
+    allievo_id: Optional[str] = None,
+    corso_id: Optional[str] = None,
+    insegnante_id: Optional[str] = None,
+    attive: bool = True
+):
+    """Get enrollments (Admin only)"""
+    await require_admin(request)
+    
+    query = active_enrollment_filter() if attive else {}
+    if allievo_id:
+        query["allievo_id"] = allievo_id
+    if corso_id:
+        query["corso_id"] = corso_id
+    if insegnante_id:
+        query["insegnante_id"] = insegnante_id
+    
+    enrollments = await db.iscrizioni.find(query, {"_id": 0}).to_list(1000)
+    return enrollments
+
+@api_router.post("/iscrizioni")
+async def create_enrollment(enrollment_data: EnrollmentCreate, request: Request):
+    """Enroll a student in a course or with a teacher (Admin only)"""
+    await require_admin(request)
+    
+    insegnante_id = enrollment_data.insegnante_id
+    if enrollment_data.corso_id:
+        course = await db.corsi.find_one({"id": enrollment_data.corso_id}, {"_id": 0, "insegnante_id": 1})
+        if not course:
+            raise HTTPException(status_code=404, detail="Corso non trovato")
+        insegnante_id = insegnante_id or course["insegnante_id"]
+    if not insegnante_id:
+        raise HTTPException(status_code=400, detail="Specificare corso_id o insegnante_id")
+    
+    student = await db.utenti.find_one({"id": enrollment_data.allievo_id, "ruolo": UserRole.STUDENT.value}, {"_id": 0, "id": 1})
+    if not student:
+        raise HTTPException(status_code=404, detail="Allievo non trovato")
+    
+    now = datetime.now(timezone.utc)
+    enrollment = {
+        "id": str(uuid.uuid4()),
+        "allievo_id": enrollment_data.allievo_id,
+        "corso_id": enrollment_data.corso_id,
+        "insegnante_id": insegnante_id,
+        "data_inizio": datetime.fromisoformat(enrollment_data.data_inizio) if enrollment_data.data_inizio else now,
+        "data_fine": datetime.fromisoformat(enrollment_data.data_fine) if enrollment_data.data_fine else None,
+        "data_creazione": now
+    }
+    
+    await db.iscrizioni.insert_one(enrollment)
+    enrollment.pop("_id", None)
+    return enrollment
+
+@api_router.put("/iscrizioni/{enrollment_id}")
+async def update_enrollment(enrollment_id: str, enrollment_data: EnrollmentUpdate, request: Request):
+    """Change the validity dates of an enrollment, e.g. to close it (Admin only)"""
+    await require_admin(request)
+    
+    update_dict = {}
+    if enrollment_data.data_inizio is not None:
+        update_dict["data_inizio"] = datetime.fromisoformat(enrollment_data.data_inizio)
+    if enrollment_data.data_fine is not None:
+        update_dict["data_fine"] = datetime.fromisoformat(enrollment_data.data_fine) if enrollment_data.data_fine else None
+    
+    if update_dict:
+        await db.iscrizioni.update_one({"id": enrollment_id}, {"$set": update_dict})
+    
+    enrollment = await db.iscrizioni.find_one({"id": enrollment_id}, {"_id": 0})
+    if not enrollment:
+        raise HTTPException(status_code=404, detail="Iscrizione non trovata")
+    return enrollment
+
+@api_router.delete("/iscrizioni/{enrollment_id}")
+async def delete_enrollment(enrollment_id: str, request: Request):
+    """Delete enrollment (Admin only)"""
+    await require_admin(request)
+    
+    result = await db.iscrizioni.delete_one({"id": enrollment_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Iscrizione non trovata")
+    
+    return {"message": "Iscrizione eliminata"}
+
+@api_router.get("/corsi/{course_id}/allievi")
+async def get_course_students(course_id: str, request: Request):
+    """Students currently enrolled in a course (teacher of the course or Admin)"""
+    current_user = await require_teacher_or_admin(request)
+    
+    match = {"corso_id": course_id, **active_enrollment_filter()}
+    if current_user["ruolo"] == UserRole.TEACHER.value:
+        match["insegnante_id"] = current_user["id"]
+    
+    return await db.iscrizioni.aggregate(enrolled_students_pipeline(match)).to_list(1000)
+
+@api_router.get("/allievi/{student_id}/corsi")
+async def get_student_courses(student_id: str, request: Request):
+    """Courses a student is currently enrolled in (the student or Admin/Teacher)"""
+    current_user = await require_auth(request)
+    
+    if current_user["ruolo"] == UserRole.STUDENT.value and current_user["id"] != student_id:
+        raise HTTPException(status_code=403, detail="Accesso negato")
+    
+    pipeline = [
+        {"$match": {"allievo_id": student_id, "corso_id": {"$ne": None}, **active_enrollment_filter()}},
+        {"$lookup": {"from": "corsi", "localField": "corso_id", "foreignField": "id", "as": "corso"}},
+        {"$unwind": "$corso"},
+        {"$addFields": {"corso.iscrizione": {"id": "$id", "data_inizio": "$data_inizio", "data_fine": "$data_fine"}}},
+        {"$replaceRoot": {"newRoot": "$corso"}},
+        {"$project": {"_id": 0}}
+    ]
+    return await db.iscrizioni.aggregate(pipeline).to_list(100)
+
 # ===================== TEACHER STUDENTS =====================
 
 @api_router.get("/insegnante/allievi")
-async def get_teacher_students(request: Request):
-    """Get students for teacher based on specialization"""
+async def get_teacher_students(request: Request, insegnante_id: Optional[str] = None):
+    """Get the students enrolled with a teacher (all active students for Admin)"""
     current_user = await require_teacher_or_admin(request)
     
-    query = {"ruolo": UserRole.STUDENT.value, "attivo": True}
-    
-    # If teacher, filter by specialization
     if current_user["ruolo"] == UserRole.TEACHER.value:
-        teacher_detail = await db.insegnanti_dettaglio.find_one({"utente_id": current_user["id"]}, {"_id": 0})
-        if teacher_detail and teacher_detail.get("specializzazione"):
-            # Get students with same course
-            student_ids = []
-            student_details = await db.allievi_dettaglio.find({
-                "corso_principale": teacher_detail["specializzazione"]
-            }, {"_id": 0}).to_list(500)
-            student_ids = [d["utente_id"] for d in student_details]
-            if student_ids:
-                query["id"] = {"$in": student_ids}
-            else:
-                return []  # No students match
-    
-    students = await db.utenti.find(query, {"_id": 0, "password_hash": 0}).to_list(500)
-    
-    # Add details
-    for student in students:
-        detail = await db.allievi_dettaglio.find_one({"utente_id": student["id"]}, {"_id": 0})
-        if detail:
-            student["dettaglio"] = detail
+        insegnante_id = current_user["id"]
     
+    if insegnante_id:
+        match = {"insegnante_id": insegnante_id, **active_enrollment_filter()}
+        return await db.iscrizioni.aggregate(enrolled_students_pipeline(match)).to_list(1000)
+    
+    students = await db.utenti.find(
+        {"ruolo": UserRole.STUDENT.value, "attivo": True},
+        {"_id": 0, "password_hash": 0}
+    ).to_list(500)
     return students
 
+# ===================== FINANCIAL REPORT =====================
+
+@api_router.get("/report/finanziario")
+async def get_financial_report(request: Request, da: str, a: str, aggiorna: bool = False):
+    """
+    Revenue, outstanding and overdue fees, revenue by instrument and teacher
+    payroll for the months da..a (YYYY-MM, inclusive). Admin only.
+    Cached per period until payments or attendance of those months change.
+    """
+    await require_admin(request)
+    
+    try:
+        start, end = period_bounds(da, a)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Periodo non valido: {e}")
+    
+    if not aggiorna:
+        report = await cached_report(db, da, a)
+        if report:
+            return {**report, "cache": True}
+    
+    months = months_between(start, end)
+    generation = await report_generation(db, months)
+    archived = await reaches_archive(db, "pagamenti", start)
+    facets = await db.pagamenti.aggregate(
+        financial_report_pipeline(start, end, archived), allowDiskUse=True
+    ).to_list(1)
+    report = {
+        "periodo": {"da": da, "a": a},
+        **summarize_report(facets[0]),
+        "generato_il": datetime.now(timezone.utc)
+    }
+    await store_report(db, da, a, months, report, generation)
+    return {**report, "cache": False}
+
+# ===================== ANALYTICS =====================
+
+@api_router.get("/analytics/allievi")
+async def get_student_analytics(
+    request: Request,
+    mesi: int = 12,
+    livello: Optional[str] = None,
+    limit: int = 200,
+    aggiorna: bool = False
+):
+    """
+    Dropout-risk indicators of every active student (absence rate and streaks,
+    justified lessons never recovered, late payments), highest risk first.
+    Admin only; the whole-school analysis is cached for ANALYTICS_CACHE_TTL.
+    """
+    await require_admin(request)
+    
+    if not 1 <= mesi <= 36:
+        raise HTTPException(status_code=400, detail="mesi deve essere tra 1 e 36")
+    
+    analysis, cached = await cached_student_analytics(db, mesi, refresh=aggiorna)
+    students = analysis["allievi"]
+    if livello:
+        students = [s for s in students if s["livello_rischio"] == livello]
+    return {**analysis, "allievi": students[:limit], "cache": cached}
+
 # ===================== STATS =====================
 
+@api_router.get("/dashboard/allievo")
+async def get_student_dashboard(request: Request, response: Response):
+    """
+    Everything the student home screen shows, in one call: upcoming lessons,
+    open assignments, payments to make, active notifications, teachers
+    """
+    current_user = await require_auth(request)
+    if current_user["ruolo"] != UserRole.STUDENT.value:
+        raise HTTPException(status_code=403, detail="Accesso negato - Solo allievi")
+    
+    dashboard, cached = await cached_dashboard(
+        "allievo", current_user["id"],
+        lambda: student_dashboard(db, reference_data, current_user, active_enrollment_filter())
+    )
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    return dashboard
+
+@api_router.get("/dashboard/insegnante")
+async def get_teacher_dashboard(request: Request, response: Response):
+    """
+    Everything the teacher home screen shows, in one call: today's lessons with
+    their roster, upcoming lessons, open assignments, payments, notifications
+    """
+    current_user = await require_auth(request)
+    if current_user["ruolo"] != UserRole.TEACHER.value:
+        raise HTTPException(status_code=403, detail="Accesso negato - Solo insegnanti")
+    
+    dashboard, cached = await cached_dashboard(
+        "insegnante", current_user["id"],
+        lambda: teacher_dashboard(db, reference_data, current_user, active_enrollment_filter())
+    )
+    response.headers["X-Cache"] = "HIT" if cached else "MISS"
+    return dashboard
+
 @api_router.get("/stats/admin")
 async def get_admin_stats(request: Request):
     """Get admin dashboard statistics"""
@@ -1959,153 +2929,156 @@ async def get_admin_stats(request: Request):
 
 # ===================== SEED DATA =====================
 
+# The endpoint is unauthenticated (it runs on an empty database): large datasets only via seed_data.py
+SEED_API_MAX = {"allievi": 200, "insegnanti": 20, "presenze": 5000}
+
+
 @api_router.post("/seed")
-async def seed_database():
-    """Seed database with sample data"""
+async def seed_database(
+    allievi: int = Query(DEMO_SCALE["allievi"], ge=0, le=SEED_API_MAX["allievi"]),
+    insegnanti: int = Query(DEMO_SCALE["insegnanti"], ge=0, le=SEED_API_MAX["insegnanti"]),
+    presenze: int = Query(DEMO_SCALE["presenze"], ge=0, le=SEED_API_MAX["presenze"])
+):
+    """Seed database with demo accounts and optional synthetic data"""
     # Check if already seeded
     existing = await db.utenti.count_documents({})
     if existing > 3:
         return {"message": "Database già popolato", "status": "skipped"}
     
-    # Create default admin with email/password
-    admin_id = str(uuid.uuid4())
-    admin = {
-        "id": admin_id,
-        "ruolo": UserRole.ADMIN.value,
-        "nome": "Admin",
-        "cognome": "Accademia",
-        "email": "acc.imusici@gmail.com",
-        "password_hash": hash_password("Accademia2026"),
-        "attivo": True,
-        "data_creazione": datetime.now(timezone.utc),
-        "ultimo_accesso": None,
-        "note_admin": "Account amministratore principale"
-    }
-    await db.utenti.insert_one(admin)
-    
-    # Create sample teachers
-    teachers = [
-        {"nome": "Mario", "cognome": "Rossi", "email": "mario.rossi@musici.it", "spec": "pianoforte", "compenso": 30.0},
-        {"nome": "Lucia", "cognome": "Bianchi", "email": "lucia.bianchi@musici.it", "spec": "violino", "compenso": 35.0},
-        {"nome": "Paolo", "cognome": "Verdi", "email": "paolo.verdi@musici.it", "spec": "chitarra", "compenso": 28.0},
-        {"nome": "Anna", "cognome": "Neri", "email": "anna.neri@musici.it", "spec": "canto", "compenso": 32.0},
-    ]
-    
-    teacher_ids = []
-    for t in teachers:
-        teacher_id = str(uuid.uuid4())
-        teacher_ids.append(teacher_id)
-        teacher = {
-            "id": teacher_id,
-            "ruolo": UserRole.TEACHER.value,
-            "nome": t["nome"],
-            "cognome": t["cognome"],
-            "email": t["email"],
-            "password_hash": hash_password("teacher123"),
-            "attivo": True,
-            "data_creazione": datetime.now(timezone.utc),
-            "ultimo_accesso": None,
-            "note_admin": None
-        }
-        await db.utenti.insert_one(teacher)
-        
-        # Teacher detail
-        detail = {
-            "id": str(uuid.uuid4()),
-            "utente_id": teacher_id,
-            "specializzazione": t["spec"],
-            "compenso_orario": t["compenso"],
-            "note": None
-        }
-        await db.insegnanti_dettaglio.insert_one(detail)
-    
-    # Create sample students
-    students = [
-        {"nome": "Giulia", "cognome": "Ferrari", "email": "giulia.ferrari@email.it", "corso": "pianoforte", "tel": "+39 340 1111111"},
-        {"nome": "Marco", "cognome": "Romano", "email": "marco.romano@email.it", "corso": "pianoforte", "tel": "+39 340 2222222"},
-        {"nome": "Sara", "cognome": "Conti", "email": "sara.conti@email.it", "corso": "violino", "tel": "+39 340 3333333"},
-        {"nome": "Luca", "cognome": "Esposito", "email": "luca.esposito@email.it", "corso": "chitarra", "tel": "+39 340 4444444"},
-        {"nome": "Anna", "cognome": "Bruno", "email": "anna.bruno@email.it", "corso": "canto", "tel": "+39 340 5555555"},
-    ]
-    
-    student_ids = []
-    for s in students:
-        student_id = str(uuid.uuid4())
-        student_ids.append(student_id)
-        student = {
-            "id": student_id,
-            "ruolo": UserRole.STUDENT.value,
-            "nome": s["nome"],
-            "cognome": s["cognome"],
-            "email": s["email"],
-            "password_hash": hash_password("student123"),
-            "attivo": True,
-            "data_creazione": datetime.now(timezone.utc),
-            "ultimo_accesso": None,
-            "note_admin": None
-        }
-        await db.utenti.insert_one(student)
-        
-        # Student detail
-        detail = {
-            "id": str(uuid.uuid4()),
-            "utente_id": student_id,
-            "telefono": s["tel"],
-            "data_nascita": None,
-            "corso_principale": s["corso"],
-            "note": None
-        }
-        await db.allievi_dettaglio.insert_one(detail)
-    
-    # Create sample payments
-    now = datetime.now(timezone.utc)
-    for i, sid in enumerate(student_ids[:3]):
-        payment = {
-            "id": str(uuid.uuid4()),
-            "utente_id": sid,
-            "tipo": PaymentType.MONTHLY.value,
-            "importo": 150.0,
-            "descrizione": f"Quota mensile Luglio 2025",
-            "data_scadenza": now + timedelta(days=10 - i*5),
-            "stato": PaymentStatus.PENDING.value if i < 2 else PaymentStatus.OVERDUE.value,
-            "visibile_utente": True,
-            "data_creazione": now
-        }
-        await db.pagamenti.insert_one(payment)
-    
-    # Create sample notifications
-    notifications = [
-        {"titolo": "Benvenuti!", "messaggio": "Benvenuti nella nuova app dell'Accademia de 'I Musici'."},
-        {"titolo": "Concerto di fine anno", "messaggio": "Il concerto si terrà il 20 Dicembre 2025."},
-    ]
-    for n in notifications:
-        notif = {
-            "id": str(uuid.uuid4()),
-            "titolo": n["titolo"],
-            "messaggio": n["messaggio"],
-            "tipo": "generale",
-            "destinatari_ids": [],
-            "attivo": True,
-            "data_creazione": now
-        }
-        await db.notifiche.insert_one(notif)
+    counts = await generate_dataset(db, {
+        **DEMO_SCALE,
+        "allievi": allievi,
+        "insegnanti": insegnanti,
+        "presenze": presenze
+    })
+    for collection in ("utenti", "corsi", "impostazioni"):
+        await invalidation_bus.notify(collection)
+    clear_analytics_cache()
     
     return {
         "message": "Database popolato con successo",
-        "data": {
-            "admin": 1,
-            "insegnanti": len(teachers),
-            "allievi": len(students),
-            "pagamenti": 3,
-            "notifiche": 2
-        },
+        "data": counts,
         "credenziali_test": {
-            "admin": {"email": "acc.imusici@gmail.com", "password": "Accademia2026"},
-            "insegnante": {"email": "mario.rossi@musici.it", "password": "teacher123"},
-            "allievo": {"email": "giulia.ferrari@email.it", "password": "student123"}
+            "admin": {"email": ADMIN_CREDENTIALS["email"], "password": ADMIN_CREDENTIALS["password"]},
+            "insegnante": {"email": "mario.rossi@musici.it", "password": TEACHER_PASSWORD},
+            "allievo": {"email": "giulia.ferrari@email.it", "password": STUDENT_PASSWORD}
         }
     }
 
+# ===================== SYNC =====================
+
+@api_router.get("/sync")
+async def sync_changes(request: Request, since: Optional[str] = None):
+    """
+    Lessons, assignments, payments, attendance and notifications of the
+    current user changed or deleted since the `since` cursor (omit it for a
+    full snapshot). Call again with the returned `cursore` while `altro` is true.
+    """
+    current_user = await require_auth(request)
+    
+    try:
+        return await changes_since(db, current_user, since)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ===================== BATCH =====================
+
+@api_router.post("/batch")
+async def batch_requests(batch: BatchRequest, request: Request):
+    """
+    Run up to 20 GET requests in one call: the caller is authenticated once and
+    the sub-requests run concurrently. Every response keeps its own status.
+    """
+    current_user = await require_auth(request)
+    
+    try:
+        body = await run_batch(
+            request.app, request.scope, [sub.model_dump() for sub in batch.richieste], current_user
+        )
+    except BatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=body, media_type="application/json")
+
+# ===================== METRICS =====================
+
+@api_router.get("/metriche")
+async def get_metrics(request: Request, azzera: bool = False):
+    """Runtime counters of this process (Admin only); azzera=true resets them after reading"""
+    await require_admin(request)
+    
+    metrics = {
+        "coalescenza": coalesced_reads.metrics(),
+        "invalidazioni": invalidation_bus.metrics(),
+        "dati_riferimento": reference_data.metrics(),
+        "idempotenza": idempotency_keys.metrics(),
+        "limiti": rate_limiter.metrics(),
+        "google_auth": google_auth.metrics()
+    }
+    if azzera:
+        coalesced_reads.reset_metrics()
+    return metrics
+
+# ===================== PROFILER =====================
+
+@api_router.get("/profili")
+async def get_profiles(request: Request, percorso: Optional[str] = None):
+    """List stored request profiles (Admin only)"""
+    await require_admin(request)
+    
+    query = {}
+    if percorso:
+        query["percorso"] = percorso
+    
+    profiles = await db.profili.find(query, {"_id": 0, "stack": 0}).sort("data_creazione", -1).to_list(200)
+    return profiles
+
+@api_router.get("/profili/{profile_id}")
+async def download_profile(profile_id: str, request: Request, formato: str = "collapsed"):
+    """Download a request profile as collapsed stacks or speedscope JSON (Admin only)"""
+    await require_admin(request)
+    
+    profile = await db.profili.find_one({"id": profile_id}, {"_id": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    
+    if formato == "speedscope":
+        return Response(
+            content=speedscope_json(profile),
+            media_type="application/json",
+            headers={"Content-Disposition": f'attachment; filename="profilo-{profile_id}.speedscope.json"'}
+        )
+    if formato != "collapsed":
+        raise HTTPException(status_code=400, detail="Formato non supportato (collapsed | speedscope)")
+    
+    return PlainTextResponse(
+        profile.get("stack", ""),
+        headers={"Content-Disposition": f'attachment; filename="profilo-{profile_id}.folded"'}
+    )
+
+@api_router.delete("/profili/{profile_id}")
+async def delete_profile(profile_id: str, request: Request):
+    """Delete a request profile (Admin only)"""
+    await require_admin(request)
+    
+    result = await db.profili.delete_one({"id": profile_id})
+    if result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Profilo non trovato")
+    
+    return {"message": "Profilo eliminato"}
+
+async def authorize_profiling(scope: dict) -> bool:
+    """Only admins can ask for a profile of their own request"""
+    user = await get_current_user(Request(scope))
+    return bool(user) and user.get("ruolo") == UserRole.ADMIN.value
+
+async def store_profile(profile: dict):
+    await db.profili.insert_one(profile)
+    logger.info(f"Profilo {profile['id']} salvato: {profile['metodo']} {profile['percorso']} ({profile['durata_ms']} ms)")
+
+async def idempotency_owner(scope: dict) -> Optional[str]:
+    """Idempotency keys are per session: the same key from two sessions is two requests"""
+    return await get_session_token(Request(scope))
+
 # ===================== MAIN ROUTES =====================
 
 @api_router.get("/")
@@ -2116,9 +3089,36 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@api_router.get("/health/live")
+async def health_live():
+    """The process answers: restart it only when this fails"""
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def health_ready():
+    """Warmed up, not shutting down and MongoDB reachable: send traffic here"""
+    status = lifecycle.status()
+    status["mongo_ms"] = await ping(db) if lifecycle.ready else None
+    if not lifecycle.ready or status["mongo_ms"] is None:
+        return JSONResponse(status_code=503, content={"status": "not_ready", **status})
+    return {"status": "ready", **status}
+
 # Include the router in the main app
 app.include_router(api_router)
 
+app.add_middleware(IdempotencyMiddleware, store=idempotency_keys, owner=idempotency_owner)
+
+app.add_middleware(
+    ProfilerMiddleware,
+    authorize=authorize_profiling,
+    store=store_profile,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    interval=PROFILE_INTERVAL_MS / 1000,
+)
+
+# Outside the other middlewares: rejected requests never reach them
+app.add_middleware(RateLimitMiddleware, limiter=rate_limiter)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -2127,6 +3127,3 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
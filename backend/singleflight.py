@@ -0,0 +1,120 @@
+"""
+Coalescenza delle letture identiche concorrenti (single-flight).
+
+When a notification goes out hundreds of clients send the same GET at once.
+Reads going through `shared_find` / `shared_find_one` are keyed on the
+collection and the normalized query, projection, sort and limit: while a
+read with the same key is in flight, later callers wait for it instead of
+sending their own query to MongoDB.
+
+The shared read runs in its own task, so a client disconnecting does not
+cancel it for the others, and every caller gets its own deep copy of the
+result, free to enrich or filter it. Per-user permission filtering stays in
+the handlers: either the query is built from the user (and is then only shared
+between identical users) or the handler shares the user-independent part and
+filters the rest per user.
+"""
+import asyncio
+import copy
+import json
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+def _normalize(value) -> str:
+    """Canonical JSON of a query fragment: key order does not matter, list order does"""
+    def default(item):
+        if isinstance(item, datetime):
+            return {"$date": item.isoformat()}
+        return str(item)
+    return json.dumps(value, sort_keys=True, default=default, separators=(",", ":"))
+
+
+class SingleFlight:
+    """Share one in-flight call among concurrent callers with the same key"""
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._stats = defaultdict(lambda: {"richieste": 0, "eseguite": 0, "condivise": 0})
+
+    async def do(self, key: str, label: str, call: Callable[[], Awaitable[Any]]) -> Any:
+        stats = self._stats[label]
+        stats["richieste"] += 1
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            stats["eseguite"] += 1
+        else:
+            stats["condivise"] += 1
+        # shield: a cancelled caller must not cancel the call the others are waiting for
+        result = await asyncio.shield(task)
+        return copy.deepcopy(result)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved when every caller went away
+        if not task.cancelled():
+            task.exception()
+
+    async def drain(self, timeout: float) -> int:
+        """Wait up to `timeout` seconds for the calls in flight; returns how many were still running"""
+        pending = list(self._calls.values())
+        if not pending:
+            return 0
+        _, still_running = await asyncio.wait(pending, timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        return len(still_running)
+
+    def metrics(self) -> dict:
+        per_read = {label: dict(stats) for label, stats in sorted(self._stats.items())}
+        richieste = sum(s["richieste"] for s in per_read.values())
+        condivise = sum(s["condivise"] for s in per_read.values())
+        return {
+            "richieste": richieste,
+            "condivise": condivise,
+            "tasso_condivise": round(condivise / richieste, 4) if richieste else 0.0,
+            "in_volo": len(self._calls),
+            "letture": per_read,
+        }
+
+    def reset_metrics(self):
+        self._stats.clear()
+
+
+reads = SingleFlight()
+
+
+def read_key(collection, op: str, query: dict, projection: Optional[dict],
+             sort: Optional[List[Tuple[str, int]]] = None, limit: int = 0) -> str:
+    return "|".join([
+        collection.name, op, _normalize(query), _normalize(projection), _normalize(sort or []), str(limit)
+    ])
+
+
+async def shared_find(
+    collection,
+    query: dict,
+    projection: Optional[dict] = None,
+    sort: Optional[List[Tuple[str, int]]] = None,
+    limit: int = 0
+) -> List[dict]:
+    """find(query, projection).sort(sort).to_list(limit), coalesced with identical concurrent reads"""
+    async def call():
+        cursor = collection.find(query, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        return await cursor.to_list(limit or None)
+
+    key = read_key(collection, "find", query, projection, sort, limit)
+    return await reads.do(key, collection.name, call)
+
+
+async def shared_find_one(collection, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+    """find_one(query, projection), coalesced with identical concurrent reads"""
+    key = read_key(collection, "find_one", query, projection)
+    return await reads.do(key, collection.name, lambda: collection.find_one(query, projection))
@@ -0,0 +1,191 @@
+"""
+Sincronizzazione incrementale per i client offline (`GET /api/sync`).
+
+Every write to a synced collection sets `data_modifica`; every delete leaves
+a tombstone in `eliminazioni` carrying the id and the owner fields of the
+deleted document, so it can be filtered per user like the document was.
+A client keeps an opaque cursor and asks only for what changed since then:
+one range scan on (owner, data_modifica, id) per collection and one on the
+tombstones, each resuming from its own position.
+
+Positions are (data_modifica, id) pairs, so documents written in the same
+instant are neither skipped nor repeated across pages. A collection that
+returned less than a full page restarts SYNC_SAFETY_SECONDS before the
+sync started: a write stamped just before the read but committed after it
+is sent again next time instead of being lost. Clients apply changes as
+upserts by `id`, so receiving a document twice is harmless.
+
+Tombstones live SYNC_TOMBSTONE_DAYS days: a cursor older than that gets
+`reset: true` and a full snapshot, and the client drops its local copy.
+Documents moved to the archive (closed academic years) are not deletions
+and produce no tombstone.
+"""
+import asyncio
+import base64
+import binascii
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+SYNC_PAGE_SIZE = int(os.environ.get("SYNC_PAGE_SIZE", "500"))
+SYNC_SAFETY_SECONDS = 5
+SYNC_TOMBSTONE_DAYS = int(os.environ.get("SYNC_TOMBSTONE_DAYS", "90"))
+TOMBSTONES = "eliminazioni"
+EPOCH = datetime(1970, 1, 1)
+
+ADMIN, TEACHER, STUDENT = "amministratore", "insegnante", "allievo"
+
+# collection -> role -> field holding the user id (None: every document)
+OWNERS = {
+    "lezioni": {ADMIN: None, TEACHER: "insegnante_id", STUDENT: None},
+    "compiti": {ADMIN: None, TEACHER: "insegnante_id", STUDENT: "allievo_id"},
+    "pagamenti": {ADMIN: None, TEACHER: "utente_id", STUDENT: "utente_id"},
+    "presenze": {ADMIN: None, TEACHER: "insegnante_id", STUDENT: "allievo_id"},
+    "notifiche": {ADMIN: None, TEACHER: "destinatari_ids", STUDENT: "destinatari_ids"},
+}
+SYNCED_COLLECTIONS = list(OWNERS)
+OWNER_FIELDS = sorted({field for roles in OWNERS.values() for field in roles.values() if field})
+
+
+class InvalidCursor(Exception):
+    """The cursor was not produced by this endpoint"""
+
+
+async def ensure_sync_indexes(db):
+    for collection, roles in OWNERS.items():
+        await db[collection].create_index([("data_modifica", 1), ("id", 1)])
+        for field in {field for field in roles.values() if field}:
+            await db[collection].create_index([(field, 1), ("data_modifica", 1), ("id", 1)])
+    await db[TOMBSTONES].create_index([("collezione", 1), ("data_modifica", 1), ("id", 1)])
+    await db[TOMBSTONES].create_index("data_modifica", expireAfterSeconds=SYNC_TOMBSTONE_DAYS * 86400)
+
+
+async def record_deletions(db, collection: str, docs: Iterable[dict]):
+    """Leave a tombstone for each deleted document of a synced collection"""
+    now = datetime.now(timezone.utc)
+    tombstones = [
+        {
+            "collezione": collection,
+            "id": doc["id"],
+            "data_modifica": now,
+            **{field: doc[field] for field in OWNER_FIELDS if field in doc},
+        }
+        for doc in docs if doc and doc.get("id")
+    ]
+    if tombstones:
+        await db[TOMBSTONES].insert_many(tombstones)
+
+
+# ===================== CURSOR =====================
+
+Position = Tuple[datetime, str]
+
+
+def encode_cursor(positions: Dict[str, Position]) -> str:
+    raw = json.dumps({stream: [ts.isoformat(), doc_id] for stream, (ts, doc_id) in positions.items()})
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Position]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return {
+            stream: (datetime.fromisoformat(ts).replace(tzinfo=None), str(doc_id))
+            for stream, (ts, doc_id) in json.loads(raw).items()
+        }
+    except (binascii.Error, ValueError, TypeError, AttributeError) as e:
+        raise InvalidCursor("Cursore di sincronizzazione non valido") from e
+
+
+# ===================== QUERIES =====================
+
+def visibility_filter(collection: str, user: dict) -> dict:
+    field = OWNERS[collection][user["ruolo"]]
+    if field is None:
+        return {}
+    if field == "destinatari_ids":
+        # Broadcast notifications have no recipients
+        return {field: {"$in": [[], user["id"]]}}
+    return {field: user["id"]}
+
+
+def _after(position: Position) -> dict:
+    ts, doc_id = position
+    return {"$or": [{"data_modifica": {"$gt": ts}}, {"data_modifica": ts, "id": {"$gt": doc_id}}]}
+
+
+async def _scan(collection, query: dict, position: Position, projection: dict) -> List[dict]:
+    return await collection.find(
+        {**query, **_after(position)}, projection
+    ).sort([("data_modifica", 1), ("id", 1)]).to_list(SYNC_PAGE_SIZE)
+
+
+def _next_position(docs: List[dict], previous: Position, restart: Position) -> Position:
+    if len(docs) >= SYNC_PAGE_SIZE:
+        return _naive(docs[-1]["data_modifica"]), docs[-1]["id"]
+    return max(previous, restart)
+
+
+def _naive(value: datetime) -> datetime:
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+async def _collection_changes(db, collection: str, user: dict, positions: Dict[str, Position],
+                              restart: Position, snapshot: bool) -> Tuple[List[dict], List[str], Dict[str, Position], bool]:
+    visible = visibility_filter(collection, user)
+    position = positions.get(collection, (EPOCH, ""))
+    docs = await _scan(db[collection], visible, position, {"_id": 0})
+    new_positions = {collection: _next_position(docs, position, restart)}
+    more = len(docs) >= SYNC_PAGE_SIZE
+
+    removed = []
+    if collection == "pagamenti" and user["ruolo"] != ADMIN:
+        # Payments hidden from the user disappear from the device
+        removed = [doc["id"] for doc in docs if doc.get("visibile_utente") is False]
+        docs = [doc for doc in docs if doc.get("visibile_utente") is not False]
+
+    stream = f"{TOMBSTONES}.{collection}"
+    if snapshot:
+        # A full snapshot has nothing to delete on the device
+        new_positions[stream] = restart
+    else:
+        position = positions.get(stream, restart)
+        tombstones = await _scan(
+            db[TOMBSTONES], {"collezione": collection, **visible}, position, {"_id": 0, "id": 1, "data_modifica": 1}
+        )
+        new_positions[stream] = _next_position(tombstones, position, restart)
+        more = more or len(tombstones) >= SYNC_PAGE_SIZE
+        removed += [t["id"] for t in tombstones]
+    return docs, removed, new_positions, more
+
+
+async def changes_since(db, user: dict, cursor: Optional[str] = None) -> dict:
+    """
+    Documents changed and deleted for `user` since `cursor` (None: full
+    snapshot). The client applies `modifiche` as upserts by id, then removes
+    the ids in `eliminazioni`, and calls again with `cursore` while `altro`.
+    """
+    started = _naive(datetime.now(timezone.utc))
+    restart = (started - timedelta(seconds=SYNC_SAFETY_SECONDS), "")
+    positions = decode_cursor(cursor) if cursor else {}
+    # Only the tombstones expire: documents keep their (possibly old) positions while paging
+    oldest = min((ts for stream, (ts, _) in positions.items() if stream.startswith(TOMBSTONES)), default=started)
+    reset = oldest < started - timedelta(days=SYNC_TOMBSTONE_DAYS)
+    if reset:
+        positions = {}
+
+    results = await asyncio.gather(*(
+        _collection_changes(db, collection, user, positions, restart, snapshot=not positions)
+        for collection in SYNCED_COLLECTIONS
+    ))
+    new_positions = {}
+    for _, _, collection_positions, _ in results:
+        new_positions.update(collection_positions)
+    return {
+        "modifiche": {c: docs for c, (docs, _, _, _) in zip(SYNCED_COLLECTIONS, results)},
+        "eliminazioni": {c: removed for c, (_, removed, _, _) in zip(SYNCED_COLLECTIONS, results)},
+        "cursore": encode_cursor(new_positions),
+        "altro": any(more for _, _, _, more in results),
+        "reset": reset,
+    }
@@ -0,0 +1,166 @@
+"""
+Client HTTP condiviso verso i servizi esterni, con circuit breaker.
+
+The Google login of the administrators exchanges a session id with the
+OAuth provider. A client per call paid a new TCP and TLS handshake every
+time and had no timeout, so a slow provider kept requests (and workers)
+hanging. UpstreamClient keeps one pooled httpx client for the lifetime of
+the app, with keep-alive and explicit connect/read timeouts.
+
+The circuit breaker stops calling a provider that is down: after
+UPSTREAM_FAILURE_THRESHOLD consecutive failures (network errors, timeouts,
+5xx) calls fail immediately for UPSTREAM_RESET_SECONDS, then a single trial
+call decides whether to close the circuit again. A 4xx answer is the
+provider rejecting the request, not a failure of the provider.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_AUTH_URL = os.environ.get(
+    "GOOGLE_AUTH_URL", "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
+)
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "5"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "2"))
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get("UPSTREAM_FAILURE_THRESHOLD", "5"))
+UPSTREAM_RESET_SECONDS = float(os.environ.get("UPSTREAM_RESET_SECONDS", "30"))
+UPSTREAM_MAX_CONNECTIONS = 20
+
+CLOSED, OPEN, HALF_OPEN = "chiuso", "aperto", "semiaperto"
+
+
+class UpstreamUnavailable(Exception):
+    """The provider is down, too slow, or the circuit is open"""
+
+
+class UpstreamRejected(Exception):
+    """The provider answered with a 4xx"""
+
+    def __init__(self, status: int):
+        super().__init__(f"Risposta {status} dal servizio esterno")
+        self.status = status
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = UPSTREAM_FAILURE_THRESHOLD,
+                 reset_seconds: float = UPSTREAM_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._trial_running = False
+
+    def allow(self) -> bool:
+        """Whether a call may go out now (in half-open state, only one at a time)"""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        self.rejected += 1
+        return False
+
+    def retry_after(self) -> int:
+        return max(1, int(self.reset_seconds - (time.monotonic() - self.opened_at)) + 1)
+
+    def release_trial(self):
+        self._trial_running = False
+
+    def record_success(self):
+        self._trial_running = False
+        self.failures = 0
+        if self.state != CLOSED:
+            logger.info("Circuit breaker chiuso: il servizio esterno risponde di nuovo")
+        self.state = CLOSED
+
+    def record_failure(self):
+        self._trial_running = False
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                logger.warning(f"Circuit breaker aperto dopo {self.failures} errori consecutivi")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def metrics(self) -> dict:
+        return {"stato": self.state, "errori_consecutivi": self.failures, "rifiutate": self.rejected}
+
+
+class UpstreamClient:
+    """One pooled httpx client and one circuit breaker for an external endpoint"""
+
+    def __init__(self, url: str, timeout: float = UPSTREAM_TIMEOUT,
+                 connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT,
+                 breaker: Optional[CircuitBreaker] = None, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url = url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self.calls = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created on first use as well, for callers that do not run the app lifespan
+        if self._client is None:
+            self._open()
+        return self._client
+
+    def _open(self):
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_CONNECTIONS,
+                keepalive_expiry=60,
+            ),
+            transport=self.transport,
+        )
+
+    async def start(self):
+        if self._client is None:
+            self._open()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_json(self, headers: Optional[dict] = None) -> dict:
+        """GET the endpoint; UpstreamRejected for a 4xx, UpstreamUnavailable when it cannot answer"""
+        if not self.breaker.allow():
+            raise UpstreamUnavailable("Servizio esterno non disponibile (circuit breaker aperto)")
+        self.calls += 1
+        try:
+            response = await self.client.get(self.url, headers=headers)
+        except (httpx.HTTPError, asyncio.TimeoutError) as e:
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(f"Servizio esterno non raggiungibile: {type(e).__name__}") from e
+        except BaseException:
+            # Cancelled: not the provider's fault, but the trial slot must be freed
+            self.breaker.release_trial()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise UpstreamUnavailable(f"Servizio esterno in errore ({response.status_code})")
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise UpstreamRejected(response.status_code)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise UpstreamUnavailable("Risposta non valida dal servizio esterno") from e
+
+    def metrics(self) -> dict:
+        return {"url": self.url, "chiamate": self.calls, "circuit_breaker": self.breaker.metrics()}
@@ -0,0 +1,190 @@
+"""
+Import massivo di allievi e insegnanti da CSV/XLSX.
+
+Parsing and per-row validation are pure functions; password hashing runs in a
+process pool because bcrypt is CPU-bound and would otherwise block the event
+loop for the whole import. The database writes stay in server.py.
+
+Every imported password, generated or supplied in the file, is hashed with
+IMPORT_BCRYPT_ROUNDS (cheaper than the login default): the login rehashes any
+hash below the pwd_context minimum, so it reaches full strength on the first
+successful login. Admin PINs are never rehashed and get FULL_BCRYPT_ROUNDS.
+
+The pool starts its processes with "spawn": forking the server would copy its
+event loop, its MongoDB connections and their lock state into the children.
+"""
+import asyncio
+import csv
+import io
+import multiprocessing
+import os
+import re
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+IMPORT_BCRYPT_ROUNDS = int(os.environ.get("IMPORT_BCRYPT_ROUNDS", "10"))
+# PINs are not upgraded at login, so they get the same cost as pwd_context
+FULL_BCRYPT_ROUNDS = 12
+IMPORT_HASH_WORKERS = int(os.environ.get("IMPORT_HASH_WORKERS", "0")) or os.cpu_count() or 1
+MAX_IMPORT_ROWS = 20_000
+HASH_CHUNK = 50
+
+IMPORT_ROLES = ("allievo", "insegnante", "amministratore")
+REQUIRED_COLUMNS = ("ruolo", "nome", "cognome", "email")
+# Columns copied into utenti.dettaglio, by role
+DETAIL_COLUMNS = {
+    "allievo": ("telefono", "data_nascita", "corso_principale", "note"),
+    "insegnante": ("specializzazione", "compenso_orario", "note"),
+}
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+class ImportFileError(Exception):
+    """The uploaded file cannot be read as a table"""
+
+
+class ImportUnavailable(Exception):
+    """The file format needs an optional dependency that is not installed"""
+
+
+# ===================== PARSING =====================
+
+def _normalize_header(name) -> str:
+    return str(name or "").strip().lower().replace(" ", "_")
+
+
+def _clean(value) -> Optional[str]:
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _read_csv(content: bytes) -> List[dict]:
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = content.decode("latin-1")
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    return list(csv.DictReader(io.StringIO(text), dialect=dialect))
+
+
+def _read_xlsx(content: bytes) -> List[dict]:
+    import pandas as pd
+    try:
+        frame = pd.read_excel(io.BytesIO(content), dtype=str, keep_default_na=False, engine="openpyxl")
+    except ImportError:
+        raise ImportUnavailable("Import XLSX non disponibile: installare openpyxl")
+    return frame.to_dict("records")
+
+
+def read_rows(filename: str, content: bytes) -> List[dict]:
+    """Rows of the uploaded file with normalized headers and stripped values"""
+    extension = os.path.splitext(filename or "")[1].lower()
+    try:
+        if extension in (".xlsx", ".xlsm"):
+            raw = _read_xlsx(content)
+        elif extension in (".csv", ".txt", ""):
+            raw = _read_csv(content)
+        else:
+            raise ImportFileError("Formato non supportato (csv | xlsx)")
+    except (ImportFileError, ImportUnavailable):
+        raise
+    except Exception as e:
+        raise ImportFileError(f"File non leggibile: {e}")
+
+    rows = [{_normalize_header(k): _clean(v) for k, v in row.items() if k is not None} for row in raw]
+    rows = [row for row in rows if any(row.values())]
+    if not rows:
+        raise ImportFileError("Il file non contiene righe")
+    missing = [col for col in REQUIRED_COLUMNS if col not in rows[0]]
+    if missing:
+        raise ImportFileError(f"Colonne mancanti: {', '.join(missing)}")
+    if len(rows) > MAX_IMPORT_ROWS:
+        raise ImportFileError(f"Massimo {MAX_IMPORT_ROWS} righe per import")
+    return rows
+
+
+def validate_row(row: dict) -> Optional[str]:
+    """Error message for an invalid row, None if the row can be imported"""
+    for col in REQUIRED_COLUMNS:
+        if not row.get(col):
+            return f"Campo obbligatorio mancante: {col}"
+    if row["ruolo"].lower() not in IMPORT_ROLES:
+        return f"Ruolo non valido: {row['ruolo']}"
+    if not EMAIL_RE.match(row["email"]):
+        return f"Email non valida: {row['email']}"
+    if row.get("compenso_orario"):
+        try:
+            float(row["compenso_orario"].replace(",", "."))
+        except ValueError:
+            return f"Compenso orario non valido: {row['compenso_orario']}"
+    return None
+
+
+def build_detail(ruolo: str, row: dict) -> Optional[dict]:
+    """utenti.dettaglio from the detail columns of the row (without id/utente_id)"""
+    columns = DETAIL_COLUMNS.get(ruolo)
+    if not columns:
+        return None
+    detail = {col: row.get(col) for col in columns}
+    if ruolo == "insegnante":
+        if detail["compenso_orario"]:
+            detail["compenso_orario"] = float(detail["compenso_orario"].replace(",", "."))
+        detail["specializzazione"] = detail["specializzazione"] or row.get("strumento")
+    return detail
+
+
+def temporary_password() -> str:
+    return secrets.token_urlsafe(9)
+
+
+# ===================== HASHING =====================
+
+def _hash_chunk(passwords: List[str], rounds: int) -> List[str]:
+    from passlib.hash import bcrypt
+    hasher = bcrypt.using(rounds=rounds)
+    return [hasher.hash(password) for password in passwords]
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMPORT_HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+async def warm_pool():
+    """Start every hashing process now instead of on the first import"""
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    await asyncio.gather(*[
+        loop.run_in_executor(pool, _hash_chunk, ["riscaldamento"], 4) for _ in range(IMPORT_HASH_WORKERS)
+    ])
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def hash_passwords(passwords: List[str], rounds: int = IMPORT_BCRYPT_ROUNDS) -> List[str]:
+    """bcrypt hashes of `passwords`, in order, computed across the process pool"""
+    if not passwords:
+        return []
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    chunks = [passwords[i:i + HASH_CHUNK] for i in range(0, len(passwords), HASH_CHUNK)]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(pool, _hash_chunk, chunk, rounds) for chunk in chunks
+    ])
+    return [h for chunk in results for h in chunk]
+
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from batch import MAX_BATCH_SIZE, BatchError, _entry, validate
+
+
+def entry(sub, status=200, headers=None, body=b""):
+    return json.loads(_entry(3, sub, status, headers or {}, body))
+
+
+def test_json_body_is_embedded():
+    result = entry({"id": "corsi"}, headers={"content-type": "application/json"}, body=b'[{"id":"c1"}]')
+    assert result == {"id": "corsi", "stato": 200, "corpo": [{"id": "c1"}]}
+
+
+def test_id_falls_back_to_the_position():
+    assert entry({})["id"] == 3
+    assert entry({"id": None})["id"] == 3
+    assert entry({"id": 0})["id"] == 0
+
+
+def test_non_json_and_empty_bodies():
+    assert entry({}, 500, {"content-type": "text/plain"}, b"Internal Server Error")["corpo"] == "Internal Server Error"
+    assert entry({}, 204)["corpo"] is None
+
+
+@pytest.mark.parametrize("requests, message", [
+    ([], "Nessuna richiesta"),
+    ([{"percorso": "/api/corsi"}] * (MAX_BATCH_SIZE + 1), "Massimo"),
+    ([{"metodo": "POST", "percorso": "/api/corsi"}], "solo richieste GET"),
+    ([{"percorso": "/docs"}], "percorso non ammesso"),
+    ([{"percorso": "/api/batch/"}], "percorso non ammesso"),
+])
+def test_invalid_batches(requests, message):
+    with pytest.raises(BatchError, match=message):
+        validate(requests)
+
+
+def test_valid_batch():
+    validate([{"percorso": "/api/corsi?fields=id"}, {"metodo": "get", "percorso": "/api/pagamenti"}])
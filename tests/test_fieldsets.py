@@ -0,0 +1,37 @@
+import pytest
+
+from fieldsets import InvalidFields, projection, requested_fields, wants
+
+
+def test_no_fields_returns_the_default():
+    default = {"_id": 0, "password_hash": 0}
+    assert projection("utenti", "amministratore", None, default) is default
+    assert projection("utenti", "amministratore", " , ", default) is default
+
+
+def test_requested_fields_plus_always_included():
+    assert projection("pagamenti", "allievo", "importo, stato", {}) == {
+        "_id": 0, "data_scadenza": 1, "id": 1, "importo": 1, "stato": 1
+    }
+
+
+def test_field_outside_the_role_whitelist_is_refused():
+    with pytest.raises(InvalidFields, match="visibile_utente"):
+        projection("pagamenti", "allievo", "importo,visibile_utente", {})
+    assert "visibile_utente" in projection("pagamenti", "amministratore", "visibile_utente", {})
+
+
+def test_unknown_field_is_refused():
+    with pytest.raises(InvalidFields, match="password_hash"):
+        projection("utenti", "amministratore", "nome,password_hash", {})
+
+
+def test_computed_field_pulls_its_source():
+    result = projection("lezioni", "insegnante", "corso", {})
+    assert result == {"_id": 0, "corso_id": 1, "data": 1, "id": 1}
+    assert wants("corso", "corso") and not wants("corso", "insegnante") and wants(None, "insegnante")
+
+
+def test_requested_fields_parsing():
+    assert requested_fields("a, b,,c ") == {"a", "b", "c"}
+    assert requested_fields("") is None
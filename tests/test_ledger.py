@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from ledger import contribution, ledger_changes
+
+
+def payment(**fields):
+    base = {"id": "p1", "utente_id": "u1", "importo": 100.0, "stato": "in_attesa",
+            "data_scadenza": datetime(2026, 3, 1)}
+    return {**base, **fields}
+
+
+def test_contribution_by_state():
+    assert contribution(payment()) == {"da_pagare": 100.0, "pagamenti_aperti": 1}
+    assert contribution(payment(stato="scaduto")) == {"da_pagare": 100.0, "pagamenti_aperti": 1, "scaduto": 100.0}
+    assert contribution(payment(stato="pagato", data_pagamento=datetime(2025, 12, 30))) == {
+        "pagato_per_anno.2025": 100.0
+    }
+
+
+def test_hidden_payment_is_not_counted():
+    assert contribution(payment(visibile_utente=False)) == {}
+    assert ledger_changes(None, payment(visibile_utente=False)) == []
+
+
+def test_insert_adds_the_due_date():
+    assert ledger_changes(None, payment()) == [
+        ("u1", {"da_pagare": 100.0, "pagamenti_aperti": 1}, datetime(2026, 3, 1), False)
+    ]
+
+
+def test_paying_moves_the_amount_and_removes_the_due_date():
+    old = payment()
+    new = payment(stato="pagato", data_pagamento=datetime(2026, 2, 20))
+    [(user_id, delta, added, removed)] = ledger_changes(old, new)
+    assert user_id == "u1"
+    assert delta == {"da_pagare": -100.0, "pagamenti_aperti": -1, "pagato_per_anno.2026": 100.0}
+    assert added is None and removed
+
+
+def test_unchanged_pending_payment_changes_nothing():
+    assert ledger_changes(payment(), payment(descrizione="Retta marzo")) == []
+
+
+def test_moving_a_payment_to_another_user():
+    changes = {user_id: (delta, added, removed) for user_id, delta, added, removed
+               in ledger_changes(payment(), payment(utente_id="u2"))}
+    assert changes["u1"] == ({"da_pagare": -100.0, "pagamenti_aperti": -1}, None, True)
+    assert changes["u2"] == ({"da_pagare": 100.0, "pagamenti_aperti": 1}, datetime(2026, 3, 1), False)
@@ -0,0 +1,19 @@
+import pytest
+
+from profiler import ProfilerMiddleware
+
+
+@pytest.mark.parametrize("query, headers, expected", [
+    (b"__profile=1", [], True),
+    (b"mese=2026-03&__profile=1", [], True),
+    (b"x__profile=1", [], False),
+    (b"__profile=10", [], False),
+    (b"q=__profile=1", [], False),
+    (b"q=a%26__profile%3D1", [], False),
+    (b"", [(b"x-profile", b"1")], True),
+    (b"", [(b"x-profile", b"0")], False),
+    (b"", [], False),
+])
+def test_requested(query, headers, expected):
+    middleware = ProfilerMiddleware(None, authorize=None, store=None)
+    assert middleware._requested({"query_string": query, "headers": headers}) is expected
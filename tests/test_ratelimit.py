@@ -0,0 +1,41 @@
+import pytest
+
+from ratelimit import DEFAULT_RULES, PER_ADDRESS, PER_SESSION, RateLimiter, Rule, estimate, parse_rules
+
+
+def test_defaults_without_spec():
+    rules = parse_rules(None)
+    assert len(rules) == len(DEFAULT_RULES)
+    assert rules[("POST", "/api/auth/login")].per == PER_ADDRESS
+
+
+def test_override_keeps_the_principal_of_the_default():
+    rules = parse_rules("POST /api/auth/login=5/30")
+    assert rules[("POST", "/api/auth/login")] == Rule("POST", "/api/auth/login", 5, 30, PER_ADDRESS)
+
+
+def test_new_rule_and_removal():
+    rules = parse_rules("GET /api/corsi/=30/60 ; GET /api/pagamenti=0/60")
+    assert rules[("GET", "/api/corsi")] == Rule("GET", "/api/corsi", 30, 60, PER_SESSION)
+    assert ("GET", "/api/pagamenti") not in rules
+
+
+def test_invalid_rule():
+    with pytest.raises(ValueError, match="regola non valida"):
+        parse_rules("GET /api/corsi=trenta")
+
+
+def test_estimate_weights_the_previous_window():
+    assert estimate(10, 4, 0.0) == 14
+    assert estimate(10, 4, 0.25) == 11.5
+    assert estimate(10, 4, 1.0) == 4
+
+
+def test_check_rejects_over_the_limit():
+    rule = Rule("GET", "/api/corsi", 3, 3600)
+    limiter = RateLimiter(rules={(rule.method, rule.path): rule})
+    assert [limiter.check(rule, "a:1") for _ in range(3)] == [None, None, None]
+    wait = limiter.check(rule, "a:1")
+    assert wait is not None and wait >= 1
+    assert limiter.check(rule, "a:2") is None
+    assert limiter.metrics()["rifiutate"] == {rule.name: 1}
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+
+from reconciliation import PaymentIndex, match_transactions, parse_amount
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.234,56", 1234.56),
+    ("1,234.56", 1234.56),
+    ("1234.5", 1234.5),
+    ("-150,00 €", -150.0),
+    ("+80", 80.0),
+    ("", None),
+    (None, None),
+    ("abc", None),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+
+def transaction(riga, ordinante, importo, causale="Retta marzo", data=datetime(2026, 3, 3)):
+    return {"riga": riga, "data": data, "importo": importo, "ordinante": ordinante, "causale": causale}
+
+
+@pytest.fixture
+def index():
+    payments = [
+        {"id": "p1", "utente_id": "u1", "importo": 120.0, "data_scadenza": datetime(2026, 3, 1)},
+        {"id": "p2", "utente_id": "u1", "importo": 120.0, "data_scadenza": datetime(2026, 4, 1)},
+        {"id": "p3", "utente_id": "u2", "importo": 90.0, "data_scadenza": datetime(2026, 3, 1)},
+    ]
+    names = {"u1": ("Giulia", "Ferrari"), "u2": ("Luca", "Bianchi")}
+    return PaymentIndex(payments, names)
+
+
+def test_exact_match_is_certain(index):
+    matches, unmatched = match_transactions([transaction(1, "FERRARI GIULIA", 120.0)], index)
+    assert unmatched == []
+    [match] = matches
+    assert match["pagamento_id"] == "p1" and match["esito"] == "certo"
+
+
+def test_typo_and_near_amount_are_probable(index):
+    matches, _ = match_transactions([transaction(1, "Bianchi Lucca", 89.0)], index)
+    [match] = matches
+    assert match["pagamento_id"] == "p3" and match["esito"] == "probabile"
+
+
+def test_each_payment_is_assigned_once(index):
+    matches, unmatched = match_transactions([
+        transaction(1, "Giulia Ferrari", 120.0),
+        transaction(2, "Giulia Ferrari", 120.0, causale="Retta aprile"),
+    ], index)
+    assert [m["pagamento_id"] for m in matches] == ["p1", "p2"]
+    assert unmatched == []
+
+
+def test_unknown_payer_and_outgoing_transactions(index):
+    outgoing = transaction(2, "Giulia Ferrari", -120.0)
+    unknown = transaction(1, "Mario Verdi", 120.0)
+    matches, unmatched = match_transactions([unknown, outgoing], index)
+    assert matches == []
+    assert unmatched == [unknown]
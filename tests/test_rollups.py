@@ -0,0 +1,55 @@
+from datetime import datetime
+
+from rollups import rollup_changes, rollup_id, split_period
+
+
+def presenza(**fields):
+    base = {"id": "a1", "data": datetime(2026, 3, 10), "stato": "presente",
+            "insegnante_id": "t1", "corso_id": "c1", "allievo_id": "s1"}
+    return {**base, **fields}
+
+
+def test_insert_counts_the_state():
+    key = rollup_id("2026-03", "t1", "c1", "s1")
+    fields, delta = rollup_changes(None, presenza())[key]
+    assert fields == {"mese": "2026-03", "insegnante_id": "t1", "corso_id": "c1", "allievo_id": "s1"}
+    assert delta == {"presenti": 1, "totale": 1}
+
+
+def test_state_change_keeps_the_total():
+    old = presenza(stato="assente")
+    new = presenza(stato="giustificato", recupero_data=datetime(2026, 3, 20))
+    [(_, delta)] = rollup_changes(old, new).values()
+    assert delta == {"assenti": -1, "giustificati": 1, "recuperi": 1}
+
+
+def test_moving_to_another_month_touches_both_rollups():
+    changes = rollup_changes(presenza(), presenza(data=datetime(2026, 4, 2)))
+    assert changes[rollup_id("2026-03", "t1", "c1", "s1")][1] == {"presenti": -1, "totale": -1}
+    assert changes[rollup_id("2026-04", "t1", "c1", "s1")][1] == {"presenti": 1, "totale": 1}
+
+
+def test_record_without_date_is_ignored():
+    assert rollup_changes(None, presenza(data=None)) == {}
+
+
+def test_split_reads_the_end_month_from_presenze():
+    months, partial = split_period(datetime(2026, 1, 1), datetime(2026, 3, 31, 23, 59, 59))
+    assert months == ["2026-01", "2026-02"]
+    assert partial == {"data": {"$gte": datetime(2026, 3, 1), "$lte": datetime(2026, 3, 31, 23, 59, 59)}}
+    assert split_period(datetime(2026, 1, 1), datetime(2026, 4, 1))[0] == ["2026-01", "2026-02", "2026-03"]
+
+
+def test_split_with_partial_months_on_both_ends():
+    start, end = datetime(2026, 1, 15), datetime(2026, 4, 10)
+    months, partial = split_period(start, end)
+    assert months == ["2026-02", "2026-03"]
+    assert partial == {"$or": [
+        {"data": {"$gte": start, "$lt": datetime(2026, 2, 1)}},
+        {"data": {"$gte": datetime(2026, 4, 1), "$lte": end}},
+    ]}
+
+
+def test_split_inside_one_month_reads_presenze_only():
+    start, end = datetime(2026, 3, 5), datetime(2026, 3, 20)
+    assert split_period(start, end) == ([], {"data": {"$gte": start, "$lte": end}})
@@ -0,0 +1,49 @@
+import time
+
+from upstream import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+def test_opens_after_the_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.metrics() == {"stato": OPEN, "errori_consecutivi": 3, "rifiutate": 1}
+    assert 1 <= breaker.retry_after() <= 31
+
+
+def test_success_resets_the_count():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_allows_a_single_trial(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    opened = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: opened + 31)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.release_trial()
+    assert breaker.allow()
+
+
+def test_trial_outcome(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    opened = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: opened + 31)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    monkeypatch.setattr(time, "monotonic", lambda: opened + 62)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow() and breaker.allow()
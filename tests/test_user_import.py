@@ -0,0 +1,51 @@
+import pytest
+
+from user_import import ImportFileError, build_detail, read_rows, validate_row
+
+
+def test_read_csv_with_semicolons_and_bom():
+    content = "﻿Ruolo;Nome;Cognome;Email;Telefono\nallievo; Giulia ;Ferrari;g@example.it;\n;;;;\n".encode()
+    assert read_rows("allievi.csv", content) == [
+        {"ruolo": "allievo", "nome": "Giulia", "cognome": "Ferrari", "email": "g@example.it", "telefono": None}
+    ]
+
+
+def test_read_latin1_csv():
+    content = "ruolo,nome,cognome,email\ninsegnante,Niccolò,Rossi,n@example.it\n".encode("latin-1")
+    assert read_rows("insegnanti.csv", content)[0]["nome"] == "Niccolò"
+
+
+@pytest.mark.parametrize("filename, content, message", [
+    ("utenti.pdf", b"", "Formato non supportato"),
+    ("utenti.csv", b"ruolo,nome,cognome,email\n", "non contiene righe"),
+    ("utenti.csv", b"ruolo,nome\nallievo,Giulia\n", "Colonne mancanti: cognome, email"),
+])
+def test_read_errors(filename, content, message):
+    with pytest.raises(ImportFileError, match=message):
+        read_rows(filename, content)
+
+
+def row(**fields):
+    base = {"ruolo": "allievo", "nome": "Giulia", "cognome": "Ferrari", "email": "g@example.it"}
+    return {**base, **fields}
+
+
+def test_valid_row():
+    assert validate_row(row()) is None
+    assert validate_row(row(ruolo="Insegnante", compenso_orario="25,50")) is None
+
+
+@pytest.mark.parametrize("fields, message", [
+    ({"email": None}, "Campo obbligatorio mancante: email"),
+    ({"ruolo": "genitore"}, "Ruolo non valido"),
+    ({"email": "g@example"}, "Email non valida"),
+    ({"ruolo": "insegnante", "compenso_orario": "venti"}, "Compenso orario non valido"),
+])
+def test_invalid_rows(fields, message):
+    assert message in validate_row(row(**fields))
+
+
+def test_teacher_detail():
+    detail = build_detail("insegnante", row(ruolo="insegnante", compenso_orario="25,5", strumento="Violino"))
+    assert detail == {"specializzazione": "Violino", "compenso_orario": 25.5, "note": None}
+    assert build_detail("amministratore", row()) is None